@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Whole-library statistics over an exported catalog.
+
+Every report is a handful of vectorized NumPy operations over the
+catalog's columns (see catalog.py), so even a million photos take
+milliseconds.  Periods are calendar days, months or years in UTC.
+Photos with no known capture time (timestamp 0) are left out of the
+time-based reports.
+
+Usage:
+    analytics.py --media_dir /library timeline --period year
+    analytics.py --media_dir /library cameras
+    analytics.py --media_dir /library bursts --max_gap 2
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import catalog
+
+# Report periods and their numpy datetime64 units.
+PERIODS = {'day': 'D', 'month': 'M', 'year': 'Y'}
+
+
+def _period_numbers(timestamps, period):
+    """Returns the number of each timestamp's period since 1970."""
+    return timestamps.astype('datetime64[s]').astype(
+        'datetime64[%s]' % PERIODS[period]).astype(np.int64)
+
+
+def _period_labels(first, count, period):
+    """Returns count consecutive periods starting at number first."""
+    return np.arange(first, first + count).astype(
+        'datetime64[%s]' % PERIODS[period])
+
+
+def _dated(cat):
+    """Returns a mask of the photos with a known capture time."""
+    return np.asarray(cat.timestamp) != 0
+
+
+def timeline(cat, period='month'):
+    """Counts photos per period.
+
+    Returns (periods, counts): every period from the first photo's to
+    the last one's, including empty ones, as datetime64 values, and the
+    number of photos taken in each.
+    """
+    numbers = _period_numbers(np.asarray(cat.timestamp)[_dated(cat)],
+                              period)
+    if not len(numbers):
+        return (_period_labels(0, 0, period), np.zeros(0, dtype=np.int64))
+    first = numbers.min()
+    counts = np.bincount(numbers - first)
+    return (_period_labels(first, len(counts), period), counts)
+
+
+def camera_breakdown(cat, period='year'):
+    """Counts photos per camera and period.
+
+    Returns (names, periods, counts) where counts[i, j] is the number of
+    photos camera names[i] took in periods[j].  The last name is
+    '(unknown)', for photos without camera EXIF.
+    """
+    dated = _dated(cat)
+    numbers = _period_numbers(np.asarray(cat.timestamp)[dated], period)
+    cameras = np.asarray(cat.camera)[dated]
+    names = [cat.camera_name(code) for code in range(len(cat.cameras))]
+    names.append(cat.camera_name(-1))
+    if not len(numbers):
+        return (names, _period_labels(0, 0, period),
+                np.zeros((len(names), 0), dtype=np.int64))
+    first = numbers.min()
+    width = numbers.max() - first + 1
+    # Unknown cameras (-1) go in the last row.
+    rows = np.where(cameras < 0, len(names) - 1, cameras)
+    counts = np.bincount(rows * width + (numbers - first),
+                         minlength=len(names) * width)
+    return (names, _period_labels(first, width, period),
+            counts.reshape(len(names), width))
+
+
+def largest_periods(cat, period='month', top=10):
+    """Returns the top periods by bytes of photos taken, as a list of
+    (period, bytes, photos), largest first."""
+    dated = _dated(cat)
+    numbers = _period_numbers(np.asarray(cat.timestamp)[dated], period)
+    if not len(numbers):
+        return []
+    first = numbers.min()
+    offsets = numbers - first
+    sizes = np.bincount(offsets, weights=np.asarray(cat.size)[dated])
+    counts = np.bincount(offsets)
+    order = np.argsort(sizes, kind='stable')[::-1][:top]
+    labels = _period_labels(first, len(sizes), period)
+    return [(labels[i], int(sizes[i]), int(counts[i])) for i in order
+            if counts[i]]
+
+
+def size_histogram(cat, bins_per_decade=4):
+    """Returns (edges, counts) of file sizes in log-spaced bins, from
+    1 kB up to the largest file."""
+    sizes = np.asarray(cat.size)
+    sizes = sizes[sizes > 0]
+    if not len(sizes):
+        return (np.array([1e3]), np.zeros(0, dtype=np.int64))
+    decades = max(np.log10(max(sizes.max(), 1e3) / 1e3), 1 / bins_per_decade)
+    edges = 1e3 * np.logspace(
+        0, np.ceil(decades * bins_per_decade) / bins_per_decade,
+        int(np.ceil(decades * bins_per_decade)) + 1)
+    # Anything under 1 kB is counted in the first bin.
+    counts = np.histogram(np.clip(sizes, edges[0], edges[-1]), edges)[0]
+    return (edges, counts)
+
+
+def bursts(cat, max_gap=2, min_photos=3):
+    """Finds bursts: runs of at least min_photos photos from the same
+    camera, each taken within max_gap seconds of the one before.
+
+    Returns a list of (camera code, first timestamp, last timestamp,
+    photos), in time order.
+    """
+    dated = _dated(cat)
+    timestamps = np.asarray(cat.timestamp)[dated]
+    cameras = np.asarray(cat.camera)[dated]
+    if not len(timestamps):
+        return []
+    order = np.lexsort((timestamps, cameras))
+    (timestamps, cameras) = (timestamps[order], cameras[order])
+    breaks = ((np.diff(timestamps) > max_gap)
+              | (np.diff(cameras) != 0))
+    starts = np.flatnonzero(np.concatenate(([True], breaks)))
+    ends = np.concatenate((starts[1:], [len(timestamps)])) - 1
+    lengths = ends - starts + 1
+    keep = lengths >= min_photos
+    (starts, ends, lengths) = (starts[keep], ends[keep], lengths[keep])
+    by_time = np.argsort(timestamps[starts], kind='stable')
+    return [(int(cameras[starts[i]]), int(timestamps[starts[i]]),
+             int(timestamps[ends[i]]), int(lengths[i])) for i in by_time]
+
+
+def camera_spans(cat):
+    """Returns (camera code, first timestamp, last timestamp, photos) for
+    each camera with dated photos.
+
+    A camera whose first or last photo falls outside the years it was in
+    use points at a wrong clock.
+    """
+    dated = _dated(cat)
+    timestamps = np.asarray(cat.timestamp)[dated]
+    cameras = np.asarray(cat.camera)[dated]
+    if not len(timestamps):
+        return []
+    order = np.lexsort((timestamps, cameras))
+    (timestamps, cameras) = (timestamps[order], cameras[order])
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            np.diff(cameras) != 0)))
+    ends = np.concatenate((starts[1:], [len(timestamps)])) - 1
+    return [(int(cameras[s]), int(timestamps[s]), int(timestamps[e]),
+             int(e - s + 1)) for (s, e) in zip(starts, ends)]
+
+
+def _date(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def _print_report(cat, args, out):
+    """Prints the report chosen on the command line."""
+    if args.report == 'timeline':
+        (periods, counts) = timeline(cat, args.period)
+        for (label, count) in zip(periods, counts):
+            out.write('%s %8d\n' % (label, count))
+    elif args.report == 'cameras':
+        (names, periods, counts) = camera_breakdown(cat, args.period)
+        for (name, row) in zip(names, counts):
+            if not row.any():
+                continue
+            out.write('%s: %d\n' % (name, row.sum()))
+            for (label, count) in zip(periods, row):
+                if count:
+                    out.write('  %s %8d\n' % (label, count))
+    elif args.report == 'largest':
+        for (label, nbytes, count) in largest_periods(cat, args.period,
+                                                      args.top):
+            out.write('%s %10.1f MB %8d photos\n'
+                      % (label, nbytes / 1e6, count))
+    elif args.report == 'sizes':
+        (edges, counts) = size_histogram(cat)
+        for (low, high, count) in zip(edges, edges[1:], counts):
+            out.write('%10.0f kB - %10.0f kB %8d\n'
+                      % (low / 1e3, high / 1e3, count))
+    elif args.report == 'bursts':
+        for (code, first, last, count) in bursts(cat, args.max_gap,
+                                                 args.min_photos):
+            out.write('%s  %3d photos in %3ds  %s\n'
+                      % (_date(first), count, last - first,
+                         cat.camera_name(code)))
+    elif args.report == 'spans':
+        for (code, first, last, count) in camera_spans(cat):
+            out.write('%-30s %s .. %s %8d photos\n'
+                      % (cat.camera_name(code), _date(first)[:10],
+                         _date(last)[:10], count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Library statistics from an exported catalog '
+                    '(photoman.py --export_catalog).')
+    location = parser.add_mutually_exclusive_group(required=True)
+    location.add_argument('--media_dir',
+                          help='Library whose default catalog to read')
+    location.add_argument('--catalog_dir', help='Catalog to read')
+    parser.add_argument('report', choices=('timeline', 'cameras', 'largest',
+                                           'sizes', 'bursts', 'spans'))
+    parser.add_argument('--period', choices=tuple(PERIODS), default='month',
+                        help='Period for timeline, cameras and largest '
+                             '(default: month)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Periods to show for largest (default: 10)')
+    parser.add_argument('--max_gap', type=int, default=2,
+                        help='Most seconds between photos of a burst '
+                             '(default: 2)')
+    parser.add_argument('--min_photos', type=int, default=3,
+                        help='Fewest photos in a burst (default: 3)')
+    args = parser.parse_args()
+    catalog_dir = (args.catalog_dir
+                   or catalog.default_catalog_dir(args.media_dir))
+    try:
+        cat = catalog.Catalog(catalog_dir)
+    except FileNotFoundError:
+        parser.error('no catalog in %s; export one with photoman.py '
+                     '--export_catalog' % catalog_dir)
+    try:
+        _print_report(cat, args, sys.stdout)
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import calendar
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import analytics
+import catalog
+import media_common
+
+
+def _time(text):
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d %H:%M:%S'))
+
+
+class AnalyticsTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.tmpdir = tempfile.mkdtemp()
+        rep = media_common.Repository()
+        rep.open(self.tmpdir)
+        rows = [
+            # A three-shot burst, and a fourth shot too late to join it.
+            ('2010-01-05 10:00:00', 1000, 'Canon', 'PowerShot'),
+            ('2010-01-05 10:00:01', 2000, 'Canon', 'PowerShot'),
+            ('2010-01-05 10:00:03', 3000, 'Canon', 'PowerShot'),
+            ('2010-01-05 10:00:09', 4000, 'Canon', 'PowerShot'),
+            # Same second as the burst, but another camera.
+            ('2010-01-05 10:00:02', 5000000, 'Google', 'Pixel 3'),
+            ('2010-03-20 08:00:00', 500, 'Google', 'Pixel 3'),
+            ('2011-07-01 12:00:00', 700, None, None),
+        ]
+        rep.con.executemany(
+            'INSERT INTO photos (md5, size, archive_path, timestamp, '
+            'camera_make, camera_model) VALUES (?, ?, ?, ?, ?, ?)',
+            [(str(i), size, '/%d.jpg' % i, _time(when), make, model)
+             for (i, (when, size, make, model)) in enumerate(rows)])
+        # Undated photos are left out of the time-based reports.
+        rep.con.execute(
+            "INSERT INTO photos (md5, size, archive_path, timestamp) "
+            "VALUES ('x', 100, '/x.jpg', 0)")
+        catalog_dir = catalog.default_catalog_dir(self.tmpdir)
+        catalog.export(rep, catalog_dir)
+        rep.close()
+        self.cat = catalog.Catalog(catalog_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_timeline(self):
+        (periods, counts) = analytics.timeline(self.cat, 'month')
+        self.assertEqual(np.datetime64('2010-01'), periods[0])
+        self.assertEqual(np.datetime64('2011-07'), periods[-1])
+        self.assertEqual(19, len(periods))
+        self.assertEqual([5, 0, 1], counts[:3].tolist())
+        self.assertEqual(7, counts.sum())
+        (periods, counts) = analytics.timeline(self.cat, 'year')
+        self.assertEqual(['2010', '2011'], [str(p) for p in periods])
+        self.assertEqual([6, 1], counts.tolist())
+
+    def test_camera_breakdown(self):
+        (names, periods, counts) = analytics.camera_breakdown(self.cat)
+        self.assertEqual(['Canon PowerShot', 'Google Pixel 3', '(unknown)'],
+                         names)
+        self.assertEqual(['2010', '2011'], [str(p) for p in periods])
+        self.assertEqual([[4, 0], [2, 0], [0, 1]], counts.tolist())
+
+    def test_largest_periods(self):
+        self.assertEqual(
+            [(np.datetime64('2010-01'), 5010000, 5),
+             (np.datetime64('2011-07'), 700, 1),
+             (np.datetime64('2010-03'), 500, 1)],
+            analytics.largest_periods(self.cat, 'month'))
+        self.assertEqual(1, len(analytics.largest_periods(self.cat,
+                                                          top=1)))
+
+    def test_size_histogram(self):
+        (edges, counts) = analytics.size_histogram(self.cat,
+                                                   bins_per_decade=1)
+        self.assertEqual([1e3, 1e4, 1e5, 1e6, 1e7], edges.tolist())
+        # Files under 1 kB land in the first bin.
+        self.assertEqual([7, 0, 0, 1], counts.tolist())
+
+    def test_bursts(self):
+        start = _time('2010-01-05 10:00:00')
+        self.assertEqual([(0, start, start + 3, 3)],
+                         analytics.bursts(self.cat))
+        self.assertEqual([(0, start, start + 9, 4)],
+                         analytics.bursts(self.cat, max_gap=6))
+        self.assertEqual(7, len(analytics.bursts(self.cat, max_gap=0,
+                                                 min_photos=1)))
+
+    def test_camera_spans(self):
+        self.assertEqual(
+            [(-1, _time('2011-07-01 12:00:00'),
+              _time('2011-07-01 12:00:00'), 1),
+             (0, _time('2010-01-05 10:00:00'),
+              _time('2010-01-05 10:00:09'), 4),
+             (1, _time('2010-01-05 10:00:02'),
+              _time('2010-03-20 08:00:00'), 2)],
+            analytics.camera_spans(self.cat))
+
+
+if __name__ == '__main__':
+    unittest.main()
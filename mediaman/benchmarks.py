@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""Benchmarks for mediaman's hot paths.
+
+Each benchmark builds its own synthetic data under a temporary directory
+and prints timings to stdout.
+
+Usage:
+    python3 benchmarks.py sidecar [--files 20000]
+    python3 benchmarks.py relayout [--photos 30000]
+    python3 benchmarks.py quick_check [--photos 30000]
+    python3 benchmarks.py similar [--photos 30000]
+    python3 benchmarks.py thumbnails [--photos 20]
+    python3 benchmarks.py query [--photos 1000000]
+    python3 benchmarks.py catalog [--photos 1000000]
+    python3 benchmarks.py wal [--photos 100000] [--writes 2000]
+    python3 benchmarks.py classify [--files 2000]
+    python3 benchmarks.py names [--files 2000]
+    python3 benchmarks.py schedule [--photos 200] [--video_mb 500]
+    python3 benchmarks.py files_from [--files 20000] [--new 5]
+    python3 benchmarks.py sync [--photos 200]
+"""
+import argparse
+import io
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+import analytics
+import catalog
+import media_common
+import media_types
+import naming
+import photoman
+import relayout
+import similar
+import takeout_fixer
+import thumbnails
+
+
+def _timed(label, fn, *args):
+    """Run fn(*args), print how long it took, and return its result."""
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    print('%-40s %10.1f ms' % (label, elapsed * 1000))
+    return result
+
+
+def bench_sidecar(args):
+    """Pair a single Takeout directory holding --files media files."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for i in range(args.files):
+            rule = i % 4
+            if rule == 0:
+                media = 'IMG_%06d.jpg' % i
+                sidecar = media + '.json'
+            elif rule == 1:
+                media = 'IMG_%06d.jpg' % i
+                sidecar = media + '.supplemental-metadata.json'
+            elif rule == 2:
+                media = 'IMG_%06d(1).jpg' % i
+                sidecar = 'IMG_%06d.jpg(1).json' % i
+            else:
+                media = 'PXL_%06d_20230704_201512345.NIGHT.PORTRAIT.jpg' % i
+                sidecar = (media + '.supplemental-metadata')[:46] + '.json'
+            for name in (media, sidecar):
+                with open(os.path.join(tmpdir, name), 'wb'):
+                    pass
+
+        print('sidecar: %d media + %d sidecars in one directory'
+              % (args.files, args.files))
+        names = _timed('listdir', os.listdir, tmpdir)
+        index = _timed('build SidecarIndex', takeout_fixer.SidecarIndex,
+                       names)
+        groups, media, sidecars = _timed('match all', index.groups)
+        print('matched %d, unmatched media %d, unmatched sidecars %d'
+              % (sum(len(v) for v in groups.values()), len(media),
+                 len(sidecars)))
+
+
+def _build_library(lib_dir, photos):
+    """Creates a library of empty files with matching media.db rows, one
+    timestamp per day of 2010.  Returns the open Repository."""
+    rep = media_common.Repository()
+    rep.open(lib_dir)
+    start = time.mktime((2010, 1, 1, 12, 0, 0, 0, 0, -1))
+    rows = []
+    for i in range(photos):
+        timestamp = int(start + (i % 365) * 86400)
+        path = os.path.join(media_common.archive_dir(lib_dir, timestamp),
+                            'MVI_%06d.mp4' % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb'):
+            pass
+        rows.append(('%032x' % i, path, timestamp)
+                    + media_common.fingerprint(os.stat(path))[1:])
+    with rep.con:
+        rep.con.executemany(
+            "INSERT INTO photos (md5, size, archive_path, timestamp, "
+            "mtime_ns, inode, device, camera_model) "
+            "VALUES (?, 0, ?, ?, ?, ?, ?, 'Flip')", rows)
+    return rep
+
+
+def bench_relayout(args):
+    """Shift --photos archived photos by a year and move them."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rep = _build_library(tmpdir, args.photos)
+        print('relayout: %d photos, +1y' % args.photos)
+        selected = _timed('select', relayout.select_photos, rep, None,
+                          'Flip')
+        moves = _timed('plan', relayout.plan_moves, tmpdir, selected, 1, 0)
+        _timed('journal, move and update', relayout.relayout, rep, tmpdir,
+               moves)
+        rep.close()
+
+
+def bench_quick_check(args):
+    """Fingerprint-check a library of --photos files, 1% of them touched."""
+    # The synthetic digests are fake, so every re-hash is a "mismatch".
+    logging.getLogger('').setLevel(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _build_library(tmpdir, args.photos).close()
+        for (i, path) in enumerate(media_common.walk_files(
+                os.path.join(tmpdir, 'photos'))):
+            if i % 100 == 0:
+                os.utime(path, (0, 0))
+        print('quick_check: %d photos' % args.photos)
+        counts = _timed('quick check', photoman._quick_check, tmpdir)
+        print(dict(counts))
+
+
+def bench_similar(args):
+    """Cluster --photos perceptual hashes, 1% of them near copies."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(args.photos)]
+    for i in range(0, args.photos, 100):
+        hashes[i] = hashes[rng.randrange(args.photos)] ^ (1 << i % 64)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rep = _build_library(tmpdir, args.photos)
+        with rep.con:
+            rep.con.executemany(
+                'UPDATE photos SET phash = ? WHERE id = ?',
+                [(similar.to_db(phash), i + 1)
+                 for (i, phash) in enumerate(hashes)])
+        print('similar: %d photos' % args.photos)
+        clusters = _timed('find_similar', similar.find_similar, rep)
+        print('%d clusters' % len(clusters))
+        index = _timed('load SimilarityIndex', similar.SimilarityIndex, rep)
+        _timed('1000 ingest lookups',
+               lambda: [index.nearest(phash) for phash in hashes[:1000]])
+        rep.close()
+
+
+def bench_thumbnails(args):
+    """Thumbnail --photos 12 MP JPEGs with draft mode and without."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(args.photos):
+            path = os.path.join(tmpdir, 'IMG_%04d.jpg' % i)
+            Image.effect_mandelbrot((4000, 3000), (-2 + i * 0.01, -1.2,
+                                                   1, 1.2), 100).convert(
+                'RGB').save(path, quality=90)
+            paths.append(path)
+        print('thumbnails: %d photos, 4000x3000, sizes %s'
+              % (args.photos, thumbnails.SIZES))
+
+        def full_decode():
+            for path in paths:
+                with Image.open(path) as image:
+                    image = ImageOps.exif_transpose(image.convert('RGB'))
+                for size in sorted(thumbnails.SIZES, reverse=True):
+                    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        def draft():
+            for (i, path) in enumerate(paths):
+                thumbnails.generate(os.path.join(tmpdir, 'cache'), path,
+                                    '%032x' % i)
+
+        _timed('full decode (no save)', full_decode)
+        _timed('draft decode + save', draft)
+
+
+def bench_query(args):
+    """Run typical catalog queries against --photos synthetic rows."""
+    cameras = [('Canon', 'PowerShot S%d' % i) for i in range(20)] + [
+        ('Samsung', 'Galaxy S%d' % i) for i in range(20)]
+    start = time.mktime((2000, 1, 1, 12, 0, 0, 0, 0, -1))
+    # 20 years of photos, one every ~10 minutes for a million rows.
+    step = 20 * 365 * 86400 // args.photos
+
+    def rows():
+        for i in range(args.photos):
+            timestamp = int(start + i * step)
+            (make, model) = cameras[i * 7919 % len(cameras)]
+            yield ('%032x' % i, 1000000 + i % 5000000,
+                   os.path.join(media_common.archive_dir('/library',
+                                                         timestamp),
+                                'IMG_%07d.jpg' % i),
+                   timestamp, make, model)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rep = media_common.Repository()
+        rep.open(tmpdir)
+        with rep.con:
+            _timed('insert %d rows' % args.photos, rep.con.executemany,
+                   'INSERT INTO photos (md5, size, archive_path, timestamp, '
+                   'camera_make, camera_model) VALUES (?, ?, ?, ?, ?, ?)',
+                   rows())
+        print('query: %d photos' % args.photos)
+        day = media_common.parse_date('2010-06-15')
+        month = media_common.parse_date('2010-06-01')
+        queries = [
+            ('count all', lambda: rep.count()),
+            ('one day', lambda: list(rep.query(since=day,
+                                               before=day + 86400))),
+            ('camera, one month', lambda: list(rep.query(
+                make='samsung', model='galaxy s3', since=month,
+                before=month + 30 * 86400))),
+            ('path prefix, one month', lambda: list(rep.query(
+                path_prefix='/library/photos/2010/06_June/'))),
+            ('count one camera', lambda: rep.count(make='Canon',
+                                                   model='PowerShot S7')),
+            ('first 100 of one camera', lambda: list(rep.query(
+                make='Canon', model='PowerShot S7', limit=100))),
+        ]
+        for (label, query) in queries:
+            result = _timed(label, query)
+            print('%40s %d' % ('->', result if isinstance(result, int)
+                                else len(result)))
+        rep.close()
+
+
+def bench_catalog(args):
+    """Export --photos synthetic rows and run each analytics report,
+    against the same timeline computed in SQL."""
+    cameras = [('Canon', 'PowerShot S%d' % i) for i in range(20)] + [
+        ('Samsung', 'Galaxy S%d' % i) for i in range(20)]
+    start = time.mktime((2000, 1, 1, 12, 0, 0, 0, 0, -1))
+    step = 20 * 365 * 86400 // args.photos
+    rng = random.Random(1)
+
+    def rows():
+        for i in range(args.photos):
+            (make, model) = cameras[i * 7919 % len(cameras)]
+            yield ('%032x' % i, rng.randrange(100000, 20000000),
+                   '/library/photos/IMG_%07d.jpg' % i,
+                   int(start + i * step + rng.randrange(step)), 4000, 3000,
+                   make, model)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rep = media_common.Repository()
+        rep.open(tmpdir)
+        with rep.con:
+            rep.con.executemany(
+                'INSERT INTO photos (md5, size, archive_path, timestamp, '
+                'width, height, camera_make, camera_model) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows())
+        print('catalog: %d photos' % args.photos)
+        catalog_dir = catalog.default_catalog_dir(tmpdir)
+        _timed('export', catalog.export, rep, catalog_dir)
+        _timed('SQL timeline by month', lambda: rep.con.execute(
+            "SELECT strftime('%Y-%m', timestamp, 'unixepoch') AS month, "
+            "COUNT(*) FROM photos WHERE timestamp != 0 GROUP BY month"
+        ).fetchall())
+        rep.close()
+        cat = _timed('open (memory-mapped)', catalog.Catalog, catalog_dir)
+        _timed('timeline by month', analytics.timeline, cat, 'month')
+        _timed('cameras by year', analytics.camera_breakdown, cat, 'year')
+        _timed('largest months', analytics.largest_periods, cat, 'month')
+        _timed('size histogram', analytics.size_histogram, cat)
+        _timed('bursts', analytics.bursts, cat)
+        _timed('camera spans', analytics.camera_spans, cat)
+
+
+def bench_wal(args):
+    """Ingest --writes photos, one commit each, into a --photos row
+    library while another connection runs reports, with the old
+    rollback journal and with WAL."""
+    report = ('SELECT camera_model, COUNT(*), SUM(size) FROM photos '
+              'GROUP BY camera_model')
+    for mode in ('delete', 'wal'):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rep = _build_library(tmpdir, 0)
+            with rep.con:
+                rep.con.executemany(
+                    'INSERT INTO photos (md5, size, timestamp, camera_model) '
+                    'VALUES (?, ?, ?, ?)',
+                    (('%032x' % i, i, i, 'Model %d' % (i % 50))
+                     for i in range(args.photos)))
+            if mode == 'delete':
+                # What open() used to leave: SQLite's defaults.
+                rep.con.execute('PRAGMA journal_mode = DELETE')
+                rep.con.execute('PRAGMA synchronous = FULL')
+            done = threading.Event()
+            reports = []
+
+            def read():
+                reader = media_common.Repository()
+                reader.open(tmpdir, read_only=True)
+                while not done.is_set():
+                    start = time.perf_counter()
+                    reader.con.execute(report).fetchall()
+                    reports.append(time.perf_counter() - start)
+                reader.close()
+
+            thread = threading.Thread(target=read)
+            thread.start()
+            start = time.perf_counter()
+            for i in range(args.writes):
+                photo = media_common.Photo('/staging/IMG_%06d.jpg' % i)
+                photo.md5 = 'new%029x' % i
+                photo.size = i
+                photo.archive_path = '/library/photos/IMG_%06d.jpg' % i
+                photo.timestamp = i
+                rep.add_or_update(photo)
+            elapsed = time.perf_counter() - start
+            done.set()
+            thread.join()
+            rep.close()
+            reports.sort()
+            print('%-8s %8.0f commits/s  %5d reports, median %6.1f ms, '
+                  'max %7.1f ms' % (mode, args.writes / elapsed, len(reports),
+                                    reports[len(reports) // 2] * 1000,
+                                    reports[-1] * 1000))
+
+
+def bench_classify(args):
+    """Stage --files files, half of them Takeout sidecars: what the
+    sidecars used to cost (MD5 and a Pillow open each) against the cost
+    of classifying every file by signature."""
+    photo = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'test', 'DSC09012.JPG')
+    with open(photo, 'rb') as fh:
+        jpeg = fh.read()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for i in range(args.files // 2):
+            path = os.path.join(tmpdir, 'IMG_%05d.jpg' % i)
+            with open(path, 'wb') as fh:
+                fh.write(jpeg)
+            with open(path + '.json', 'w') as fh:
+                fh.write('{"title": "IMG_%05d.jpg", "photoTakenTime": '
+                         '{"timestamp": "1341000000"}}' % i)
+            paths += [path, path + '.json']
+        sidecars = paths[1::2]
+        print('classify: %d files, %d sidecars' % (len(paths),
+                                                    len(sidecars)))
+
+        def ingest_sidecars():
+            for path in sidecars:
+                media_common.compute_md5(path)
+                try:
+                    media_common.read_image_metadata(path)
+                except OSError:
+                    pass
+
+        def sniff():
+            return sum(media_types.classify(path) is not None
+                       for path in paths)
+
+        _timed('sidecars: MD5 + Pillow open', ingest_sidecars)
+        print('%40s %d media' % ('->', _timed('all files: signature',
+                                             sniff)))
+
+
+def bench_names(args):
+    """Create --files files of the same name in one directory: trying
+    name_1, name_2, ... in turn against the NameAllocator."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+
+    def probe(dest_dir):
+        for _ in range(args.files):
+            path = os.path.join(dest_dir, 'IMG_0001.JPG')
+            counter = 0
+            while True:
+                try:
+                    os.close(os.open(path, flags, 0o644))
+                    break
+                except FileExistsError:
+                    counter += 1
+                    path = os.path.join(dest_dir, 'IMG_0001_%d.JPG' % counter)
+
+    def allocate(dest_dir):
+        names = naming.NameAllocator()
+        for _ in range(args.files):
+            os.close(names.create(dest_dir, 'IMG_0001.JPG')[0])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print('names: %d files named IMG_0001.JPG' % args.files)
+        for (label, fn) in (('probe each suffix', probe),
+                            ('NameAllocator', allocate)):
+            dest_dir = os.path.join(tmpdir, fn.__name__)
+            os.mkdir(dest_dir)
+            _timed(label, fn, dest_dir)
+
+
+def bench_schedule(args):
+    """Archive a staging directory holding one --video_mb video and
+    --photos photos with each schedule, and compare the time to archive
+    per file."""
+    photo = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'test', 'DSC09012.JPG')
+    with open(photo, 'rb') as fh:
+        jpeg = fh.read()
+    chunk = b'\0' * (1 << 20)
+    logging.getLogger('').setLevel(logging.ERROR)
+    print('schedule: %d photos and a %d MB video'
+          % (args.photos, args.video_mb))
+    print('%-12s %8s %8s %8s %8s' % ('', 'mean', 'p50', 'p90', 'max'))
+    for schedule in photoman.SCHEDULES:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            staging = os.path.join(tmpdir, 'staging')
+            # The video sits first in the walk, the photos in a subdirectory.
+            os.makedirs(os.path.join(staging, 'phone'))
+            with open(os.path.join(staging, 'VID_0001.MP4'), 'wb') as fh:
+                fh.write(b'\0\0\0\x18ftypmp42' + b'\0' * 12)
+                for _ in range(args.video_mb):
+                    fh.write(chunk)
+            for i in range(args.photos):
+                path = os.path.join(staging, 'phone', 'IMG_%05d.JPG' % i)
+                with open(path, 'wb') as fh:
+                    # Trailing bytes after the image make every MD5 unique.
+                    fh.write(jpeg + b'%d' % i)
+            latencies = photoman._find_and_archive_photos(
+                staging, os.path.join(tmpdir, 'library'), True, '',
+                schedule=schedule)
+            summary = photoman._latency_summary(latencies)
+            print('%-12s %7.2fs %7.2fs %7.2fs %7.2fs'
+                  % (schedule, summary['mean'], summary['p50'],
+                     summary['p90'], summary['max']))
+
+
+def bench_files_from(args):
+    """Archive --new photos from a staging tree that also holds --files
+    leftover files (sidecars and the like): walking the tree against
+    reading the new paths from --files_from."""
+    logging.getLogger('').setLevel(logging.ERROR)
+    photo = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'test', 'DSC09012.JPG')
+    with open(photo, 'rb') as fh:
+        jpeg = fh.read()
+    print('files_from: %d new photos among %d staged files'
+          % (args.new, args.files))
+    for mode in ('walk', 'files_from'):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            staging = os.path.join(tmpdir, 'staging')
+            for i in range(args.files):
+                subdir = os.path.join(staging, 'takeout_%03d' % (i // 1000))
+                os.makedirs(subdir, exist_ok=True)
+                with open(os.path.join(subdir, 'IMG_%06d.jpg.json' % i),
+                          'w') as fh:
+                    fh.write('{"title": "IMG_%06d.jpg"}' % i)
+            new = []
+            for i in range(args.new):
+                new.append('new/IMG_%05d.JPG' % i)
+                os.makedirs(os.path.join(staging, 'new'), exist_ok=True)
+                with open(os.path.join(staging, new[-1]), 'wb') as fh:
+                    fh.write(jpeg + b'%d' % i)
+            files_from = None
+            if mode == 'files_from':
+                files_from = photoman._read_file_list(
+                    io.BytesIO('\n'.join(new).encode()))
+            _timed(mode, photoman._find_and_archive_photos, staging,
+                   os.path.join(tmpdir, 'library'), True, '',
+                   photoman.DEFAULT_QUARANTINE_AFTER, 'skip', 'walk',
+                   photoman.DEFAULT_SCHEDULE_BUDGET, files_from)
+
+
+def bench_sync(args):
+    """Archive --photos photos with --del_src and each --sync_batch size:
+    what making the copies durable before deleting their sources costs
+    in throughput."""
+    logging.getLogger('').setLevel(logging.ERROR)
+    photo = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                         'test', 'DSC09012.JPG')
+    with open(photo, 'rb') as fh:
+        jpeg = fh.read()
+    print('sync: %d photos' % args.photos)
+    for (sync_batch, sync_mode) in ((0, 'fsync'), (1, 'fsync'),
+                                    (10, 'fsync'), (100, 'fsync'),
+                                    (100, 'syncfs')):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            staging = os.path.join(tmpdir, 'staging')
+            os.mkdir(staging)
+            for i in range(args.photos):
+                with open(os.path.join(staging, 'IMG_%05d.JPG' % i),
+                          'wb') as fh:
+                    fh.write(jpeg + b'%d' % i)
+            start = time.perf_counter()
+            photoman._find_and_archive_photos(
+                staging, os.path.join(tmpdir, 'library'), True, '',
+                sync_batch=sync_batch, sync_mode=sync_mode)
+            elapsed = time.perf_counter() - start
+            label = ('--sync_batch 0 (no sync)' if not sync_batch else
+                     '--sync_batch %d --sync_mode %s' % (sync_batch,
+                                                          sync_mode))
+            print('%-40s %10.1f files/s' % (label, args.photos / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    sidecar = sub.add_parser('sidecar', help=bench_sidecar.__doc__)
+    sidecar.add_argument('--files', type=int, default=20000)
+    sidecar.set_defaults(func=bench_sidecar)
+
+    relayout_parser = sub.add_parser('relayout', help=bench_relayout.__doc__)
+    relayout_parser.add_argument('--photos', type=int, default=30000)
+    relayout_parser.set_defaults(func=bench_relayout)
+
+    quick_check = sub.add_parser('quick_check',
+                                 help=bench_quick_check.__doc__)
+    quick_check.add_argument('--photos', type=int, default=30000)
+    quick_check.set_defaults(func=bench_quick_check)
+
+    similar_parser = sub.add_parser('similar', help=bench_similar.__doc__)
+    similar_parser.add_argument('--photos', type=int, default=30000)
+    similar_parser.set_defaults(func=bench_similar)
+
+    thumbnails_parser = sub.add_parser('thumbnails',
+                                       help=bench_thumbnails.__doc__)
+    thumbnails_parser.add_argument('--photos', type=int, default=20)
+    thumbnails_parser.set_defaults(func=bench_thumbnails)
+
+    query = sub.add_parser('query', help=bench_query.__doc__)
+    query.add_argument('--photos', type=int, default=1000000)
+    query.set_defaults(func=bench_query)
+
+    catalog_parser = sub.add_parser('catalog', help=bench_catalog.__doc__)
+    catalog_parser.add_argument('--photos', type=int, default=1000000)
+    catalog_parser.set_defaults(func=bench_catalog)
+
+    wal = sub.add_parser('wal', help=bench_wal.__doc__)
+    wal.add_argument('--photos', type=int, default=100000)
+    wal.add_argument('--writes', type=int, default=2000)
+    wal.set_defaults(func=bench_wal)
+
+    classify = sub.add_parser('classify', help=bench_classify.__doc__)
+    classify.add_argument('--files', type=int, default=2000)
+    classify.set_defaults(func=bench_classify)
+
+    names = sub.add_parser('names', help=bench_names.__doc__)
+    names.add_argument('--files', type=int, default=2000)
+    names.set_defaults(func=bench_names)
+
+    schedule = sub.add_parser('schedule', help=bench_schedule.__doc__)
+    schedule.add_argument('--photos', type=int, default=200)
+    schedule.add_argument('--video_mb', type=int, default=500)
+    schedule.set_defaults(func=bench_schedule)
+
+    files_from = sub.add_parser('files_from', help=bench_files_from.__doc__)
+    files_from.add_argument('--files', type=int, default=20000)
+    files_from.add_argument('--new', type=int, default=5)
+    files_from.set_defaults(func=bench_files_from)
+
+    sync = sub.add_parser('sync', help=bench_sync.__doc__)
+    sync.add_argument('--photos', type=int, default=200)
+    sync.set_defaults(func=bench_sync)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
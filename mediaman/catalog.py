@@ -0,0 +1,115 @@
+"""Columnar export of the photos table for fast analysis.
+
+The catalog is a directory holding one NumPy .npy file per column, so
+each column can be memory-mapped and scanned without parsing rows:
+
+    id, timestamp, size      int64
+    width, height            int32, -1 where unknown
+    latitude, longitude      float64, NaN where unknown
+    camera                   int32 index into cameras, -1 where unknown
+    cameras                  (n, 2) str array of (make, model)
+
+Timestamps of unknown capture time are 0, as in media.db.
+"""
+
+import os
+import os.path
+import shutil
+
+import numpy as np
+
+CATALOG_DIR_NAME = 'catalog'
+
+# Numeric columns copied from the photos table, with their dtype and the
+# SQL value standing in for NULL ('nan' is cast to NaN by NumPy).
+_NUMERIC_COLUMNS = (
+    ('id', np.int64, 0),
+    ('timestamp', np.int64, 0),
+    ('size', np.int64, 0),
+    ('width', np.int32, -1),
+    ('height', np.int32, -1),
+    ('latitude', np.float64, "'nan'"),
+    ('longitude', np.float64, "'nan'"),
+)
+
+COLUMNS = tuple(name for (name, _dtype, _null) in _NUMERIC_COLUMNS) + (
+    'camera', 'cameras')
+
+
+def default_catalog_dir(lib_base_dir):
+    """Returns where a library's catalog is exported by default."""
+    return os.path.join(lib_base_dir, CATALOG_DIR_NAME)
+
+
+def export(rep, catalog_dir):
+    """Writes the photos table of rep to catalog_dir, replacing any
+    earlier export.  Returns the number of photos exported.
+
+    The new catalog is written next to the old one and swapped in, so
+    readers see either the old or the new columns, never a mix.
+    """
+    # SQLite fills in the NULLs and looks up camera codes, so rows go
+    # straight into one structured array without per-value Python code.
+    rep.con.execute(
+        'CREATE TEMP TABLE catalog_cameras AS SELECT DISTINCT camera_make '
+        'AS make, camera_model AS model FROM photos WHERE camera_make IS '
+        'NOT NULL OR camera_model IS NOT NULL ORDER BY make, model')
+    try:
+        rep.con.execute('CREATE INDEX temp.catalog_cameras_make_model '
+                        'ON catalog_cameras (make, model)')
+        cameras = rep.con.execute(
+            'SELECT make, model FROM catalog_cameras ORDER BY rowid'
+        ).fetchall()
+        # Codes are rowid - 1; unknown cameras find no row and get -1.
+        rows = np.fromiter(rep.con.execute(
+            'SELECT %s, IFNULL((SELECT rowid FROM catalog_cameras WHERE '
+            'make IS camera_make AND model IS camera_model), 0) - 1 '
+            'FROM photos ORDER BY id'
+            % ', '.join('IFNULL(%s, %s)' % (name, null)
+                        for (name, _dtype, null) in _NUMERIC_COLUMNS)),
+            dtype=[(name, dtype) for (name, dtype, _null)
+                   in _NUMERIC_COLUMNS] + [('camera', np.int32)])
+    finally:
+        rep.con.execute('DROP TABLE temp.catalog_cameras')
+    columns = {name: rows[name] for name in rows.dtype.names}
+    columns['cameras'] = (
+        np.array([(make or '', model or '') for (make, model) in cameras],
+                 dtype=str)
+        if cameras else np.empty((0, 2), dtype=str))
+
+    tmp_dir = catalog_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for (name, values) in columns.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), values)
+    old_dir = catalog_dir + '.old'
+    if os.path.exists(catalog_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(catalog_dir, old_dir)
+    os.rename(tmp_dir, catalog_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return len(rows)
+
+
+class Catalog():
+    """The columns of an exported catalog, as NumPy arrays.
+
+    Columns are memory-mapped unless mmap is False, so opening a catalog
+    costs nothing until a column is used.
+    """
+
+    def __init__(self, catalog_dir, mmap=True):
+        self.catalog_dir = catalog_dir
+        for name in COLUMNS:
+            setattr(self, name, np.load(
+                os.path.join(catalog_dir, name + '.npy'),
+                mmap_mode='r' if mmap else None))
+
+    def __len__(self):
+        return len(self.id)
+
+    def camera_name(self, code):
+        """Returns 'make model' for a camera code, or '(unknown)'."""
+        if code < 0:
+            return '(unknown)'
+        return ' '.join(part for part in self.cameras[code] if part)
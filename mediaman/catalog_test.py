@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import catalog
+import media_common
+
+
+class CatalogTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.tmpdir = tempfile.mkdtemp()
+        self.rep = media_common.Repository()
+        self.rep.open(self.tmpdir)
+        self.rep.con.executemany(
+            'INSERT INTO photos (md5, size, archive_path, timestamp, width, '
+            'height, latitude, longitude, camera_make, camera_model) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [('a', 100, '/a.jpg', 300, 4000, 3000, 47.5, -122.3, 'Canon',
+              'PowerShot'),
+             ('b', 200, '/b.jpg', None, None, None, None, None, None, None),
+             ('c', 300, '/c.jpg', 100, 800, 600, None, None, 'Canon',
+              'PowerShot'),
+             ('d', 400, '/d.jpg', 200, None, None, None, None, None,
+              'Pixel 3')])
+        self.rep.con.commit()
+        self.catalog_dir = catalog.default_catalog_dir(self.tmpdir)
+
+    def tearDown(self):
+        self.rep.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_export_and_load(self):
+        self.assertEqual(4, catalog.export(self.rep, self.catalog_dir))
+        cat = catalog.Catalog(self.catalog_dir)
+        self.assertEqual(4, len(cat))
+        self.assertIsInstance(cat.timestamp, np.memmap)
+        self.assertEqual([1, 2, 3, 4], cat.id.tolist())
+        self.assertEqual([300, 0, 100, 200], cat.timestamp.tolist())
+        self.assertEqual([100, 200, 300, 400], cat.size.tolist())
+        self.assertEqual([4000, -1, 800, -1], cat.width.tolist())
+        self.assertEqual(47.5, cat.latitude[0])
+        self.assertTrue(np.isnan(cat.latitude[1:]).all())
+        # Cameras are numbered in (make, model) order; no make sorts first.
+        self.assertEqual([1, -1, 1, 0], cat.camera.tolist())
+        self.assertEqual(['Canon PowerShot', '(unknown)', 'Canon PowerShot',
+                          'Pixel 3'],
+                         [cat.camera_name(code) for code in cat.camera])
+
+    def test_export_replaces_old_catalog(self):
+        catalog.export(self.rep, self.catalog_dir)
+        self.rep.con.execute('DELETE FROM photos')
+        self.assertEqual(0, catalog.export(self.rep, self.catalog_dir))
+        cat = catalog.Catalog(self.catalog_dir, mmap=False)
+        self.assertEqual(0, len(cat))
+        self.assertEqual((0, 2), cat.cameras.shape)
+        self.assertEqual(['catalog'],
+                         [name for name in os.listdir(self.tmpdir)
+                          if name.startswith('catalog')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+"""Splitting a staging tree between cooperating photoman workers.
+
+A worker claims a file by renaming it into its own directory,
+<staging>/.claims/<host>-<pid>/, under the same relative path.  A rename
+is atomic, on NFS and SMB shares too, so exactly one worker gets each
+file; the others find it gone and move on.  When a worker is done it
+moves whatever is left in its directory (files it didn't archive and
+delete) back where they came from.
+
+A worker that dies leaves its claims behind; the next worker to start
+puts them back in the staging tree.  Claims of a worker on the same host
+are recovered as soon as its process is gone, those of a worker on
+another host once its directory has gone stale_after seconds without a
+heartbeat.  A worker beats from a background thread for as long as its
+queue is open, so a file that takes long to archive, or a slow sync of
+a batch, doesn't make it look dead.
+
+Renames reset a file's ctime, which is also its arrival time for
+photoman --schedule oldest.  So a file's ctime is saved in an extended
+attribute when it is first claimed, and a file put back after a crash
+keeps its place in the queue (see arrival_time()).  On filesystems
+without user extended attributes, such as some SMB mounts, a file put
+back goes to the end of the queue.
+"""
+
+import logging
+import os
+import os.path
+import socket
+import threading
+import time
+
+import naming
+
+CLAIMS_DIR_NAME = '.claims'
+
+# Seconds without a heartbeat after which another host's claims are
+# taken back, and seconds between heartbeats.
+DEFAULT_STALE_AFTER = 3600
+_HEARTBEAT_EVERY = 60
+
+# Extended attribute holding a claimed file's original ctime.
+_ARRIVAL_XATTR = 'user.mediaman.arrival'
+
+
+def worker_name():
+    """Returns this process's name in claim directories: host-pid."""
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def arrival_time(path, stat=None):
+    """Returns when the file at path arrived in staging: its ctime, or
+    the ctime saved on its first claim if it has been claimed before.
+    stat is the file's os.stat() result, if already known."""
+    try:
+        return float(os.getxattr(path, _ARRIVAL_XATTR))
+    except (OSError, ValueError, AttributeError):
+        # No saved time, no xattr support, or no os.getxattr at all.
+        pass
+    return (stat or os.stat(path)).st_ctime
+
+
+def _save_arrival(path):
+    """Saves the ctime of path before a rename resets it, unless an
+    earlier claim already did."""
+    try:
+        os.setxattr(path, _ARRIVAL_XATTR,
+                    repr(os.stat(path).st_ctime).encode(),
+                    os.XATTR_CREATE)
+    except (OSError, AttributeError):
+        pass
+
+
+def _owner_alive(owner, claim_dir, stale_after):
+    """Returns whether the worker named owner may still be working."""
+    (host, _sep, pid) = owner.rpartition('-')
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    try:
+        return time.time() - os.stat(claim_dir).st_mtime < stale_after
+    except FileNotFoundError:
+        return True
+
+
+class ClaimQueue():
+    """Hands out the files of a staging tree to one of several workers.
+
+    Use claim() on each candidate file and close() when done; files left
+    in the worker's claim directory then go back to the staging tree,
+    under a free name if a new file has taken theirs.
+    """
+
+    def __init__(self, src_dir, name=None, stale_after=DEFAULT_STALE_AFTER):
+        self.src_dir = src_dir
+        self.claims_dir = os.path.join(src_dir, CLAIMS_DIR_NAME)
+        self.name = name or worker_name()
+        self.worker_dir = os.path.join(self.claims_dir, self.name)
+        self.stale_after = stale_after
+        self._last_heartbeat = 0
+        self._stop = threading.Event()
+        self._beater = None
+
+    def open(self):
+        """Creates this worker's claim directory, starts its heartbeat and
+        recovers the claims of dead workers.  Raises OSError if the
+        staging tree can't be written to."""
+        os.makedirs(self.worker_dir, exist_ok=True)
+        self._heartbeat()
+        self.recover_stale()
+        self._stop.clear()
+        self._beater = threading.Thread(target=self._beat,
+                                        name='claims-heartbeat', daemon=True)
+        self._beater.start()
+
+    def claim(self, path):
+        """Moves path, a file under src_dir, into this worker's claim
+        directory.  Returns its new path, or None if another worker
+        claimed it first."""
+        claimed = os.path.join(self.worker_dir,
+                               os.path.relpath(path, self.src_dir))
+        os.makedirs(os.path.dirname(claimed), exist_ok=True)
+        _save_arrival(path)
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        self._heartbeat()
+        return claimed
+
+    def close(self):
+        """Stops the heartbeat and puts back every file this worker still
+        holds."""
+        if self._beater is not None:
+            self._stop.set()
+            self._beater.join()
+            self._beater = None
+        self._release(self.worker_dir)
+
+    def recover_stale(self):
+        """Puts back the files claimed by workers that are gone.
+        Returns the number of files recovered."""
+        try:
+            names = os.listdir(self.claims_dir)
+        except FileNotFoundError:
+            return 0
+        recovered = 0
+        for name in names:
+            claim_dir = os.path.join(self.claims_dir, name)
+            # A directory being recovered is named <recoverer>+<owner>.
+            owner = name.split('+')[0]
+            if (owner == self.name or not os.path.isdir(claim_dir)
+                    or _owner_alive(owner, claim_dir, self.stale_after)):
+                continue
+            # Take over the directory first, so two workers never put back
+            # the same files.
+            taken = os.path.join(self.claims_dir,
+                                 '%s+%s' % (self.name, owner))
+            try:
+                os.rename(claim_dir, taken)
+            except OSError:
+                continue
+            logging.warning('Recovering the claims of worker %s, which is '
+                            'gone', owner)
+            recovered += self._release(taken)
+        return recovered
+
+    def _release(self, claim_dir):
+        """Moves the files under claim_dir back to the staging tree and
+        removes claim_dir.  Returns the number of files moved back.
+
+        A file whose name has been taken by a new file in the meantime
+        goes back as stem_N.ext."""
+        names = naming.NameAllocator()
+        released = 0
+        for (dirpath, _dirnames, filenames) in os.walk(claim_dir,
+                                                       topdown=False):
+            for filename in filenames:
+                claimed = os.path.join(dirpath, filename)
+                original = os.path.join(
+                    self.src_dir, os.path.relpath(claimed, claim_dir))
+                os.makedirs(os.path.dirname(original), exist_ok=True)
+                # Reserve the name, so that the rename never replaces a
+                # file that appeared while this one was claimed.
+                (fd, dest) = names.create(os.path.dirname(original),
+                                          filename)
+                os.close(fd)
+                os.rename(claimed, dest)
+                if dest != original:
+                    logging.warning('%s reappeared while it was claimed; '
+                                    'putting the claimed file back as %s',
+                                    original, dest)
+                released += 1
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+        return released
+
+    def _heartbeat(self):
+        now = time.time()
+        if now - self._last_heartbeat >= _HEARTBEAT_EVERY:
+            os.utime(self.worker_dir)
+            self._last_heartbeat = now
+
+    def _beat(self):
+        """Heartbeat thread: touches the claim directory until close()."""
+        while not self._stop.wait(_HEARTBEAT_EVERY):
+            try:
+                self._heartbeat()
+            except OSError as e:
+                logging.warning('Could not touch %s: %s', self.worker_dir, e)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import claims
+
+
+class ClaimQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.src = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.src, 'sub'))
+        for name in ('a.jpg', os.path.join('sub', 'b.jpg')):
+            with open(os.path.join(self.src, name), 'w') as fh:
+                fh.write(name)
+        self.claims_dir = os.path.join(self.src, claims.CLAIMS_DIR_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.src)
+
+    def _claim_dir(self, owner, *names):
+        """Fakes the claims of another worker."""
+        claim_dir = os.path.join(self.claims_dir, owner)
+        for name in names:
+            os.makedirs(os.path.dirname(os.path.join(claim_dir, name)),
+                        exist_ok=True)
+            os.rename(os.path.join(self.src, name),
+                      os.path.join(claim_dir, name))
+        return claim_dir
+
+    def test_claim_once_and_release(self):
+        first = claims.ClaimQueue(self.src, name='host-1')
+        first.open()
+        second = claims.ClaimQueue(self.src, name='host-2')
+        second.open()
+        path = os.path.join(self.src, 'sub', 'b.jpg')
+        claimed = first.claim(path)
+        self.assertEqual(
+            os.path.join(self.claims_dir, 'host-1', 'sub', 'b.jpg'), claimed)
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(second.claim(path))
+        first.close()
+        second.close()
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual([], os.listdir(self.claims_dir))
+
+    def test_release_keeps_a_file_that_reappeared(self):
+        queue = claims.ClaimQueue(self.src, name='host-1')
+        queue.open()
+        path = os.path.join(self.src, 'a.jpg')
+        claimed = queue.claim(path)
+        with open(path, 'w') as fh:
+            fh.write('new')
+        queue.close()
+        with open(path) as fh:
+            self.assertEqual('new', fh.read())
+        self.assertFalse(os.path.exists(claimed))
+        with open(os.path.join(self.src, 'a_1.jpg')) as fh:
+            self.assertEqual('a.jpg', fh.read())
+        self.assertEqual([], os.listdir(self.claims_dir))
+
+    def test_heartbeat_while_open(self):
+        """A worker beats without claiming, e.g. while archiving a large
+        file, until it is closed."""
+        with patch.object(claims, '_HEARTBEAT_EVERY', 0.01):
+            queue = claims.ClaimQueue(self.src, name='host-1')
+            queue.open()
+            os.utime(queue.worker_dir, (0, 0))
+            deadline = time.time() + 5
+            while (os.stat(queue.worker_dir).st_mtime == 0
+                   and time.time() < deadline):
+                time.sleep(0.01)
+            self.assertNotEqual(0, os.stat(queue.worker_dir).st_mtime)
+            queue.close()
+            self.assertFalse(queue._beater)
+
+    def test_recovers_dead_local_worker(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        owner = '%s-%d' % (socket.gethostname(), process.pid)
+        self._claim_dir(owner, os.path.join('sub', 'b.jpg'))
+        # This process is alive, so its claims stay.
+        self._claim_dir(claims.worker_name(), 'a.jpg')
+        queue = claims.ClaimQueue(self.src, name='host-1')
+        queue.open()
+        self.assertTrue(os.path.isfile(os.path.join(self.src, 'sub',
+                                                    'b.jpg')))
+        self.assertFalse(os.path.exists(os.path.join(self.src, 'a.jpg')))
+        self.assertEqual(sorted([claims.worker_name(), 'host-1']),
+                         sorted(os.listdir(self.claims_dir)))
+
+    def test_recovers_other_host_only_when_stale(self):
+        claim_dir = self._claim_dir('otherhost-12', 'a.jpg')
+        queue = claims.ClaimQueue(self.src, name='host-1', stale_after=600)
+        queue.open()
+        self.assertEqual(0, queue.recover_stale())
+        os.utime(claim_dir, (0, 0))
+        self.assertEqual(1, queue.recover_stale())
+        self.assertTrue(os.path.isfile(os.path.join(self.src, 'a.jpg')))
+        self.assertFalse(os.path.exists(claim_dir))
+
+    def test_recovered_file_keeps_its_arrival_time(self):
+        path = os.path.join(self.src, 'a.jpg')
+        try:
+            os.setxattr(path, 'user.test', b'1')
+        except (OSError, AttributeError):
+            self.skipTest('no user extended attributes here')
+        arrived = os.stat(path).st_ctime
+        self.assertEqual(arrived, claims.arrival_time(path))
+        time.sleep(0.05)
+        crashed = claims.ClaimQueue(self.src, name='otherhost-12')
+        crashed.claim(path)
+        os.utime(crashed.worker_dir, (0, 0))
+        queue = claims.ClaimQueue(self.src, name='host-1', stale_after=600)
+        queue.open()
+        queue.close()
+        self.assertTrue(os.path.isfile(path))
+        self.assertGreater(os.stat(path).st_ctime, arrived)
+        self.assertEqual(arrived, claims.arrival_time(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""MD5 of an image's content, ignoring its metadata.
+
+Re-tagging a photo (Google rewriting EXIF in a Takeout export, a desktop
+tool editing keywords, fix_gnexus_exif dropping a tag) changes its file
+MD5 but not its image data.  The content digest covers only what
+determines the pixels, read straight from the file without decoding:
+
+- JPEG: every marker segment except APPn (EXIF, XMP, JFIF, ...) and
+  COM, then everything from the start of the scan data on.
+- PNG: the signature and the critical chunks (IHDR, PLTE, IDAT, IEND);
+  ancillary chunks such as tEXt, iTXt, eXIf and tIME are skipped.
+
+Other formats have no content digest.
+"""
+
+import hashlib
+
+_JPEG_SOI = b'\xff\xd8'
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+_SOS = 0xDA
+_EOI = 0xD9
+_COM = 0xFE
+# Markers without a length field.
+_STANDALONE_MARKERS = frozenset({0x01, 0xD8, _EOI} | set(range(0xD0, 0xD8)))
+
+_CHUNK_SIZE = 8192
+
+
+class ContentHasher():
+    """Computes the content digest of a file fed to it in pieces.
+
+    Meant to run alongside the full-file MD5, on the same chunks, so the
+    file is read once.  Metadata is skipped by tracking the segment or
+    chunk boundaries as the bytes go by.
+    """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._buffer = b''
+        self._parse = self._parse_signature
+        # Bytes of the current segment/chunk still to pass through, and
+        # whether they are hashed.
+        self._remaining = 0
+        self._hashing = False
+        # Set once a JPEG reaches its scan data: hash everything after.
+        self._scan_next = self._in_scan = False
+        self._valid = True
+
+    def update(self, data):
+        """Feeds the next piece of the file."""
+        if not self._valid:
+            return
+        if self._in_scan:
+            self._md5.update(data)
+            return
+        self._buffer += data
+        while self._valid and not self._in_scan:
+            if self._remaining:
+                self._pass_through()
+                if self._remaining:
+                    return
+                self._in_scan = self._scan_next
+                continue
+            if not self._parse():
+                return
+        if self._in_scan and self._buffer:
+            self._md5.update(self._buffer)
+            self._buffer = b''
+
+    def hexdigest(self):
+        """Returns the content digest, or None if the file wasn't a JPEG
+        or PNG or was cut short."""
+        if (not self._valid or self._remaining or self._buffer
+                or self._parse == self._parse_signature):
+            return None
+        return self._md5.hexdigest()
+
+    def _pass_through(self):
+        count = min(self._remaining, len(self._buffer))
+        if self._hashing:
+            self._md5.update(self._buffer[:count])
+        self._buffer = self._buffer[count:]
+        self._remaining -= count
+
+    def _start(self, count, hashing):
+        self._remaining = count
+        self._hashing = hashing
+
+    def _parse_signature(self):
+        if len(self._buffer) < len(_PNG_SIGNATURE):
+            return False
+        if self._buffer.startswith(_JPEG_SOI):
+            self._parse = self._parse_jpeg_marker
+            self._start(len(_JPEG_SOI), True)
+        elif self._buffer.startswith(_PNG_SIGNATURE):
+            self._parse = self._parse_png_chunk
+            self._start(len(_PNG_SIGNATURE), True)
+        else:
+            self._valid = False
+        return True
+
+    def _parse_jpeg_marker(self):
+        """Handles the marker at the start of the buffer.  Returns False
+        if more bytes are needed."""
+        if len(self._buffer) < 2:
+            return False
+        if self._buffer[0] != 0xFF:
+            self._valid = False
+            return True
+        marker = self._buffer[1]
+        if marker == 0xFF:
+            # Fill byte in front of a marker.
+            self._start(1, False)
+            return True
+        if marker in _STANDALONE_MARKERS:
+            if marker == _EOI:
+                # No scan data at all.
+                self._valid = False
+            self._start(2, True)
+            return True
+        if len(self._buffer) < 4:
+            return False
+        length = int.from_bytes(self._buffer[2:4], 'big')
+        if length < 2:
+            self._valid = False
+            return True
+        metadata = 0xE0 <= marker <= 0xEF or marker == _COM
+        self._start(2 + length, not metadata)
+        self._scan_next = marker == _SOS
+        return True
+
+    def _parse_png_chunk(self):
+        """Handles the chunk header at the start of the buffer.  Returns
+        False if more bytes are needed."""
+        if len(self._buffer) < 8:
+            return False
+        length = int.from_bytes(self._buffer[0:4], 'big')
+        # Ancillary chunk types start with a lower-case letter.
+        critical = not self._buffer[4] & 0x20
+        # Length, type, data and CRC.
+        self._start(12 + length, critical)
+        return True
+
+
+def file_content_md5(filepath):
+    """Returns the content digest of a file, or None if it has none."""
+    hasher = ContentHasher()
+    with open(filepath, 'rb') as fh:
+        while True:
+            chunk = fh.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, PngImagePlugin
+
+import content_hash
+import jpeg_segments
+import media_common
+
+
+class ContentHashTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        self.gnexus = os.path.join(scriptdir, 'test', 'gnexus 160.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_jpeg_metadata_is_ignored(self):
+        stripped = self._path('stripped.jpg')
+        jpeg_segments.copy_without_exif_tag(
+            self.gnexus, stripped, jpeg_segments.ISO_SPEED_RATINGS)
+        with open(self.gnexus, 'rb') as fh:
+            data = fh.read()
+        # A comment and an XMP-like APP1 segment added after SOI.
+        commented = self._path('commented.jpg')
+        with open(commented, 'wb') as fh:
+            fh.write(data[:2] + b'\xff\xfe\x00\x07hello'
+                     + b'\xff\xe1\x00\x06xmp!' + data[2:])
+        digest = content_hash.file_content_md5(self.gnexus)
+        self.assertIsNotNone(digest)
+        for path in (stripped, commented):
+            self.assertNotEqual(media_common.compute_md5(self.gnexus),
+                                media_common.compute_md5(path))
+            self.assertEqual(digest, content_hash.file_content_md5(path))
+
+    def test_jpeg_image_change_is_detected(self):
+        with open(self.gnexus, 'rb') as fh:
+            data = bytearray(fh.read())
+        data[-100] ^= 0xFF
+        changed = self._path('changed.jpg')
+        with open(changed, 'wb') as fh:
+            fh.write(data)
+        self.assertNotEqual(content_hash.file_content_md5(self.gnexus),
+                            content_hash.file_content_md5(changed))
+
+    def test_any_chunking_gives_the_same_digest(self):
+        with open(self.gnexus, 'rb') as fh:
+            data = fh.read()
+        digest = content_hash.file_content_md5(self.gnexus)
+        for size in (1, 5, 4096):
+            hasher = content_hash.ContentHasher()
+            for offset in range(0, len(data), size):
+                hasher.update(data[offset:offset + size])
+            self.assertEqual(digest, hasher.hexdigest())
+
+    def test_png_ancillary_chunks_are_ignored(self):
+        image = Image.new('RGB', (16, 16), 'teal')
+        plain = self._path('plain.png')
+        tagged = self._path('tagged.png')
+        image.save(plain)
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Description', 'Beach, 2019')
+        image.save(tagged, pnginfo=info)
+        self.assertNotEqual(media_common.compute_md5(plain),
+                            media_common.compute_md5(tagged))
+        self.assertEqual(content_hash.file_content_md5(plain),
+                         content_hash.file_content_md5(tagged))
+        Image.new('RGB', (16, 16), 'olive').save(tagged)
+        self.assertNotEqual(content_hash.file_content_md5(plain),
+                            content_hash.file_content_md5(tagged))
+
+    def test_other_files_have_no_digest(self):
+        for (name, data) in (('clip.mp4', b'\x00\x00\x00\x18ftypmp42'),
+                             ('empty.jpg', b''),
+                             ('truncated.jpg', b'\xff\xd8\xff\xe1\x10\x00'),
+                             ('no_scan.jpg', b'\xff\xd8\xff\xfe\x00\x02'
+                                             b'\xff\xd9')):
+            with open(self._path(name), 'wb') as fh:
+                fh.write(data)
+            self.assertIsNone(content_hash.file_content_md5(self._path(name)),
+                              name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,66 +5,128 @@ The Galaxy Nexus phone's default camera app puts an array of values
 into the ISO EXIF Tag, and some applications can't handle that. This
 script creates copies in the same directory with the name
     <basename>_isoremoved<extension>
+
+With --media_dir (the nightly mode) candidates come from media.db: photos
+whose camera_model is the Galaxy Nexus, plus photos added since the last
+run.  Every photo examined is recorded in a ledger so it is never read
+again.  --search_dir walks a directory tree instead.
 """
 
 import argparse
 import logging
 import os
 import os.path
-import shutil
 import sys
 
-import piexif
+import jpeg_segments
+import media_common
+
+_JOB_NAME = 'fix_gnexus_exif'
+
+_CAMERA_MODEL = 'Galaxy Nexus'
+
+_JPEG_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
 
 
-def _create_parsable_gnexus_copies(search_dir):
+def _create_parsable_gnexus_copies(search_dir, workers=4):
     """Walk a directory tree, finding photos that have arrays for ISO EXIF
     data, and make ISO-free copies.
 
     Useful for the PS3 Media Server, which currently cannot parse (and
     therefore serve) files with array ISO EXIF data.
     """
-    total = 0
-    fixed = 0
-    errors = 0
-    skipped = 0
-    non_photo = 0
-    for (dirpath, _dirnames, filenames) in os.walk(search_dir):
-        total += len(filenames)
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            array_iso, is_photo = _is_array_iso(filepath)
-            if not is_photo:
-                non_photo += 1
-                continue
-            if not array_iso:
-                continue
-
-            prefix, suffix = os.path.splitext(filepath)
-            sanitized_filepath = os.path.join(
-                dirpath, '%s_isoremoved%s' % (prefix, suffix))
-            if os.path.exists(sanitized_filepath):
-                skipped += 1
-                continue
-
-            logging.info('Sanitizing %s to %s.', filepath,
-                         sanitized_filepath)
-            shutil.copy2(filepath, sanitized_filepath)
-            try:
-                exif_dict = piexif.load(sanitized_filepath)
-                if 'Exif' in exif_dict and piexif.ExifIFD.ISOSpeedRatings in exif_dict['Exif']:
-                    del exif_dict['Exif'][piexif.ExifIFD.ISOSpeedRatings]
-                    exif_bytes = piexif.dump(exif_dict)
-                    piexif.insert(exif_bytes, sanitized_filepath)
-                fixed += 1
-            except Exception:
-                logging.warning('Could not strip ISO from %s',
-                                sanitized_filepath)
-                errors += 1
-
-    logging.info('fix_gnexus_exif complete: scanned=%d fixed=%d '
-                 'skipped=%d non_photo=%d errors=%d',
-                 total, fixed, skipped, non_photo, errors)
+    job = media_common.BatchJob(_JOB_NAME, _sanitize, workers=workers)
+    job.run(media_common.walk_files(search_dir))
+
+
+def _fix_library(lib_base_dir, workers=4):
+    """Make ISO-free copies of the library's Galaxy Nexus photos.
+
+    Candidates are selected from the repository rather than by walking
+    the archive: every photo whose camera_model is the Galaxy Nexus, and
+    every photo added since the previous run (its camera_model may not
+    have been parsed).  Photos recorded in the job ledger are skipped, so
+    each file is examined at most once; failures are left out of the
+    ledger and the high-water mark stops below the first of them, so they
+    are retried on the next run.
+    """
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        ledger = rep.ledger(_JOB_NAME)
+        last_id = int(ledger.get_state('last_photo_id', 0))
+        rows = rep.con.execute(
+            'SELECT id, archive_path, camera_model FROM photos '
+            'WHERE camera_model LIKE :model OR id > :last_id ORDER BY id',
+            {'model': '%' + _CAMERA_MODEL + '%', 'last_id': last_id}
+        ).fetchall()
+        job = media_common.BatchJob(_JOB_NAME, _check_photo, ledger=ledger,
+                                    key=lambda row: str(row[0]),
+                                    workers=workers)
+        failed_ids = []
+
+        def on_result(row, status, _value):
+            if status == 'error':
+                failed_ids.append(row[0])
+
+        job.run(rows, on_result=on_result)
+        if rows:
+            high = rows[-1][0]
+            if failed_ids:
+                high = min(high, min(failed_ids) - 1)
+            ledger.set_state('last_photo_id', max(last_id, high))
+        ledger.commit()
+    finally:
+        rep.close()
+
+
+def _check_photo(row):
+    """Sanitizes the photo of an (id, archive_path, camera_model) row."""
+    (_db_id, filepath, camera_model) = row
+    if not _is_candidate(filepath, camera_model):
+        return 'not_candidate'
+    return _sanitize(filepath)
+
+
+def _is_candidate(filepath, camera_model):
+    """Returns True if the photo could be a Galaxy Nexus JPEG."""
+    if os.path.splitext(filepath)[1].lower() not in _JPEG_EXTENSIONS:
+        return False
+    # Case-insensitive, like the LIKE that selects candidates.
+    return (camera_model is None
+            or _CAMERA_MODEL.lower() in camera_model.lower())
+
+
+def _sanitize(filepath):
+    """Makes an ISO-free copy of filepath if it has an array ISO tag.
+
+    Returns one of 'fixed', 'skipped' (copy already exists), 'ok' (no
+    array ISO), 'non_photo' or 'error'.
+    """
+    try:
+        array_iso, is_photo = _is_array_iso(filepath)
+    except OSError as e:
+        logging.warning('Could not read %s: %s', filepath, e)
+        return 'error'
+    if not is_photo:
+        return 'non_photo'
+    if not array_iso:
+        return 'ok'
+
+    prefix, suffix = os.path.splitext(filepath)
+    sanitized_filepath = '%s_isoremoved%s' % (prefix, suffix)
+    if os.path.exists(sanitized_filepath):
+        return 'skipped'
+
+    logging.info('Sanitizing %s to %s.', filepath, sanitized_filepath)
+    try:
+        jpeg_segments.copy_without_exif_tag(
+            filepath, sanitized_filepath, jpeg_segments.ISO_SPEED_RATINGS)
+        return 'fixed'
+    except Exception:
+        logging.warning('Could not strip ISO from %s',
+                        sanitized_filepath)
+        return 'error'
 
 
 def _is_array_iso(filepath):
@@ -72,14 +134,21 @@ def _is_array_iso(filepath):
 
     is_array_iso — True if the file has a multi-valued ISO EXIF tag.
     is_photo     — False if the file could not be parsed as an EXIF image
-                   at all (e.g. non-JPEG, corrupt, permissions error).
+                   at all (e.g. non-JPEG, corrupt).
+
+    Raises OSError if the file could not be read, so that the caller can
+    retry it rather than record it as a non-photo.
     """
     try:
-        exif_dict = piexif.load(filepath)
-        iso = exif_dict.get('Exif', {}).get(piexif.ExifIFD.ISOSpeedRatings)
-        if iso is not None and not isinstance(iso, int):
-            return (True, True)
-        return (False, True)
+        with open(filepath, 'rb') as fh:
+            _segment, tiff = jpeg_segments.find_exif_segment(fh)
+        if tiff is None:
+            return (False, True)
+        iso = jpeg_segments.find_exif_tag(
+            tiff, jpeg_segments.ISO_SPEED_RATINGS)
+        return (iso is not None and iso.count > 1, True)
+    except OSError:
+        raise
     except Exception:
         logging.debug('Skipping non-photo or unparseable file: %s', filepath)
         return (False, False)
@@ -93,13 +162,22 @@ def _configure_logging():
 def main():
     parser = argparse.ArgumentParser(
         description='Sanitize Galaxy Nexus ISO EXIF data.')
-    parser.add_argument('--search_dir', required=True,
-                        help='Directory to scan for photos')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--media_dir',
+                        help='Media library whose database selects the '
+                             'photos to check (incremental)')
+    source.add_argument('--search_dir',
+                        help='Directory to scan for photos (full walk)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Photos checked in parallel (default: 4)')
     args = parser.parse_args()
 
     try:
         _configure_logging()
-        _create_parsable_gnexus_copies(args.search_dir)
+        if args.media_dir:
+            _fix_library(args.media_dir, args.workers)
+        else:
+            _create_parsable_gnexus_copies(args.search_dir, args.workers)
     except Exception:
         logging.exception('An unexpected error occurred while fixing'
                           ' Galaxy Nexus photos')
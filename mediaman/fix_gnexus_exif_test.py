@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import glob
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from unittest.mock import *
+
+from PIL import Image
+
+import fix_gnexus_exif
+import media_common
+import photoman
+
+
+class FixGnexusExifTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        self.mediadir = os.path.join(self.tmpdir, 'media')
+        os.mkdir(self.srcdir)
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        for test_file in glob.glob(os.path.join(scriptdir, 'test', '*')):
+            shutil.copy(test_file, self.srcdir)
+        self.gnexus = os.path.join(self.mediadir,
+                                   'photos/2012/07_July/gnexus 160.jpg')
+        self.sanitized = os.path.join(
+            self.mediadir, 'photos/2012/07_July/gnexus 160_isoremoved.jpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def _archive(self):
+        photoman._find_and_archive_photos(self.srcdir, self.mediadir,
+                                          True, 'foo')
+
+    def test_fix_library_creates_sanitized_copy(self):
+        self._archive()
+        fix_gnexus_exif._fix_library(self.mediadir)
+        self.assertTrue(os.path.isfile(self.sanitized))
+        with Image.open(self.sanitized) as img:
+            exif = img.getexif().get_ifd(0x8769)
+        self.assertNotIn(0x8827, exif)
+        self.assertEqual((False, True),
+                         fix_gnexus_exif._is_array_iso(self.sanitized))
+
+    def test_fix_library_only_reads_candidates(self):
+        """Photos from other cameras are never opened."""
+        self._archive()
+        with patch.object(fix_gnexus_exif, '_sanitize',
+                          return_value='fixed') as sanitize:
+            fix_gnexus_exif._fix_library(self.mediadir)
+        sanitize.assert_called_once_with(self.gnexus)
+
+    def test_fix_library_examines_each_photo_once(self):
+        self._archive()
+        fix_gnexus_exif._fix_library(self.mediadir)
+        with patch.object(fix_gnexus_exif, '_sanitize') as sanitize:
+            fix_gnexus_exif._fix_library(self.mediadir)
+        sanitize.assert_not_called()
+
+        # Photos added later are picked up by the next run.
+        os.remove(self.sanitized)
+        rep = media_common.Repository()
+        rep.open(self.mediadir)
+        rep.con.execute("INSERT INTO photos (md5, size, archive_path) "
+                        "VALUES ('new', 1, ?)", [self.gnexus])
+        rep.close()
+        fix_gnexus_exif._fix_library(self.mediadir)
+        self.assertTrue(os.path.isfile(self.sanitized))
+
+    def test_fix_library_retries_errors(self):
+        self._archive()
+        with patch.object(fix_gnexus_exif, '_sanitize',
+                          return_value='error'):
+            fix_gnexus_exif._fix_library(self.mediadir)
+        fix_gnexus_exif._fix_library(self.mediadir)
+        self.assertTrue(os.path.isfile(self.sanitized))
+
+    def test_fix_library_retries_errors_of_unknown_camera(self):
+        """A failed photo without a camera_model is not skipped by the
+        high-water mark."""
+        self._archive()
+        rep = media_common.Repository()
+        rep.open(self.mediadir)
+        rep.con.execute('UPDATE photos SET camera_model = NULL')
+        rep.close()
+
+        def sanitize(filepath):
+            return 'error' if filepath == self.gnexus else 'ok'
+
+        with patch.object(fix_gnexus_exif, '_sanitize',
+                          side_effect=sanitize):
+            fix_gnexus_exif._fix_library(self.mediadir)
+        fix_gnexus_exif._fix_library(self.mediadir)
+        self.assertTrue(os.path.isfile(self.sanitized))
+
+    def test_read_errors_are_retried(self):
+        self._archive()
+        with patch('builtins.open', side_effect=PermissionError('denied')):
+            self.assertEqual('error', fix_gnexus_exif._sanitize(self.gnexus))
+        fix_gnexus_exif._fix_library(self.mediadir)
+        self.assertTrue(os.path.isfile(self.sanitized))
+
+    def test_is_candidate_ignores_case(self):
+        self.assertTrue(fix_gnexus_exif._is_candidate('a.JPG',
+                                                      'GALAXY NEXUS'))
+        self.assertTrue(fix_gnexus_exif._is_candidate('a.jpg', None))
+        self.assertFalse(fix_gnexus_exif._is_candidate('a.jpg', 'Pixel 7'))
+        self.assertFalse(fix_gnexus_exif._is_candidate('a.mp4', None))
+
+    def test_walk_mode(self):
+        fix_gnexus_exif._create_parsable_gnexus_copies(self.srcdir)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.srcdir, 'gnexus 160_isoremoved.jpg')))
+        self.assertEqual(6, len(os.listdir(self.srcdir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,11 @@ For the integrated Windows client with staging-copy support, use::
     photocoll fix-takeout --src_dir ... --staging_dir ...
 
 This script is a thin wrapper that can be used directly on the server.
+To archive an export that is already on the server, prefer::
+
+    photoman.py --takeout_dir ... --media_dir ...
+
+which reads the sidecars directly and never modifies the export.
 """
 import argparse
 import logging
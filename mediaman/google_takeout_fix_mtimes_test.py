@@ -5,6 +5,7 @@ import os
 import tempfile
 import time
 import unittest
+from collections import Counter
 from pathlib import Path
 from unittest.mock import patch
 
@@ -75,6 +76,24 @@ class FixMtimesTests(unittest.TestCase):
         self.assertEqual(fixed, 0)
         self.assertEqual(skipped, 1)
 
+    def test_read_sidecar_skips_malformed_fields(self):
+        """A geoData or description of the wrong type is ignored, not
+        fatal to the ingest."""
+        p = self.src_dir / 'photo.jpg.json'
+        p.write_text(json.dumps({
+            'photoTakenTime': {'timestamp': '1400000000'},
+            'description': ['not', 'text'],
+            'geoData': [1],
+            'geoDataExif': {'latitude': 40.5, 'longitude': -74.25},
+        }))
+        self.assertEqual({'timestamp': 1400000000, 'description': None,
+                          'latitude': 40.5, 'longitude': -74.25},
+                         fixer.read_sidecar(str(p)))
+        p.write_text(json.dumps({'geoData': 'here', 'geoDataExif': 7}))
+        sidecar = fixer.read_sidecar(str(p))
+        self.assertEqual((None, None),
+                         (sidecar['latitude'], sidecar['longitude']))
+
     def test_deletes_json_when_requested(self):
         """--delete_json removes the sidecar after fixing."""
         ts = int(time.mktime(time.strptime('2020-06-15', '%Y-%m-%d')))
@@ -121,6 +140,42 @@ class FixMtimesTests(unittest.TestCase):
         self.assertEqual(ok, 0)
         self.assertEqual(skipped, 0)
 
+    def test_iter_fixed_media_streams_all_media(self):
+        """iter_fixed_media yields paired and unpaired media, not sidecars."""
+        ts = int(time.mktime(time.strptime('2018-03-01', '%Y-%m-%d')))
+        self._write_json('a/vid.mp4.json', ts)
+        vid = self._write_file('a/vid.mp4', b'fake mp4')
+        self._write_file('a/photo.jpg')
+        self._write_file('b/notes.txt')
+        self._write_json('b/metadata.json', ts)
+
+        stats = Counter()
+        results = list(fixer.iter_fixed_media(str(self.src_dir),
+                                              workers=2, stats=stats))
+        self.assertEqual(sorted(os.path.basename(p) for p in results),
+                         ['photo.jpg', 'vid.mp4'])
+        self.assertEqual(int(os.path.getmtime(str(vid))), ts)
+        self.assertEqual(stats['fixed'], 1)
+        self.assertEqual(stats['skipped'], 1)
+
+    def test_iter_fixed_media_is_lazy(self):
+        """The first file is available before the whole tree is scanned."""
+        for i in range(20):
+            self._write_file(f'dir{i:02d}/img.jpg')
+        listed = []
+        real_walk = os.walk
+
+        def counting_walk(top):
+            for entry in real_walk(top):
+                listed.append(entry[0])
+                yield entry
+
+        with patch('os.walk', counting_walk):
+            it = fixer.iter_fixed_media(str(self.src_dir), workers=1)
+            next(it)
+            it.close()
+        self.assertLess(len(listed), 21)
+
     def test_iter_media_files_filters_json(self):
         """iter_media_files returns media files, not JSON sidecars."""
         self._write_file('photo.jpg')
@@ -145,5 +200,101 @@ class FixMtimesTests(unittest.TestCase):
         self.assertEqual(len(results), 2)
 
 
+def _google_sidecar(media_name: str, suffix: str = '.supplemental-metadata',
+                    counter: int = 0) -> str:
+    """Build a sidecar name the way Google Takeout does."""
+    body = (media_name + suffix)[:46]
+    if counter:
+        body += '(%d)' % counter
+    return body + '.json'
+
+
+class SidecarIndexTests(unittest.TestCase):
+
+    def _match(self, filenames):
+        return fixer.SidecarIndex(filenames).groups()
+
+    def test_plain_sidecar(self):
+        groups, media, sidecars = self._match(['a.jpg', 'a.jpg.json'])
+        self.assertEqual(groups, {'a.jpg.json': ['a.jpg']})
+        self.assertEqual((media, sidecars), ([], []))
+
+    def test_supplemental_metadata(self):
+        groups, _, _ = self._match([
+            'IMG_0001.JPG', 'IMG_0001.JPG.supplemental-metadata.json'])
+        self.assertEqual(groups, {
+            'IMG_0001.JPG.supplemental-metadata.json': ['IMG_0001.JPG']})
+
+    def test_truncated_supplemental_suffix(self):
+        name = 'Screenshot_20200101-101010_Chrome.jpg'
+        json_name = _google_sidecar(name)
+        self.assertTrue(json_name.endswith('.suppleme.json'))
+        groups, media, _ = self._match([name, json_name])
+        self.assertEqual(groups, {json_name: [name]})
+        self.assertEqual(media, [])
+
+    def test_truncated_long_media_name(self):
+        name = 'PXL_20230704_201512345.NIGHT.PORTRAIT-01.COVER.jpg'
+        for suffix in ('', '.supplemental-metadata'):
+            json_name = _google_sidecar(name, suffix)
+            groups, media, sidecars = self._match([name, json_name])
+            self.assertEqual(groups, {json_name: [name]}, json_name)
+
+    def test_duplicate_counter_after_extension(self):
+        names = ['IMG.jpg', 'IMG(1).jpg', 'IMG.jpg.json', 'IMG.jpg(1).json',
+                 'IMG(2).jpg', _google_sidecar('IMG.jpg', counter=2)]
+        groups, media, sidecars = self._match(names)
+        self.assertEqual(groups['IMG.jpg.json'], ['IMG.jpg'])
+        self.assertEqual(groups['IMG.jpg(1).json'], ['IMG(1).jpg'])
+        self.assertEqual(groups['IMG.jpg.supplemental-metadata(2).json'],
+                         ['IMG(2).jpg'])
+        self.assertEqual((media, sidecars), ([], []))
+
+    def test_edited_and_live_photo_share_sidecar(self):
+        groups, media, _ = self._match([
+            'IMG_1.HEIC', 'IMG_1.MP4', 'IMG_1-edited.HEIC', 'IMG_1.HEIC.json'])
+        self.assertEqual(sorted(groups['IMG_1.HEIC.json']),
+                         ['IMG_1-edited.HEIC', 'IMG_1.HEIC', 'IMG_1.MP4'])
+        self.assertEqual(media, [])
+
+    def test_reports_unmatched_on_both_sides(self):
+        groups, media, sidecars = self._match([
+            'lonely.png', 'metadata.json', 'print-subscriptions.json'])
+        self.assertEqual(groups, {})
+        self.assertEqual(media, ['lonely.png'])
+        self.assertEqual(sorted(sidecars),
+                         ['metadata.json', 'print-subscriptions.json'])
+
+
+class FixMtimesNamingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src_dir = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_fixes_google_named_sidecars(self):
+        ts = int(time.mktime(time.strptime('2016-02-29', '%Y-%m-%d')))
+        media = ['VID(1).mp4', 'clip.mp4',
+                 'PXL_20230704_201512345.NIGHT.PORTRAIT-01.COVER.mp4']
+        sidecars = ['VID.mp4(1).json', _google_sidecar('clip.mp4'),
+                    _google_sidecar(media[2])]
+        for name in media:
+            (self.src_dir / name).write_bytes(b'video')
+        for name in sidecars:
+            (self.src_dir / name).write_text(json.dumps({
+                'photoTakenTime': {'timestamp': str(ts)},
+            }))
+
+        fixed, ok, skipped = fixer.fix_mtimes(str(self.src_dir),
+                                              delete_json=True)
+        self.assertEqual((fixed, ok, skipped), (3, 0, 0))
+        for name in media:
+            self.assertEqual(int(os.path.getmtime(self.src_dir / name)), ts)
+        self.assertEqual(sorted(os.listdir(self.src_dir)), sorted(media))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,263 @@
+"""Minimal JPEG marker-segment and EXIF IFD handling.
+
+Only the marker segments in front of the image data are parsed; the
+entropy-coded scan data is never decoded, just copied through.  This is
+enough to inspect or patch individual EXIF tags without rewriting the
+rest of the file.
+"""
+import errno
+import fcntl
+import os
+import shutil
+import struct
+
+SOI = 0xD8
+SOS = 0xDA
+EOI = 0xD9
+APP1 = 0xE1
+
+# Markers that stand alone, without a length field.
+_STANDALONE_MARKERS = frozenset({0x01, SOI, EOI} | set(range(0xD0, 0xD8)))
+
+_EXIF_HEADER = b'Exif\x00\x00'
+
+# IFD0 tag holding the offset of the Exif sub-IFD.
+EXIF_IFD_POINTER = 0x8769
+
+ISO_SPEED_RATINGS = 0x8827
+
+# ioctl that clones a file's extents on btrfs/xfs (linux/fs.h).
+_FICLONE = 0x40049409
+
+_COPY_CHUNK = 1 << 20
+
+
+class Segment():
+    """A JPEG marker segment.
+
+    offset is the position of the 0xFF marker byte in the file and length
+    the value of the segment's length field (which counts itself but not
+    the marker), so the segment spans offset .. offset + 2 + length.
+    """
+
+    def __init__(self, marker, offset, length):
+        self.marker = marker
+        self.offset = offset
+        self.length = length
+
+    @property
+    def payload_offset(self):
+        return self.offset + 4
+
+    @property
+    def end(self):
+        return self.offset + 2 + self.length
+
+
+class IfdEntry():
+    """One 12-byte TIFF IFD entry; offset is relative to the TIFF header."""
+
+    def __init__(self, tag, type_id, count, value, offset):
+        self.tag = tag
+        self.type_id = type_id
+        self.count = count
+        self.value = value
+        self.offset = offset
+
+
+def read_header_segments(fh):
+    """Reads the marker segments in front of the scan data of a JPEG.
+
+    fh must be positioned at the start of the file.  Returns a list of
+    Segment, ending with the SOS segment (if any), and leaves fh after the
+    last segment read.  Raises ValueError if the file isn't a JPEG.
+    """
+    if fh.read(2) != b'\xff\xd8':
+        raise ValueError('not a JPEG file')
+    segments = []
+    offset = 2
+    while True:
+        prefix = fh.read(2)
+        if len(prefix) < 2 or prefix[0] != 0xFF:
+            raise ValueError('bad JPEG marker at offset %d' % offset)
+        marker = prefix[1]
+        # Runs of 0xFF are fill bytes in front of a marker.
+        while marker == 0xFF:
+            offset += 1
+            byte = fh.read(1)
+            if not byte:
+                raise ValueError('truncated JPEG')
+            marker = byte[0]
+        if marker in _STANDALONE_MARKERS:
+            if marker == EOI:
+                return segments
+            offset += 2
+            continue
+        length_bytes = fh.read(2)
+        if len(length_bytes) < 2:
+            raise ValueError('truncated JPEG')
+        length = struct.unpack('>H', length_bytes)[0]
+        if length < 2:
+            raise ValueError('bad segment length at offset %d' % offset)
+        segment = Segment(marker, offset, length)
+        segments.append(segment)
+        if marker == SOS:
+            return segments
+        fh.seek(segment.end)
+        offset = segment.end
+
+
+def find_exif_segment(fh):
+    """Returns (segment, tiff_bytes) for the EXIF APP1 segment of a JPEG.
+
+    Returns (None, None) if the JPEG has no EXIF block.  fh must be
+    positioned at the start of the file; it is left at an unspecified
+    position.
+    """
+    for segment in read_header_segments(fh):
+        if segment.marker != APP1:
+            continue
+        fh.seek(segment.payload_offset)
+        payload = fh.read(segment.length - 2)
+        if payload.startswith(_EXIF_HEADER):
+            return segment, bytearray(payload[len(_EXIF_HEADER):])
+    return None, None
+
+
+def byte_order(tiff):
+    """Returns the struct byte-order prefix of a TIFF header."""
+    if tiff[:4] == b'II*\x00':
+        return '<'
+    if tiff[:4] == b'MM\x00*':
+        return '>'
+    raise ValueError('bad TIFF header')
+
+
+def read_ifd(tiff, ifd_offset):
+    """Returns the list of IfdEntry in the IFD at ifd_offset."""
+    order = byte_order(tiff)
+    if ifd_offset + 2 > len(tiff):
+        raise ValueError('IFD offset %d out of range' % ifd_offset)
+    count = struct.unpack_from(order + 'H', tiff, ifd_offset)[0]
+    if ifd_offset + 2 + 12 * count + 4 > len(tiff):
+        raise ValueError('IFD at %d runs past the EXIF block' % ifd_offset)
+    entries = []
+    for i in range(count):
+        pos = ifd_offset + 2 + 12 * i
+        tag, type_id, n, value = struct.unpack_from(order + 'HHII', tiff, pos)
+        entries.append(IfdEntry(tag, type_id, n, value, pos))
+    return entries
+
+
+def exif_ifd_offset(tiff):
+    """Returns the offset of the Exif sub-IFD, or None if there is none."""
+    order = byte_order(tiff)
+    ifd0 = struct.unpack_from(order + 'I', tiff, 4)[0]
+    for entry in read_ifd(tiff, ifd0):
+        if entry.tag == EXIF_IFD_POINTER:
+            return entry.value
+    return None
+
+
+def find_exif_tag(tiff, tag):
+    """Returns the IfdEntry for tag in the Exif sub-IFD, or None."""
+    ifd_offset = exif_ifd_offset(tiff)
+    if ifd_offset is None:
+        return None
+    for entry in read_ifd(tiff, ifd_offset):
+        if entry.tag == tag:
+            return entry
+    return None
+
+
+def remove_ifd_entry(tiff, ifd_offset, tag):
+    """Deletes tag from the IFD at ifd_offset, in place.
+
+    The following entries and the next-IFD pointer move up by one slot and
+    the freed 12 bytes are zeroed, so the block keeps its size and no
+    other offset in the file changes.  Returns True if the tag was found.
+    """
+    order = byte_order(tiff)
+    entries = read_ifd(tiff, ifd_offset)
+    for entry in entries:
+        if entry.tag == tag:
+            end = ifd_offset + 2 + 12 * len(entries) + 4
+            tiff[entry.offset:end - 12] = tiff[entry.offset + 12:end]
+            tiff[end - 12:end] = bytes(12)
+            struct.pack_into(order + 'H', tiff, ifd_offset, len(entries) - 1)
+            return True
+    return False
+
+
+def copy_without_exif_tag(src_path, dest_path, tag):
+    """Writes a copy of a JPEG with one Exif sub-IFD tag removed.
+
+    The source is read once: the header segments are parsed, the APP1
+    block is patched in memory, and the rest of the file (the
+    entropy-coded data) is copied through unchanged, by reflink where the
+    filesystem supports it and with kernel-side or large-buffer copies
+    otherwise.  dest_path must not exist.  Metadata is copied as by
+    shutil.copy2.
+
+    Returns False (creating nothing) if the JPEG doesn't have the tag.
+    Raises ValueError for files that aren't well-formed JPEGs.
+    """
+    with open(src_path, 'rb') as src:
+        segment, tiff = find_exif_segment(src)
+        if segment is None:
+            return False
+        ifd_offset = exif_ifd_offset(tiff)
+        if ifd_offset is None or not remove_ifd_entry(tiff, ifd_offset, tag):
+            return False
+        patch_offset = segment.payload_offset + len(_EXIF_HEADER)
+        src.seek(0)
+        head = bytearray(src.read(segment.end))
+        head[patch_offset:patch_offset + len(tiff)] = tiff
+
+        fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if _reflink(src.fileno(), fd):
+                os.pwrite(fd, bytes(head[patch_offset:patch_offset
+                                         + len(tiff)]), patch_offset)
+            else:
+                os.write(fd, head)
+                _copy_range(src, fd, segment.end)
+        except BaseException:
+            os.close(fd)
+            os.remove(dest_path)
+            raise
+        os.close(fd)
+    shutil.copystat(src_path, dest_path)
+    return True
+
+
+def _reflink(src_fd, dest_fd):
+    """Clones src_fd's data into dest_fd; returns False if unsupported."""
+    try:
+        fcntl.ioctl(dest_fd, _FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_range(src, dest_fd, offset):
+    """Copies src from offset to its end onto dest_fd's current position."""
+    size = os.fstat(src.fileno()).st_size
+    try:
+        while offset < size:
+            copied = os.copy_file_range(src.fileno(), dest_fd,
+                                        size - offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP):
+            raise
+    src.seek(offset)
+    while True:
+        chunk = src.read(_COPY_CHUNK)
+        if not chunk:
+            break
+        os.write(dest_fd, chunk)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import errno
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest.mock import *
+
+from PIL import Image
+
+import jpeg_segments
+
+_SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+_GNEXUS = os.path.join(_SCRIPT_DIR, 'test', 'gnexus 160.jpg')
+
+
+def _tiff(order, ifd_tags):
+    """Builds a TIFF block whose IFD0 holds SHORT entries for ifd_tags."""
+    body = struct.pack(order + 'H', len(ifd_tags))
+    for tag in ifd_tags:
+        body += struct.pack(order + 'HHIHH', tag, 3, 1, tag & 0xFF, 0)
+    body += struct.pack(order + 'I', 0x11223344)
+    magic = b'II*\x00' if order == '<' else b'MM\x00*'
+    return bytearray(magic + struct.pack(order + 'I', 8) + body)
+
+
+class JpegSegmentsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src.jpg')
+        self.dest = os.path.join(self.tmpdir, 'dest.jpg')
+        shutil.copy2(_GNEXUS, self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_header_segments(self):
+        with open(_GNEXUS, 'rb') as fh:
+            segments = jpeg_segments.read_header_segments(fh)
+        self.assertEqual(jpeg_segments.APP1, segments[0].marker)
+        self.assertEqual(jpeg_segments.SOS, segments[-1].marker)
+        for prev, cur in zip(segments, segments[1:]):
+            self.assertEqual(prev.end, cur.offset)
+
+    def test_not_a_jpeg(self):
+        path = os.path.join(self.tmpdir, 'notes.txt')
+        with open(path, 'wb') as fh:
+            fh.write(b'not a photo')
+        with open(path, 'rb') as fh:
+            self.assertRaises(ValueError,
+                              jpeg_segments.read_header_segments, fh)
+        self.assertRaises(ValueError, jpeg_segments.copy_without_exif_tag,
+                          path, self.dest, jpeg_segments.ISO_SPEED_RATINGS)
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_find_exif_tag(self):
+        with open(_GNEXUS, 'rb') as fh:
+            _segment, tiff = jpeg_segments.find_exif_segment(fh)
+        iso = jpeg_segments.find_exif_tag(tiff,
+                                          jpeg_segments.ISO_SPEED_RATINGS)
+        self.assertEqual(3, iso.count)
+
+    def test_remove_ifd_entry(self):
+        for order in '<>':
+            tiff = _tiff(order, [0x100, 0x101, 0x102])
+            size = len(tiff)
+            self.assertTrue(jpeg_segments.remove_ifd_entry(tiff, 8, 0x101))
+            self.assertEqual(size, len(tiff))
+            entries = jpeg_segments.read_ifd(tiff, 8)
+            self.assertEqual([0x100, 0x102], [e.tag for e in entries])
+            value = struct.unpack_from(order + 'H', tiff,
+                                       entries[1].offset + 8)[0]
+            self.assertEqual(0x02, value)
+            next_ifd = struct.unpack_from(order + 'I', tiff, 8 + 2 + 24)[0]
+            self.assertEqual(0x11223344, next_ifd)
+            self.assertEqual(bytes(12), bytes(tiff[-12:]))
+            self.assertFalse(jpeg_segments.remove_ifd_entry(tiff, 8, 0x101))
+
+    def _assert_iso_removed(self):
+        self.assertEqual(os.path.getsize(self.src),
+                         os.path.getsize(self.dest))
+        self.assertEqual(os.stat(self.src).st_mtime,
+                         os.stat(self.dest).st_mtime)
+        with Image.open(self.src) as orig, Image.open(self.dest) as copy:
+            orig_exif = orig.getexif().get_ifd(0x8769)
+            copy_exif = copy.getexif().get_ifd(0x8769)
+            self.assertNotIn(0x8827, copy_exif)
+            del orig_exif[0x8827]
+            # repr, since the Galaxy Nexus writes a NaN ExposureIndex.
+            self.assertEqual(repr(dict(orig_exif)), repr(dict(copy_exif)))
+            self.assertEqual(orig.getexif()[0x110], copy.getexif()[0x110])
+            self.assertEqual(orig.tobytes(), copy.tobytes())
+
+    def test_copy_without_exif_tag(self):
+        self.assertTrue(jpeg_segments.copy_without_exif_tag(
+            self.src, self.dest, jpeg_segments.ISO_SPEED_RATINGS))
+        self._assert_iso_removed()
+
+    @patch('jpeg_segments._reflink', new=lambda src, dest: False)
+    def test_copy_without_reflink(self):
+        self.assertTrue(jpeg_segments.copy_without_exif_tag(
+            self.src, self.dest, jpeg_segments.ISO_SPEED_RATINGS))
+        self._assert_iso_removed()
+
+    @patch('jpeg_segments._reflink', new=lambda src, dest: False)
+    @patch('os.copy_file_range',
+           side_effect=OSError(errno.EXDEV, 'cross-device'))
+    def test_copy_buffered_fallback(self, _copy_file_range):
+        self.assertTrue(jpeg_segments.copy_without_exif_tag(
+            self.src, self.dest, jpeg_segments.ISO_SPEED_RATINGS))
+        self._assert_iso_removed()
+
+    def test_copy_without_missing_tag(self):
+        jpeg_segments.copy_without_exif_tag(
+            self.src, self.dest, jpeg_segments.ISO_SPEED_RATINGS)
+        again = os.path.join(self.tmpdir, 'again.jpg')
+        self.assertFalse(jpeg_segments.copy_without_exif_tag(
+            self.dest, again, jpeg_segments.ISO_SPEED_RATINGS))
+        self.assertFalse(os.path.exists(again))
+
+    def test_copy_refuses_existing_dest(self):
+        with open(self.dest, 'wb') as fh:
+            fh.write(b'keep me')
+        self.assertRaises(FileExistsError,
+                          jpeg_segments.copy_without_exif_tag,
+                          self.src, self.dest,
+                          jpeg_segments.ISO_SPEED_RATINGS)
+        with open(self.dest, 'rb') as fh:
+            self.assertEqual(b'keep me', fh.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,40 +1,156 @@
 """ Common operations and types for media collection and management
 """
 
+import calendar
+import ctypes
+import fcntl
+import functools
 import logging
 import os
 import os.path
+import socket
 import sys
+import threading
 import time
+import urllib.parse
 import grp
 import hashlib
 import sqlite3 as sqlite
+import struct
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from PIL.ExifTags import TAGS
 
+import content_hash
+import media_types
+import parallel
+
 # Map of PIL EXIF tag names to their numeric IDs (for faster lookup)
 _EXIF_TAG_TO_ID = {v: k for k, v in TAGS.items()}
 
 _RELEVANT_TAGS = {
     'Make', 'Model', 'DateTimeOriginal', 'DateTime', 'DateTimeDigitized',
-    'ISOSpeedRatings'
+    'ISOSpeedRatings', 'Orientation', 'GPSInfo'
 }
 
+# GPSInfo sub-tags
+_GPS_LATITUDE_REF = 1
+_GPS_LATITUDE = 2
+_GPS_LONGITUDE_REF = 3
+_GPS_LONGITUDE = 4
+
+# Columns added to the photos table after its original schema, as
+# (name, type).  New databases get them at creation time; open() adds any
+# that an existing database is missing.
+_ADDED_COLUMNS = (
+    ('latitude', 'real'),
+    ('longitude', 'real'),
+    ('orientation', 'integer'),
+    ('width', 'integer'),
+    ('height', 'integer'),
+    ('verified_at', 'integer'),
+    ('verify_status', 'text'),
+    ('mtime_ns', 'integer'),
+    ('inode', 'integer'),
+    ('device', 'integer'),
+    ('phash', 'integer'),
+    ('similar_to', 'integer'),
+    ('content_md5', 'text'),
+)
+
+# Every column of the photos table, once a database is upgraded.
+PHOTO_COLUMNS = (('id', 'flags', 'md5', 'size', 'description',
+                  'source_info', 'archive_path', 'timestamp', 'camera_make',
+                  'camera_model')
+                 + tuple(name for (name, _type) in _ADDED_COLUMNS))
+
+# Secondary indexes on the photos table, as (name, columns).
+_INDEXES = (
+    ('photos_content_md5', 'content_md5'),
+    ('photos_timestamp', 'timestamp'),
+    ('photos_camera', 'camera_make COLLATE NOCASE, '
+                      'camera_model COLLATE NOCASE, timestamp'),
+    ('photos_archive_path', 'archive_path'),
+)
+
+# Connection settings for media.db.  WAL lets readers and the writer
+# run at the same time; synchronous=NORMAL in WAL mode can lose the last
+# commits on power loss but never corrupts the database.  A writer waits
+# up to busy_timeout ms for another writer before "database is locked".
+# Negative cache_size is in KiB; journal_size_limit trims the WAL file
+# once a checkpoint has emptied it.
+_PRAGMAS = (
+    ('busy_timeout', 60000),
+    ('journal_size_limit', 64 * 1024 * 1024),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+# Lock file in a library, held by the process archiving into it and by
+# the jobs that move or drop its photos' rows (see RunLock).
+INGEST_LOCK_NAME = 'ingest.lock'
+
+# Archived files made durable together by a SyncBatch, and how.
+DEFAULT_SYNC_BATCH = 100
+SYNC_MODES = ('fsync', 'syncfs')
+
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+except (AttributeError, OSError):
+    _syncfs = None
+
+# job_state job holding the library's archive layout settings.
+_LAYOUT_JOB = 'layout'
+
+# Modes of Repository.checkpoint(), see
+# https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+# Columns Repository.query() returns unless asked for others.
+QUERY_COLUMNS = ('id', 'archive_path', 'timestamp', 'camera_make',
+                 'camera_model', 'size', 'md5', 'width', 'height',
+                 'latitude', 'longitude')
+
+# ioctl returning a file's extent map (linux/fs.h), with the layouts of
+# struct fiemap and struct fiemap_extent.
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQIIII')
+_FIEMAP_EXTENT_SIZE = 56
+
 
 class Repository():
     """Represents a repository of media items, such as photos"""
 
     def __init__(self):
         self.con = None
+        self.read_only = False
 
-    def open(self, lib_base_dir):
-        """Opens or creates the repository and media library"""
-        self._tree_setup(lib_base_dir)
+    def open(self, lib_base_dir, read_only=False):
+        """Opens or creates the repository and media library.
+
+        With read_only, opens an existing database for queries and
+        reports only: nothing is created, upgraded or written, and the
+        connection never blocks the ingest.
+        """
+        self.read_only = read_only
         db_path = os.path.join(lib_base_dir, 'media.db')
+        if read_only:
+            if not os.path.exists(db_path):
+                raise FileNotFoundError('no media database in %s'
+                                        % lib_base_dir)
+            self.con = sqlite.connect(
+                'file:%s?mode=ro' % urllib.parse.quote(db_path), uri=True)
+            self._configure()
+            return
+        self._tree_setup(lib_base_dir)
         if not os.access(db_path, os.R_OK | os.W_OK):
             logging.warning("can't open %s, will attempt to create it",
                             lib_base_dir)
             self.con = sqlite.connect(os.path.join(lib_base_dir, "media.db"))
+            self._configure()
             cur = self.con.cursor()
             cur.execute('''create table photos
                 (id integer primary key,
@@ -47,46 +163,128 @@ class Repository():
                 timestamp integer,
                 camera_make text,
                 camera_model text,
+                %s
                 unique (md5) on conflict replace);
-                ''')
+                ''' % ''.join('%s %s, ' % column
+                              for column in _ADDED_COLUMNS))
         else:
             self.con = sqlite.connect(os.path.join(lib_base_dir, "media.db"))
+            self._configure()
+            self._upgrade_schema()
         if self.con is None:
             raise RuntimeError("Could not open the media database"
                                " for an unknown reason")
+        self._create_indexes()
+
+    def _configure(self):
+        """Applies _PRAGMAS and, for writers, switches to WAL mode."""
+        cur = self.con.cursor()
+        for (name, value) in _PRAGMAS:
+            cur.execute('PRAGMA %s = %s' % (name, value))
+        if not self.read_only:
+            # Persistent: set once, it stays on for every later connection.
+            cur.execute('PRAGMA journal_mode = WAL')
+
+    def checkpoint(self, mode='PASSIVE'):
+        """Copies committed transactions from the WAL into the database.
+
+        SQLite also checkpoints on its own every 1000 pages.  A writer
+        checkpoints when it is closed, so a bulk job hands the next one a
+        WAL that can be reused from the start.  PASSIVE never waits for
+        readers; TRUNCATE waits up to busy_timeout for them and empties
+        the WAL file.  Returns (busy, pages in the WAL, pages
+        checkpointed) as reported by SQLite.
+        """
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError('unknown checkpoint mode %r' % mode)
+        return tuple(self.con.execute(
+            'PRAGMA wal_checkpoint(%s)' % mode).fetchone())
+
+    def _upgrade_schema(self):
+        """Adds any columns in _ADDED_COLUMNS missing from the database."""
+        cur = self.con.cursor()
+        existing = {row[1] for row in
+                    cur.execute('PRAGMA table_info(photos)')}
+        for name, column_type in _ADDED_COLUMNS:
+            if name not in existing:
+                logging.info('Adding column %s to the photos table', name)
+                cur.execute('ALTER TABLE photos ADD COLUMN %s %s'
+                            % (name, column_type))
+        self.con.commit()
+
+    def _create_indexes(self):
+        """Creates any indexes in _INDEXES missing from the database."""
+        cur = self.con.cursor()
+        for name, columns in _INDEXES:
+            cur.execute('CREATE INDEX IF NOT EXISTS %s ON photos (%s)'
+                        % (name, columns))
 
     def close(self):
         """Closes the repository."""
         if self.con:
-            self.con.commit()
+            if not self.read_only:
+                self.con.commit()
+                self.checkpoint()
             self.con.close()
             self.con = None
 
-    def add_or_update(self, photo):
-        """Adds a photo to the repository."""
+    def add_or_update(self, photo, commit=True):
+        """Adds a photo to the repository.  With commit False, the caller
+        commits later, e.g. through a SyncBatch."""
         cur = self.con.cursor()
         cur.execute('''
 INSERT OR REPLACE INTO photos (id, flags, md5, size, description,
                                source_info, camera_make,
                                camera_model, archive_path,
-                               timestamp)
-SELECT old.id, old.flags, new.md5, new.size, old.description,
+                               timestamp, latitude, longitude,
+                               orientation, width, height,
+                               mtime_ns, inode, device, phash,
+                               similar_to, content_md5)
+SELECT old.id, old.flags, new.md5, new.size,
+       COALESCE(new.description, old.description),
        old.source_info, new.camera_make, new.camera_model,
-       new.archive_path, new.timestamp
+       new.archive_path, new.timestamp,
+       COALESCE(new.latitude, old.latitude),
+       COALESCE(new.longitude, old.longitude),
+       COALESCE(new.orientation, old.orientation),
+       COALESCE(new.width, old.width),
+       COALESCE(new.height, old.height),
+       COALESCE(new.mtime_ns, old.mtime_ns),
+       COALESCE(new.inode, old.inode),
+       COALESCE(new.device, old.device),
+       COALESCE(new.phash, old.phash),
+       COALESCE(new.similar_to, old.similar_to),
+       COALESCE(new.content_md5, old.content_md5)
 FROM ( SELECT
      :md5             AS md5,
      :size            AS size,
+     :description     AS description,
      :camera_make     AS camera_make,
      :camera_model    AS camera_model,
      :archive_path     AS archive_path,
-     :timestamp       AS timestamp
+     :timestamp       AS timestamp,
+     :latitude        AS latitude,
+     :longitude       AS longitude,
+     :orientation     AS orientation,
+     :width           AS width,
+     :height          AS height,
+     :mtime_ns        AS mtime_ns,
+     :inode           AS inode,
+     :device          AS device,
+     :phash           AS phash,
+     :similar_to      AS similar_to,
+     :content_md5     AS content_md5
  ) AS new
 LEFT JOIN (
-           SELECT id, flags, description, source_info, md5
+           SELECT id, flags, description, source_info, md5,
+                  latitude, longitude, orientation, width, height,
+                  mtime_ns, inode, device, phash, similar_to,
+                  content_md5
            FROM photos
 ) AS old ON new.md5 = old.md5;
                 ''', photo.__dict__)
-        self.con.commit()
+        if commit:
+            self.con.commit()
         return cur.lastrowid
 
     def remove(self, photo):
@@ -119,6 +317,51 @@ LEFT JOIN (
             return row
         return None
 
+    def lookup_content(self, content_md5):
+        """Returns the id and filepath of an existing file with the
+        provided content digest (see content_hash), or None.
+
+        A match has the same image data as the file looked up, but
+        possibly different metadata.
+        """
+        return self.con.execute(
+            'SELECT id, archive_path FROM photos WHERE content_md5 = ? '
+            'ORDER BY id LIMIT 1', [content_md5]).fetchone()
+
+    def query(self, columns=QUERY_COLUMNS, limit=None, **filters):
+        """Yields the photos matching all filters, oldest first, as dicts
+        of columns.
+
+        Rows are fetched lazily.  filters are since and before (epoch
+        seconds, inclusive and exclusive), make and model (whole value,
+        case-insensitive), path_prefix (start of archive_path) and
+        min_size and max_size (bytes, inclusive).  Each is served by an
+        index except the size bounds.
+        """
+        unknown = set(columns) - self._columns()
+        if unknown:
+            raise ValueError('unknown column(s) %s'
+                             % ', '.join(sorted(unknown)))
+        (where, params) = _query_filters(**filters)
+        sql = ('SELECT %s FROM photos%s ORDER BY timestamp, id'
+               % (', '.join(columns), where))
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        for row in self.con.execute(sql, params):
+            yield dict(zip(columns, row))
+
+    def count(self, **filters):
+        """Returns the number of photos matching filters, as for
+        query()."""
+        (where, params) = _query_filters(**filters)
+        return self.con.execute('SELECT COUNT(*) FROM photos' + where,
+                                params).fetchone()[0]
+
+    def _columns(self):
+        """Returns the names of the photos table's columns."""
+        return {row[1] for row in
+                self.con.execute('PRAGMA table_info(photos)')}
+
     def iter_all_photos(self):
         """Returns an iterator returning (id, filepath) for all photos"""
         cur = self.con.cursor()
@@ -131,6 +374,30 @@ LEFT JOIN (
                  + ','.join('?' * len(photo_ids)) + ')')
         cur.execute(query, photo_ids)
 
+    def ledger(self, job):
+        """Returns the JobLedger for the named maintenance job."""
+        return JobLedger(self.con, job)
+
+    def ingest_failures(self, commit=True):
+        """Returns the IngestFailures ledger of files that failed to
+        archive.  With commit False, its changes are left for the caller
+        to commit."""
+        return IngestFailures(self.con, commit=commit)
+
+    def archive_layout(self, lib_base_dir):
+        """Returns the ArchiveLayout of the library, with its saved
+        settings."""
+        value = self.ledger(_LAYOUT_JOB).get_state('day_dirs_after')
+        return ArchiveLayout(self, lib_base_dir,
+                             int(value) if value else None)
+
+    def set_day_dirs_after(self, count):
+        """Saves the month size beyond which photos get day directories
+        (see ArchiveLayout); 0 or None turns them off."""
+        ledger = self.ledger(_LAYOUT_JOB)
+        ledger.set_state('day_dirs_after', count or 0)
+        ledger.commit()
+
     @staticmethod
     def _tree_setup(lib_base_dir):
         """Creates the media library directories"""
@@ -141,6 +408,553 @@ LEFT JOIN (
             os.mkdir(photos_dir, 0o755)
 
 
+def _query_filters(since=None, before=None, make=None, model=None,
+                   path_prefix=None, min_size=None, max_size=None):
+    """Returns the WHERE clause and parameters for Repository.query()."""
+    clauses = []
+    params = {}
+    if since is not None:
+        clauses.append('timestamp >= :since')
+        params['since'] = since
+    if before is not None:
+        clauses.append('timestamp < :before')
+        params['before'] = before
+    if make is not None:
+        clauses.append('camera_make = :make COLLATE NOCASE')
+        params['make'] = make
+    if model is not None:
+        clauses.append('camera_model = :model COLLATE NOCASE')
+        params['model'] = model
+    if path_prefix:
+        # A range rather than LIKE or substr(), so the index is used.
+        clauses.append('archive_path >= :prefix '
+                       'AND archive_path < :prefix_end')
+        params['prefix'] = path_prefix
+        params['prefix_end'] = path_prefix + '\U0010ffff'
+    if min_size is not None:
+        clauses.append('size >= :min_size')
+        params['min_size'] = min_size
+    if max_size is not None:
+        clauses.append('size <= :max_size')
+        params['max_size'] = max_size
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    return (where, params)
+
+
+class JobLedger():
+    """Remembers which items a maintenance job has already processed.
+
+    Entries live in the job_ledger table of a sqlite database (normally
+    media.db) keyed by job name and item, so a job can skip everything it
+    has examined on earlier runs.  A small key/value job_state table holds
+    per-job bookkeeping such as high-water marks.  Changes are written on
+    commit().
+    """
+
+    def __init__(self, con, job):
+        self.con = con
+        self.job = job
+        cur = self.con.cursor()
+        cur.execute('''create table if not exists job_ledger
+            (job text, item text, status text, updated integer,
+            primary key (job, item));''')
+        cur.execute('''create table if not exists job_state
+            (job text, key text, value text,
+            primary key (job, key));''')
+
+    def __contains__(self, item):
+        row = self.con.execute(
+            'SELECT 1 FROM job_ledger WHERE job = ? AND item = ?',
+            (self.job, str(item))).fetchone()
+        return row is not None
+
+    def items(self):
+        """Returns the set of items recorded for this job."""
+        return {row[0] for row in self.con.execute(
+            'SELECT item FROM job_ledger WHERE job = ?', (self.job,))}
+
+    def add(self, item, status='done'):
+        """Records that item was processed, with a short status string."""
+        self.con.execute(
+            'INSERT OR REPLACE INTO job_ledger (job, item, status, updated) '
+            'VALUES (?, ?, ?, ?)',
+            (self.job, str(item), status, int(time.time())))
+
+    def get_state(self, key, default=None):
+        """Returns a bookkeeping value saved with set_state()."""
+        row = self.con.execute(
+            'SELECT value FROM job_state WHERE job = ? AND key = ?',
+            (self.job, key)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        """Saves a bookkeeping value for this job."""
+        self.con.execute(
+            'INSERT OR REPLACE INTO job_state (job, key, value) '
+            'VALUES (?, ?, ?)', (self.job, key, str(value)))
+
+    def commit(self):
+        """Writes the recorded entries to the database."""
+        self.con.commit()
+
+    def close(self):
+        """Commits and closes a ledger opened with open_ledger()."""
+        self.con.commit()
+        self.con.close()
+
+
+class IngestFailures():
+    """Remembers staged files that failed to archive, so they are retried
+    with exponential backoff instead of on every run.
+
+    Entries live in the ingest_failures table keyed by failure_key(), the
+    file's size, mtime and inode: a file that is replaced or rewritten
+    starts over with a clean slate.  The whole table is read when the
+    ledger is created; it only ever holds a handful of rows.
+
+    Changes are committed as they are made unless commit is False, for a
+    caller whose connection has other writes in flight, such as the rows
+    of a SyncBatch that must not be committed before their files are
+    synced.
+    """
+
+    def __init__(self, con, backoff=3600, max_backoff=7 * 86400,
+                 commit=True):
+        self.con = con
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.commit = commit
+        self.con.execute('''create table if not exists ingest_failures
+            (key text primary key, path text, error text,
+            attempts integer, first_failed integer, last_failed integer,
+            retry_at integer, quarantined_to text);''')
+        self._rows = {row[0]: row[1:] for row in self.con.execute(
+            'SELECT key, attempts, retry_at FROM ingest_failures')}
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def backing_off(self, key, now=None):
+        """Returns whether the file with key failed recently enough that
+        it shouldn't be tried again yet."""
+        row = self._rows.get(key)
+        return row is not None and row[1] > (now or time.time())
+
+    def record(self, key, path, error, now=None):
+        """Records a failure of the file at path and returns how many
+        times it has failed.  The next try is due after backoff seconds,
+        doubling with each failure up to max_backoff."""
+        now = int(now or time.time())
+        attempts = self._rows.get(key, (0, 0))[0] + 1
+        retry_at = now + min(self.backoff * 2 ** (attempts - 1),
+                             self.max_backoff)
+        self.con.execute(
+            'INSERT INTO ingest_failures (key, path, error, attempts, '
+            'first_failed, last_failed, retry_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET path = excluded.path, '
+            'error = excluded.error, attempts = excluded.attempts, '
+            'last_failed = excluded.last_failed, '
+            'retry_at = excluded.retry_at',
+            (key, path, str(error)[:500], attempts, now, now, retry_at))
+        self._commit()
+        self._rows[key] = (attempts, retry_at)
+        return attempts
+
+    def quarantined(self, key, dest):
+        """Records that the failing file was moved to dest for good."""
+        self.con.execute(
+            'UPDATE ingest_failures SET quarantined_to = ? WHERE key = ?',
+            (dest, key))
+        self._commit()
+
+    def clear(self, key):
+        """Forgets the failures of a file that has now been archived."""
+        if self._rows.pop(key, None) is not None:
+            self.con.execute('DELETE FROM ingest_failures WHERE key = ?',
+                             (key,))
+            self._commit()
+
+    def _commit(self):
+        if self.commit:
+            self.con.commit()
+
+
+def failure_key(path):
+    """Returns the IngestFailures key of the file at path.
+
+    The device number is left out, as it differs between machines
+    mounting the same staging share.
+    """
+    (size, mtime_ns, inode, _device) = fingerprint(os.stat(path))
+    return '%d:%d:%d' % (size, mtime_ns, inode)
+
+
+def default_ledger_path():
+    """Returns the database for ledgers of jobs run outside a library."""
+    state_home = (os.environ.get('XDG_STATE_HOME')
+                  or os.path.expanduser('~/.local/state'))
+    return os.path.join(state_home, 'mediaman', 'jobs.db')
+
+
+def open_ledger(job, db_path=None):
+    """Returns a JobLedger kept in its own database file.
+
+    For jobs that work on plain directories rather than a library's
+    media.db.  db_path defaults to default_ledger_path().  Close it with
+    its close() method.
+    """
+    db_path = db_path or default_ledger_path()
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    return JobLedger(sqlite.connect(db_path), job)
+
+
+class SyncBatch():
+    """Makes archived files durable in groups before their staged
+    originals are deleted.
+
+    track() records a file just written to the archive, before its row is
+    added to the database, and add() the source to delete once that is
+    safe.  Nothing else may commit the connection while rows are pending.
+    Every size files, flush() fsyncs the files
+    and the directories holding them, up to top_dir, or with mode
+    'syncfs' syncs their whole filesystem in one call.  Then it commits
+    the database, with synchronous=FULL so the commit is on disk too, and
+    only then deletes the sources.  A power cut can't lose a file whose
+    original is gone, and the cost is a few syscalls per batch instead of
+    per file.  If the sync fails, the batch's rows are rolled back and its
+    copies removed, so the staged originals are archived again later.
+    on_rollback is then called, so the caller can drop whatever it has
+    cached about those rows: SQLite hands their ids out again.
+
+    A size of 0 skips the syncs: rows are committed as they are added and
+    the sources deleted at the final flush().
+    """
+
+    def __init__(self, con, top_dir, size=DEFAULT_SYNC_BATCH, mode='fsync',
+                 on_rollback=None):
+        self.con = con
+        self.top_dir = os.path.abspath(top_dir)
+        self.size = size
+        self.mode = mode
+        self.on_rollback = on_rollback
+        self._files = []
+        self._sources = []
+        self._pending = 0
+        if size:
+            self.con.execute('PRAGMA synchronous = FULL')
+
+    def track(self, path):
+        """Records path, a file written to the archive, to be synced
+        before the pending rows are committed."""
+        self._files.append(path)
+
+    def add(self, path=None, source=None):
+        """Records path, a file written to the archive, and source, a
+        file to delete once the pending files are durable.  Either may be
+        None."""
+        if path is not None:
+            self.track(path)
+        if source is not None:
+            self._sources.append(source)
+        self._pending += 1
+        if not self.size:
+            self.con.commit()
+        elif self._pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Syncs the pending files, commits and deletes the pending
+        sources.  Returns the number of sources deleted."""
+        (files, sources) = (self._files, self._sources)
+        (self._files, self._sources, self._pending) = ([], [], 0)
+        try:
+            if self.size and files:
+                self._sync(files)
+        except OSError as e:
+            logging.error('Could not sync the archive (%s); removing %d '
+                          'copies and keeping the staged originals of %d '
+                          'files', e, len(files), len(sources))
+            # Their rows must not outlive a power cut that the copies
+            # might not survive.
+            self.con.rollback()
+            for path in files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if self.on_rollback is not None:
+                self.on_rollback()
+            return 0
+        self.con.commit()
+        deleted = 0
+        for source in sources:
+            try:
+                os.remove(source)
+                deleted += 1
+            except OSError as e:
+                logging.warning('Could not delete %s: %s', source, e)
+        return deleted
+
+    def _sync(self, files):
+        if self.mode == 'syncfs' and _syncfs is not None:
+            fd = os.open(self.top_dir, os.O_RDONLY)
+            try:
+                if _syncfs(fd) != 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error))
+            finally:
+                os.close(fd)
+            return
+        dirs = set()
+        for path in files:
+            _fsync_path(path)
+            parent = os.path.dirname(os.path.abspath(path))
+            # New YYYY, MM_Month and DD directories need syncing too.
+            while parent not in dirs:
+                dirs.add(parent)
+                if (parent == self.top_dir
+                        or not parent.startswith(self.top_dir + os.sep)):
+                    break
+                parent = os.path.dirname(parent)
+        for path in dirs:
+            _fsync_path(path)
+
+
+def _fsync_path(path):
+    """fsyncs the file or directory at path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class RunLock():
+    """An exclusive, non-blocking lock on lock_path, held while a job
+    runs so that cron can't start a second copy of it over the first.
+
+    Backed by flock(2), so it goes away with the process however that
+    ends; a leftover lock file means nothing.  The holder's host and pid
+    are written to the file for the messages of the next would-be
+    holder.
+    """
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._fh = None
+
+    def acquire(self):
+        """Takes the lock if it is free.  Returns whether it was taken."""
+        fh = open(self.lock_path, 'a+')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            return False
+        fh.seek(0)
+        fh.truncate()
+        fh.write('%s %d\n' % (socket.gethostname(), os.getpid()))
+        fh.flush()
+        self._fh = fh
+        return True
+
+    def held(self):
+        """Returns whether this RunLock holds the lock."""
+        return self._fh is not None
+
+    def holder(self):
+        """Returns 'host pid' of the process last to take the lock."""
+        try:
+            with open(self.lock_path) as fh:
+                return fh.read().strip() or 'unknown'
+        except OSError:
+            return 'unknown'
+
+    def release(self):
+        """Releases the lock, if held."""
+        if self._fh:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+
+
+def walk_files(search_dir):
+    """Yields the path of every file under search_dir, lazily."""
+    for (dirpath, _dirnames, filenames) in os.walk(search_dir):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+class RateLimiter():
+    """Token-bucket limit on operations and bytes per second.
+
+    Either limit may be None for no limit.  Bursts of up to one second's
+    worth are allowed; a single request bigger than that is let through
+    once the bucket is full and paid back by later requests.
+    """
+
+    def __init__(self, ops_per_sec=None, bytes_per_sec=None):
+        self.ops_per_sec = ops_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self._ops = ops_per_sec or 0
+        self._bytes = bytes_per_sec or 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes=0):
+        """Blocks until one operation of nbytes bytes is allowed."""
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self._last
+                self._last = now
+                delay = 0
+                if self.ops_per_sec:
+                    self._ops = min(self.ops_per_sec,
+                                    self._ops + elapsed * self.ops_per_sec)
+                    if self._ops < 1:
+                        delay = (1 - self._ops) / self.ops_per_sec
+                if self.bytes_per_sec:
+                    self._bytes = min(self.bytes_per_sec,
+                                      self._bytes
+                                      + elapsed * self.bytes_per_sec)
+                    wanted = min(nbytes, self.bytes_per_sec)
+                    if self._bytes < wanted:
+                        delay = max(delay, (wanted - self._bytes)
+                                    / self.bytes_per_sec)
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+            if self.ops_per_sec:
+                self._ops -= 1
+            if self.bytes_per_sec:
+                self._bytes -= nbytes
+
+
+class BatchJob():
+    """Runs an operation over many items on a worker pool.
+
+    operation(item) returns a short status string such as 'fixed' or
+    'ok', or a (status, value) pair to hand a result back to the caller;
+    an exception is logged and counted as 'error'.  Items can come from
+    walk_files(), from database rows or from any other iterable, and are
+    consumed lazily.
+
+    With a ledger, items whose key(item) is already recorded are skipped
+    and every result other than 'error' is recorded.  The ledger is
+    committed every checkpoint_every results and when the run ends, even
+    by an exception or Ctrl-C, so an interrupted job picks up where it
+    stopped.  Items are handed to the pool through rate_limiter, if any,
+    with size_of(item) as the byte count.  Progress and throughput are
+    logged every progress_interval seconds.
+
+    processes=True runs the operation in a process pool, for CPU-bound
+    work; operation must then be a module-level function and items and
+    results picklable.
+    """
+
+    def __init__(self, name, operation, ledger=None, key=str, workers=4,
+                 processes=False, rate_limiter=None, size_of=None,
+                 progress_interval=30, checkpoint_every=200):
+        self.name = name
+        self.operation = operation
+        self.ledger = ledger
+        self.key = key
+        self.workers = workers
+        self.processes = processes
+        self.rate_limiter = rate_limiter
+        self.size_of = size_of
+        self.progress_interval = progress_interval
+        self.checkpoint_every = checkpoint_every
+
+    def run(self, items, on_result=None, on_checkpoint=None):
+        """Processes items and returns a Counter of result statuses.
+
+        on_result(item, status, value) is called in the calling thread as
+        each item finishes, before the item is recorded in the ledger;
+        value is None unless the operation returned one.
+        on_checkpoint() is called just before each ledger commit, for
+        callers that batch their own database writes.  Skipped items are
+        counted as 'already_done'.
+        """
+        counts = Counter()
+        done = self.ledger.items() if self.ledger is not None else set()
+        start = time.monotonic()
+        next_report = start + self.progress_interval
+        total_bytes = 0
+
+        def feed():
+            nonlocal total_bytes
+            for item in items:
+                if done and self.key(item) in done:
+                    counts['already_done'] += 1
+                    continue
+                nbytes = self.size_of(item) if self.size_of else 0
+                total_bytes += nbytes
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(nbytes)
+                yield item
+
+        executor = (ProcessPoolExecutor(max_workers=self.workers)
+                    if self.processes else None)
+        uncommitted = 0
+        try:
+            for (item, result) in parallel.imap_unordered(
+                    functools.partial(_run_batch_item, self.operation),
+                    feed(), workers=self.workers, executor=executor):
+                (status, value) = (result if isinstance(result, tuple)
+                                   else (result, None))
+                counts[status] += 1
+                if on_result is not None:
+                    on_result(item, status, value)
+                if self.ledger is not None and status != 'error':
+                    self.ledger.add(self.key(item), status)
+                uncommitted += 1
+                if uncommitted >= self.checkpoint_every:
+                    self._checkpoint(on_checkpoint)
+                    uncommitted = 0
+                now = time.monotonic()
+                if now >= next_report:
+                    self._log_progress(counts, total_bytes, now - start)
+                    next_report = now + self.progress_interval
+        finally:
+            self._checkpoint(on_checkpoint)
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+        self._log_progress(counts, total_bytes, time.monotonic() - start,
+                           final=True)
+        return counts
+
+    def _checkpoint(self, on_checkpoint):
+        if on_checkpoint is not None:
+            on_checkpoint()
+        if self.ledger is not None:
+            self.ledger.commit()
+
+    def _log_progress(self, counts, total_bytes, elapsed, final=False):
+        processed = sum(counts.values()) - counts['already_done']
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        details = ['%s=%d' % item for item in sorted(counts.items())]
+        if self.size_of:
+            details.append('%.1f MB/s' % (
+                total_bytes / elapsed / 1e6 if elapsed > 0 else 0.0))
+        logging.info('%s %s: %d processed in %.1fs (%.1f/s) %s',
+                     self.name, 'complete' if final else 'progress',
+                     processed, elapsed, rate,
+                     ' '.join(details) or 'nothing to do')
+
+
+def _run_batch_item(operation, item):
+    """Runs operation on one item for BatchJob, turning errors into a
+    status."""
+    try:
+        return (item, operation(item))
+    except Exception:
+        logging.exception('Error processing %s', item)
+        return (item, 'error')
+
+
 class Photo():
     """Represents a file containing a photo"""
 
@@ -149,8 +963,24 @@ class Photo():
         self.size = self.description = None
         self.timestamp = self.archive_path = None
         self.camera_make = self.camera_model = None
+        self.latitude = self.longitude = None
+        self.orientation = self.width = self.height = None
+        # Stat fingerprint of the archived copy, see fingerprint().
+        self.mtime_ns = self.inode = self.device = None
+        # Perceptual hash (signed, see similar.to_db) and the id of an
+        # archived photo it looks like, if any.
+        self.phash = self.similar_to = None
+        # Digest of the image data alone, see content_hash.
+        self.content_md5 = None
         self.source_info = None
         self.source_path = source_path
+        # (kind, format) from media_types.classify(), None if not media;
+        # classified when metadata is loaded unless set before.
+        self.media_type = None
+        self.media_type_known = False
+        # Capture time from an external source such as a Google Takeout
+        # sidecar; used when the file itself has no EXIF date.
+        self.sidecar_timestamp = None
         self.metadata_read = False
 
     def get_path_parts(self):
@@ -164,56 +994,68 @@ class Photo():
     def load_metadata(self):
         """Loads relevant exif and filesystem metadata for the photo"""
         self._load_exif_metadata()
+        self._load_sidecar_timestamp()
         self._load_filesystem_timestamp()
         self._load_file_size()
         self.md5 = self._get_hash()
         self.metadata_read = True
 
+    def classify(self):
+        """Sets and returns media_type, reading the file's first bytes if
+        it isn't known yet.  Raises OSError if the file can't be read."""
+        if not self.media_type_known:
+            self.media_type = media_types.classify(self.source_path)
+            self.media_type_known = True
+        return self.media_type
+
     def _load_exif_metadata(self):
-        """Reads EXIF data using Pillow."""
-        image = None
+        """Reads EXIF data using Pillow, or the movie header of a video.
+        Files of other kinds aren't opened."""
         try:
-            image = Image.open(self.source_path)
-            exif_data = image._getexif()
-            if exif_data is None:
+            media_type = self.classify()
+            if media_type is None or media_type[0] == media_types.AUDIO:
                 return
-            # Map numeric tag IDs to names
-            tagged = {}
-            for tag_id, value in exif_data.items():
-                tag_name = TAGS.get(tag_id, '')
-                if tag_name in _RELEVANT_TAGS:
-                    tagged[tag_name] = value
-
-            # Timestamp
-            timestamp_str = (tagged.get('DateTimeOriginal')
-                             or tagged.get('DateTime')
-                             or tagged.get('DateTimeDigitized'))
-            if timestamp_str and isinstance(timestamp_str, str):
-                try:
-                    ts = time.strptime(timestamp_str,
-                                       '%Y:%m:%d %H:%M:%S')
-                    self.timestamp = time.mktime(ts)
-                except (ValueError, OverflowError):
-                    logging.warning('Bad EXIF timestamp in %s: %s',
-                                    self.source_path, timestamp_str)
-
-            # Camera make
-            if 'Make' in tagged:
-                self.camera_make = str(tagged['Make']).strip()
-
-            # Camera model
-            if 'Model' in tagged:
-                self.camera_model = str(tagged['Model']).strip()
-
+            if media_type[0] == media_types.VIDEO:
+                metadata = media_types.read_video_metadata(self.source_path)
+                # A Takeout sidecar's time is UTC, which the movie header
+                # of many cameras isn't.
+                if self.sidecar_timestamp is not None:
+                    metadata['timestamp'] = None
+            else:
+                metadata = read_image_metadata(self.source_path)
         except (IOError, OSError) as e:
             logging.warning("%s: cannot read EXIF: %s",
                             self.source_path, e)
+            return
         except Exception as e:
             logging.warning('Unexpected error reading EXIF from %s: %s',
                             self.source_path, e)
-        finally:
-            if image is not None:
-                image.close()
+            return
+        self.timestamp = metadata['timestamp']
+        self.camera_make = metadata['camera_make']
+        self.camera_model = metadata['camera_model']
+        self.orientation = metadata['orientation']
+        self.width = metadata['width']
+        self.height = metadata['height']
+        # A location from a sidecar was set before loading, and wins.
+        if self.latitude is None and self.longitude is None:
+            self.latitude = metadata['latitude']
+            self.longitude = metadata['longitude']
+
+    def load_archive_fingerprint(self):
+        """Records the stat fingerprint of the archived copy."""
+        (_size, self.mtime_ns, self.inode, self.device) = fingerprint(
+            os.stat(self.archive_path))
+
+    def _load_sidecar_timestamp(self):
+        """Uses the sidecar capture time if EXIF didn't provide one."""
+        if self.timestamp is None and self.sidecar_timestamp is not None:
+            self.timestamp = self.sidecar_timestamp
+
+    def timestamp_from_sidecar(self):
+        """Returns True if the photo's timestamp came from its sidecar."""
+        return (self.sidecar_timestamp is not None
+                and self.timestamp == self.sidecar_timestamp)
 
     def _load_file_size(self):
         """Gets the size in bytes of the photo from the filesystem"""
@@ -235,14 +1077,21 @@ class Photo():
                 self.timestamp = 0
 
     def _get_hash(self):
-        """Computes the md5 hash."""
+        """Computes the md5 hash.
+
+        The content digest is computed in the same pass and stored in
+        content_md5.
+        """
         md5_hash = hashlib.md5()
+        content_hasher = content_hash.ContentHasher()
         with open(self.source_path, 'rb') as fh:
             while True:
                 chunk = fh.read(8192)
                 if not chunk:
                     break
                 md5_hash.update(chunk)
+                content_hasher.update(chunk)
+        self.content_md5 = content_hasher.hexdigest()
         return md5_hash.hexdigest()
 
 
@@ -281,6 +1130,188 @@ def configure_logging(filename):
                         log_dir, e)
 
 
+def read_image_metadata(filepath):
+    """Reads the metadata held in an image file's headers.
+
+    Returns a dict with timestamp, camera_make, camera_model, latitude,
+    longitude, orientation, width and height; anything the file doesn't
+    record is None.  Only the headers are parsed, the image data isn't
+    decoded.  Raises OSError if the file can't be opened as an image.
+    """
+    metadata = dict.fromkeys(('timestamp', 'camera_make', 'camera_model',
+                              'latitude', 'longitude', 'orientation',
+                              'width', 'height'))
+    with Image.open(filepath) as image:
+        (metadata['width'], metadata['height']) = image.size
+        exif_data = image._getexif() if hasattr(image, '_getexif') else None
+    if exif_data is None:
+        return metadata
+    # Map numeric tag IDs to names
+    tagged = {}
+    for tag_id, value in exif_data.items():
+        tag_name = TAGS.get(tag_id, '')
+        if tag_name in _RELEVANT_TAGS:
+            tagged[tag_name] = value
+
+    # Timestamp
+    timestamp_str = (tagged.get('DateTimeOriginal')
+                     or tagged.get('DateTime')
+                     or tagged.get('DateTimeDigitized'))
+    if timestamp_str and isinstance(timestamp_str, str):
+        try:
+            ts = time.strptime(timestamp_str, '%Y:%m:%d %H:%M:%S')
+            metadata['timestamp'] = time.mktime(ts)
+        except (ValueError, OverflowError):
+            logging.warning('Bad EXIF timestamp in %s: %s',
+                            filepath, timestamp_str)
+
+    if 'Make' in tagged:
+        metadata['camera_make'] = str(tagged['Make']).strip()
+    if 'Model' in tagged:
+        metadata['camera_model'] = str(tagged['Model']).strip()
+    if isinstance(tagged.get('Orientation'), int):
+        metadata['orientation'] = tagged['Orientation']
+    gps = tagged.get('GPSInfo')
+    if isinstance(gps, dict):
+        metadata['latitude'] = _gps_degrees(gps.get(_GPS_LATITUDE),
+                                            gps.get(_GPS_LATITUDE_REF), 'S')
+        metadata['longitude'] = _gps_degrees(gps.get(_GPS_LONGITUDE),
+                                             gps.get(_GPS_LONGITUDE_REF), 'W')
+        if metadata['latitude'] is None or metadata['longitude'] is None:
+            metadata['latitude'] = metadata['longitude'] = None
+    return metadata
+
+
+def _gps_degrees(dms, ref, negative_ref):
+    """Converts an EXIF (degrees, minutes, seconds) triple to signed
+    decimal degrees, or None if it's missing or malformed."""
+    try:
+        degrees = (float(dms[0]) + float(dms[1]) / 60
+                   + float(dms[2]) / 3600)
+    except (TypeError, ValueError, IndexError, ZeroDivisionError):
+        return None
+    if isinstance(ref, bytes):
+        ref = ref.decode('ascii', 'replace')
+    if isinstance(ref, str) and ref.strip().upper() == negative_ref:
+        degrees = -degrees
+    return degrees
+
+
+def fingerprint(stat):
+    """Returns the (size, mtime_ns, inode, device) of a stat result.
+
+    Stored for every archived file, so an unchanged fingerprint means
+    the file hasn't been touched and needn't be re-hashed.
+    """
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def physical_sort_key(path):
+    """Returns a key that sorts files into on-disk order.
+
+    Uses the physical offset of the file's first extent where the
+    filesystem reports it (FIEMAP), otherwise the inode number, which
+    roughly follows allocation order.  Raises OSError if the file can't
+    be opened.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        stat = os.fstat(fd)
+        buf = bytearray(_FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+                        + bytes(_FIEMAP_EXTENT_SIZE))
+        try:
+            fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf)
+        except OSError:
+            return (stat.st_dev, 0, stat.st_ino)
+    finally:
+        os.close(fd)
+    physical = 0
+    if _FIEMAP_HEADER.unpack_from(buf)[3]:
+        # fe_physical follows fe_logical in the first extent.
+        physical = struct.unpack_from('=Q', buf, _FIEMAP_HEADER.size + 8)[0]
+    return (stat.st_dev, physical, stat.st_ino)
+
+
+def parse_date(text):
+    """Parses YYYY-MM-DD as local midnight, in epoch seconds."""
+    return int(time.mktime(time.strptime(text, '%Y-%m-%d')))
+
+
+def archive_dir(lib_base_dir, timestamp, day_dir=False):
+    """Returns the archive directory for a photo taken at timestamp:
+    <lib_base_dir>/photos/YYYY/MM_Monthname, or MM_Monthname/DD with
+    day_dir."""
+    time_struct = time.localtime(timestamp)
+    month_dir = os.path.join(lib_base_dir, 'photos', '%04d' % time_struct[0],
+                             month_dir_name(time_struct[1]))
+    if day_dir:
+        return os.path.join(month_dir, '%02d' % time_struct[2])
+    return month_dir
+
+
+def _month_bounds(timestamp):
+    """Returns the (start, end) timestamps of the local calendar month
+    holding timestamp."""
+    (year, month) = time.localtime(timestamp)[:2]
+    (next_year, next_month) = (year + month // 12, month % 12 + 1)
+    return (int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1))),
+            int(time.mktime((next_year, next_month, 1, 0, 0, 0, 0, 0, -1))))
+
+
+class ArchiveLayout():
+    """Decides which archive directory each photo goes in.
+
+    Photos go in YYYY/MM_Monthname (see archive_dir()).  With
+    day_dirs_after, a month holding more photos than that gets one DD
+    directory per day instead, so that no directory grows to tens of
+    thousands of entries.  A month crosses the threshold during an ingest:
+    the photos archived before then stay in the month directory until
+    relayout.py moves them.
+
+    Month sizes are counted in the repository once per month and then
+    kept up to date by directory(new=True), until forget().
+    """
+
+    def __init__(self, rep, lib_base_dir, day_dirs_after=None):
+        self.rep = rep
+        self.lib_base_dir = lib_base_dir
+        self.day_dirs_after = day_dirs_after
+        # Month start timestamp -> photos in that month.
+        self._month_counts = {}
+
+    def directory(self, timestamp, new=False):
+        """Returns the archive directory for a photo taken at timestamp.
+
+        new counts the photo in its month first, for photos about to be
+        archived.
+        """
+        timestamp = timestamp or 0
+        if not self.day_dirs_after:
+            return archive_dir(self.lib_base_dir, timestamp)
+        (start, end) = _month_bounds(timestamp)
+        count = self._month_counts.get(start)
+        if count is None:
+            count = self.rep.con.execute(
+                'SELECT count(*) FROM photos WHERE timestamp >= ? AND '
+                'timestamp < ?', (start, end)).fetchone()[0]
+        if new:
+            count += 1
+        self._month_counts[start] = count
+        return archive_dir(self.lib_base_dir, timestamp,
+                           day_dir=count > self.day_dirs_after)
+
+    def forget(self):
+        """Drops the month sizes counted so far, to count them again,
+        e.g. after photos counted by directory(new=True) were rolled
+        back."""
+        self._month_counts.clear()
+
+
+def month_dir_name(month):
+    """Returns a month identifier for a given decimal month"""
+    return "%02d_%s" % (month, calendar.month_name[month])
+
+
 def get_group_id(group_name):
     """Returns the group id for the given group name"""
     if group_name:
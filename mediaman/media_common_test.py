@@ -4,7 +4,9 @@ import logging
 import os
 import os.path
 import media_common
+import shutil
 import sqlite3
+import tempfile
 import time
 import unittest
 from unittest.mock import *
@@ -22,13 +24,15 @@ class TestRepository(unittest.TestCase):
         access.return_value = True
         conn_mock = Mock()
         cur_mock = Mock()
+        cur_mock.execute.return_value = []
         conn_mock.cursor.return_value = cur_mock
         connect.return_value = conn_mock
         self.rep.open('/tmp/bar')
         access.assert_called_with('/tmp/bar/media.db', ANY)
         connect.assert_called_with('/tmp/bar/media.db')
-        self.assertFalse(conn_mock.cursor.called,
-                         'expect cursor not needed for existing database')
+        statements = [c.args[0].lower() for c in cur_mock.execute.call_args_list]
+        self.assertFalse([q for q in statements if 'create table' in q],
+                         'expect no table created for existing database')
         self.assertTrue(tree_setup.called,
                         'expect tree_setup always called')
 
@@ -51,6 +55,375 @@ class TestRepository(unittest.TestCase):
         self.assertTrue(tree_setup.called,
                         'expect tree_setup always called')
 
+    def test_open_upgrades_old_schema(self):
+        """Opening a database with the original schema adds new columns."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            con = sqlite3.connect(os.path.join(tmpdir, 'media.db'))
+            con.execute('''create table photos
+                (id integer primary key, flags text, md5 varchar(32),
+                size integer, description text, source_info text,
+                archive_path text, timestamp integer, camera_make text,
+                camera_model text, unique (md5) on conflict replace)''')
+            con.execute("INSERT INTO photos (md5, size, archive_path) "
+                        "VALUES ('abc', 3, '/a.jpg')")
+            con.commit()
+            con.close()
+
+            rep = media_common.Repository()
+            rep.open(tmpdir)
+            columns = {row[1] for row in
+                       rep.con.execute('PRAGMA table_info(photos)')}
+            self.assertIn('latitude', columns)
+            self.assertIn('longitude', columns)
+            self.assertEqual((1, '/a.jpg'), rep.lookup_hash('abc', size=3))
+            indexes = {row[1] for row in
+                       rep.con.execute('PRAGMA index_list(photos)')}
+            self.assertIn('photos_content_md5', indexes)
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_add_or_update_keeps_sidecar_metadata(self):
+        """Description and location are stored and survive a re-archive."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rep = media_common.Repository()
+            rep.open(tmpdir)
+            photo = media_common.Photo('/src/a.jpg')
+            photo.md5, photo.size, photo.timestamp = 'abc', 3, 0
+            photo.archive_path = '/lib/a.jpg'
+            photo.description = 'Beach'
+            photo.latitude, photo.longitude = 51.5, -0.1
+            rep.add_or_update(photo)
+            again = media_common.Photo('/src/a.jpg')
+            again.md5, again.size, again.timestamp = 'abc', 3, 0
+            again.archive_path = '/lib/a_1.jpg'
+            rep.add_or_update(again)
+            row = rep.con.execute(
+                'SELECT description, latitude, longitude, archive_path '
+                'FROM photos').fetchall()
+            self.assertEqual([('Beach', 51.5, -0.1, '/lib/a_1.jpg')], row)
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_query(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rep = media_common.Repository()
+            rep.open(tmpdir)
+            rep.con.executemany(
+                'INSERT INTO photos (md5, size, archive_path, timestamp, '
+                'camera_make, camera_model) VALUES (?, ?, ?, ?, ?, ?)',
+                [('a', 100, '/lib/photos/2010/01_January/a.jpg', 300,
+                  'Canon', 'PowerShot'),
+                 ('b', 200, '/lib/photos/2010/02_February/b.jpg', 200,
+                  'Samsung', 'Galaxy Nexus'),
+                 ('c', 300, '/lib/photos/2011/01_January/c.jpg', 100,
+                  'canon', 'powershot')])
+
+            def paths(**filters):
+                return [row['archive_path'][-5:]
+                        for row in rep.query(**filters)]
+
+            self.assertEqual(['c.jpg', 'b.jpg', 'a.jpg'], paths())
+            self.assertEqual(['c.jpg', 'a.jpg'],
+                             paths(make='CANON', model='PowerShot'))
+            self.assertEqual([], paths(make='Can'))
+            self.assertEqual(['b.jpg'], paths(since=150, before=300))
+            self.assertEqual(['b.jpg', 'a.jpg'],
+                             paths(path_prefix='/lib/photos/2010/'))
+            self.assertEqual(['b.jpg'], paths(min_size=150, max_size=250))
+            self.assertEqual(2, rep.count(make='canon'))
+            self.assertEqual([{'md5': 'c', 'size': 300}], list(
+                rep.query(columns=('md5', 'size'), limit=1)))
+            self.assertRaises(ValueError, list,
+                              rep.query(columns=('md5; DROP',)))
+            self.assertEqual(['c.jpg', 'b.jpg'], paths(limit=2))
+            self.assertEqual([], paths(limit=0))
+            self.assertEqual([], paths(make='Leica'))
+            self.assertEqual(0, rep.count(make='Leica'))
+            plan = ' '.join(row[3] for row in rep.con.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM photos WHERE '
+                'camera_make = ? COLLATE NOCASE', ['canon']))
+            self.assertIn('photos_camera', plan)
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_query_path_prefix_bounds(self):
+        """The prefix range holds every path that starts with the prefix,
+        whatever follows it, and nothing else."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rep = media_common.Repository()
+            rep.open(tmpdir)
+            paths = ['/lib/photos/2010', '/lib/photos/2010/a.jpg',
+                     '/lib/photos/2010/\u00e9t\u00e9.jpg',
+                     '/lib/photos/2010/\U0001f600.jpg',
+                     '/lib/photos/2010/\uffff.jpg', '/lib/photos/2010a/b.jpg',
+                     '/lib/photos/2011/a.jpg', '/lib/photos/201/a.jpg']
+            rep.con.executemany(
+                'INSERT INTO photos (md5, size, archive_path) '
+                'VALUES (?, 1, ?)', list(enumerate(paths)))
+            found = sorted(row['archive_path'] for row in rep.query(
+                columns=('archive_path',), path_prefix='/lib/photos/2010/'))
+            self.assertEqual(sorted(paths[1:5]), found)
+            self.assertEqual(6, rep.count(path_prefix='/lib/photos/2010'))
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_wal_and_read_only(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertRaises(FileNotFoundError, self.rep.open, tmpdir,
+                              read_only=True)
+            self.rep.open(tmpdir)
+            self.assertEqual('wal', self.rep.con.execute(
+                'PRAGMA journal_mode').fetchone()[0])
+            self.assertEqual(60000, self.rep.con.execute(
+                'PRAGMA busy_timeout').fetchone()[0])
+            self.rep.con.execute(
+                "INSERT INTO photos (md5, size) VALUES ('a', 1)")
+            self.rep.con.commit()
+            reader = media_common.Repository()
+            reader.open(tmpdir, read_only=True)
+            self.assertRaises(sqlite3.OperationalError, reader.con.execute,
+                              "INSERT INTO photos (md5) VALUES ('b')")
+            reader.con.rollback()
+            # A reader in the middle of a read doesn't block the writer,
+            # and keeps seeing its snapshot until the read ends.
+            reader.con.execute('BEGIN')
+            self.assertEqual(1, reader.count())
+            self.rep.con.execute(
+                "INSERT INTO photos (md5, size) VALUES ('b', 2)")
+            self.rep.con.commit()
+            self.assertEqual(1, reader.count())
+            reader.con.rollback()
+            self.assertEqual(2, reader.count())
+            self.assertEqual(0, self.rep.checkpoint('TRUNCATE')[0])
+            self.assertRaises(ValueError, self.rep.checkpoint, 'SOON')
+            reader.close()
+            self.rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_only_path_needs_quoting(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lib_dir = os.path.join(tmpdir, 'a?b#c%20d')
+            self.rep.open(lib_dir)
+            self.rep.con.execute(
+                "INSERT INTO photos (md5, size) VALUES ('a', 1)")
+            self.rep.close()
+            reader = media_common.Repository()
+            reader.open(lib_dir, read_only=True)
+            self.assertEqual(1, reader.count())
+            reader.close()
+            self.assertEqual(['a?b#c%20d'], os.listdir(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_only_open_changes_nothing(self):
+        """A read-only open neither upgrades, indexes nor converts a
+        database, nor checkpoints it on close, but gets the pragmas."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tmpdir, 'media.db')
+            con = sqlite3.connect(db_path)
+            con.execute('CREATE TABLE photos (id integer primary key, '
+                        'md5 varchar(32), size integer)')
+            con.commit()
+            con.close()
+            reader = media_common.Repository()
+            reader.open(tmpdir, read_only=True)
+            pragmas = {name: reader.con.execute(
+                'PRAGMA %s' % name).fetchone()[0]
+                for name in ('journal_mode', 'busy_timeout', 'synchronous',
+                             'cache_size', 'temp_store')}
+            self.assertEqual({'journal_mode': 'delete',
+                              'busy_timeout': 60000, 'synchronous': 1,
+                              'cache_size': -65536, 'temp_store': 2},
+                             pragmas)
+            with patch.object(reader, 'checkpoint') as checkpoint:
+                reader.close()
+            checkpoint.assert_not_called()
+            con = sqlite3.connect(db_path)
+            self.assertEqual(['id', 'md5', 'size'], [
+                row[1] for row in con.execute('PRAGMA table_info(photos)')])
+            self.assertEqual([], con.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")
+                .fetchall())
+            con.close()
+            self.assertEqual(['media.db'], os.listdir(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_writer_checkpoints_on_close(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.rep.open(tmpdir)
+            reader = media_common.Repository()
+            reader.open(tmpdir, read_only=True)
+            # The reader's connection keeps the WAL from being removed.
+            reader.con.execute('SELECT count(*) FROM photos').fetchone()
+            self.rep.con.executemany(
+                'INSERT INTO photos (md5, size) VALUES (?, 1)',
+                [(str(i),) for i in range(100)])
+            self.rep.con.commit()
+            wal_path = os.path.join(tmpdir, 'media.db-wal')
+            self.assertGreater(os.path.getsize(wal_path), 0)
+            with patch.object(self.rep, 'checkpoint',
+                              wraps=self.rep.checkpoint) as checkpoint:
+                self.rep.close()
+            checkpoint.assert_called_once_with()
+            self.assertEqual(100, reader.count())
+            # Checkpointed: the WAL is reused from the start, and TRUNCATE
+            # empties it.
+            writer = media_common.Repository()
+            writer.open(tmpdir)
+            (busy, _wal_pages, _done) = writer.checkpoint('TRUNCATE')
+            self.assertEqual(0, busy)
+            self.assertEqual(0, os.path.getsize(wal_path))
+            writer.close()
+            reader.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_archive_layout(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.rep.open(tmpdir)
+            july_2 = time.mktime((2012, 7, 2, 12, 0, 0, 0, 0, -1))
+            for (md5, timestamp) in (('a', july_2 - 86400), ('b', july_2),
+                                     ('c', july_2 + 60)):
+                self.rep.con.execute(
+                    'INSERT INTO photos (md5, size, timestamp) '
+                    'VALUES (?, 1, ?)', (md5, timestamp))
+            month_dir = os.path.join(tmpdir, 'photos', '2012', '07_July')
+            self.assertIsNone(
+                self.rep.archive_layout(tmpdir).day_dirs_after)
+            self.rep.set_day_dirs_after(3)
+            layout = self.rep.archive_layout(tmpdir)
+            self.assertEqual(3, layout.day_dirs_after)
+            self.assertEqual(month_dir, layout.directory(july_2))
+            # The fourth photo of the month is the first in a day directory.
+            self.assertEqual(os.path.join(month_dir, '02'),
+                             layout.directory(july_2, new=True))
+            self.assertEqual(os.path.join(month_dir, '02'),
+                             layout.directory(july_2))
+            august = time.mktime((2012, 8, 1, 0, 0, 0, 0, 0, -1))
+            self.assertEqual(
+                os.path.join(tmpdir, 'photos', '2012', '08_August'),
+                layout.directory(august, new=True))
+            self.assertEqual(
+                (int(time.mktime((2012, 12, 1, 0, 0, 0, 0, 0, -1))),
+                 int(time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, -1)))),
+                media_common._month_bounds(
+                    time.mktime((2012, 12, 31, 23, 0, 0, 0, 0, -1))))
+            self.rep.set_day_dirs_after(0)
+            self.assertEqual(month_dir, self.rep.archive_layout(
+                tmpdir).directory(july_2, new=True))
+        finally:
+            self.rep.close()
+            shutil.rmtree(tmpdir)
+
+    def test_sync_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.rep.open(tmpdir)
+            month_dir = os.path.join(tmpdir, 'photos', '2012', '07_July')
+            os.makedirs(month_dir)
+            files = []
+            for name in ('a', 'b', 'c'):
+                for path in (os.path.join(month_dir, name + '.jpg'),
+                             os.path.join(tmpdir, name + '.src')):
+                    open(path, 'w').close()
+                files.append((os.path.join(month_dir, name + '.jpg'),
+                              os.path.join(tmpdir, name + '.src')))
+            rolled_back = Mock()
+            batch = media_common.SyncBatch(self.rep.con, tmpdir, size=3,
+                                           on_rollback=rolled_back)
+            self.assertEqual(2, self.rep.con.execute(
+                'PRAGMA synchronous').fetchone()[0])
+            with patch('os.fsync', wraps=os.fsync) as fsync:
+                batch.add(*files[0])
+                self.rep.con.execute(
+                    "INSERT INTO photos (md5, size) VALUES ('a', 1)")
+                batch.add(*files[1])
+                self.assertEqual(0, fsync.call_count)
+                self.assertTrue(os.path.exists(files[0][1]))
+                self.assertTrue(self.rep.con.in_transaction)
+                batch.add(source=files[2][1])
+                # Two files and the four directories up to the library.
+                self.assertEqual(6, fsync.call_count)
+            self.assertFalse(self.rep.con.in_transaction)
+            rolled_back.assert_not_called()
+            for (_copy, source) in files:
+                self.assertFalse(os.path.exists(source))
+
+            open(files[0][1], 'w').close()
+            batch.add(*files[0])
+            self.rep.con.execute(
+                "INSERT INTO photos (md5, size) VALUES ('b', 1)")
+            with patch('os.fsync', side_effect=OSError(5, 'EIO')):
+                self.assertEqual(0, batch.flush())
+            rolled_back.assert_called_once_with()
+            self.assertTrue(os.path.exists(files[0][1]))
+            # The unsynced copy and its row are gone.
+            self.assertFalse(os.path.exists(files[0][0]))
+            self.assertEqual(1, self.rep.con.execute(
+                'SELECT count(*) FROM photos').fetchone()[0])
+
+            unsynced = media_common.SyncBatch(self.rep.con, tmpdir, size=0)
+            with patch('os.fsync') as fsync:
+                unsynced.add(*files[0])
+                self.assertTrue(os.path.exists(files[0][1]))
+                self.assertEqual(1, unsynced.flush())
+                fsync.assert_not_called()
+        finally:
+            self.rep.close()
+            shutil.rmtree(tmpdir)
+
+    def test_ingest_failures(self):
+        con = sqlite3.connect(':memory:')
+        failures = media_common.IngestFailures(con, backoff=100,
+                                               max_backoff=300)
+        self.assertFalse(failures.backing_off('k', now=1000))
+        self.assertEqual(1, failures.record('k', '/a', 'boom', now=1000))
+        self.assertTrue(failures.backing_off('k', now=1099))
+        self.assertFalse(failures.backing_off('k', now=1100))
+        self.assertEqual(2, failures.record('k', '/a', 'boom', now=1100))
+        self.assertTrue(failures.backing_off('k', now=1299))
+        failures.record('k', '/a', 'boom', now=1300)
+        # Capped at max_backoff.
+        self.assertFalse(failures.backing_off('k', now=1600))
+        # Reloaded from the database.
+        failures = media_common.IngestFailures(con)
+        self.assertIn('k', failures)
+        failures.clear('k')
+        self.assertNotIn('k', failures)
+        self.assertEqual([], con.execute(
+            'SELECT * FROM ingest_failures').fetchall())
+
+    def test_run_lock(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'job.lock')
+            first = media_common.RunLock(path)
+            second = media_common.RunLock(path)
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+            self.assertEqual('%d' % os.getpid(),
+                             second.holder().split()[-1])
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+        finally:
+            shutil.rmtree(tmpdir)
+
     @patch('os.mkdir')
     def test_tree_setup(self, mkdir):
         media_common.Repository()._tree_setup('/tmp/foo')
@@ -127,6 +500,216 @@ class TestRepository(unittest.TestCase):
         self.assertEqual({'md5': 'abc', 'size': 12345}, call_args[1])
 
 
+class TestJobLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.con = sqlite3.connect(':memory:')
+        self.ledger = media_common.JobLedger(self.con, 'job')
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_add_and_contains(self):
+        self.assertNotIn(1, self.ledger)
+        self.ledger.add(1, 'fixed')
+        self.ledger.commit()
+        self.assertIn(1, self.ledger)
+        self.assertIn('1', self.ledger)
+        self.assertEqual({'1'}, self.ledger.items())
+
+    def test_jobs_are_separate(self):
+        self.ledger.add('a')
+        other = media_common.JobLedger(self.con, 'other')
+        self.assertNotIn('a', other)
+        self.assertEqual(set(), other.items())
+
+    def test_state(self):
+        self.assertEqual(0, self.ledger.get_state('last_photo_id', 0))
+        self.ledger.set_state('last_photo_id', 42)
+        self.assertEqual('42', self.ledger.get_state('last_photo_id'))
+
+
+def _parity(n):
+    """BatchJob operation; module level so process pools can pickle it."""
+    if n < 0:
+        raise ValueError(n)
+    return 'even' if n % 2 == 0 else 'odd'
+
+
+class TestBatchJob(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('').setLevel(logging.CRITICAL)
+        self.con = sqlite3.connect(':memory:')
+        self.ledger = media_common.JobLedger(self.con, 'job')
+
+    def tearDown(self):
+        self.con.close()
+
+    def test_run_counts_statuses(self):
+        results = []
+        job = media_common.BatchJob('job', _parity)
+        counts = job.run(range(10),
+                         on_result=lambda item, status, value:
+                         results.append((item, status)))
+        self.assertEqual({'even': 5, 'odd': 5}, counts)
+        self.assertEqual(sorted((n, _parity(n)) for n in range(10)),
+                         sorted(results))
+
+    def test_errors_are_counted_not_raised(self):
+        job = media_common.BatchJob('job', _parity, ledger=self.ledger)
+        counts = job.run([1, -1, 2])
+        self.assertEqual({'odd': 1, 'even': 1, 'error': 1}, counts)
+        self.assertEqual({'1', '2'}, self.ledger.items())
+
+    def test_resumes_from_ledger(self):
+        seen = []
+
+        def interrupt_after_three(item, status, value):
+            seen.append(item)
+            if len(seen) == 3:
+                raise KeyboardInterrupt
+
+        job = media_common.BatchJob('job', _parity, ledger=self.ledger,
+                                    checkpoint_every=1000)
+        self.assertRaises(KeyboardInterrupt, job.run, range(6),
+                          on_result=interrupt_after_three)
+        # Everything handled before the interruption was committed; the
+        # item being handled when it came is not recorded.
+        self.assertEqual({str(n) for n in seen[:2]}, self.ledger.items())
+
+        calls = []
+
+        def operation(n):
+            calls.append(n)
+            return 'ok'
+
+        counts = media_common.BatchJob('job', operation, ledger=self.ledger
+                                       ).run(range(6))
+        self.assertEqual({'already_done': 2, 'ok': 4}, counts)
+        self.assertEqual(sorted(set(range(6)) - set(seen[:2])),
+                         sorted(calls))
+
+    def test_values_and_checkpoints(self):
+        values = []
+        checkpoints = []
+
+        def operation(n):
+            return ('ok', n * n)
+
+        job = media_common.BatchJob('job', operation, ledger=self.ledger,
+                                    checkpoint_every=2)
+        job.run(range(5),
+                on_result=lambda item, status, value: values.append(value),
+                on_checkpoint=lambda: checkpoints.append(len(values)))
+        self.assertEqual([0, 1, 4, 9, 16], sorted(values))
+        self.assertEqual([2, 4, 5], checkpoints)
+
+    def test_process_pool(self):
+        job = media_common.BatchJob('job', _parity, workers=2,
+                                    processes=True)
+        self.assertEqual({'even': 3, 'odd': 2}, job.run(range(5)))
+
+    def test_rate_limiter_is_applied(self):
+        limiter = Mock()
+        job = media_common.BatchJob('job', _parity, rate_limiter=limiter,
+                                    size_of=lambda n: n * 10)
+        job.run([1, 2, 3])
+        self.assertEqual([call(10), call(20), call(30)],
+                         limiter.acquire.call_args_list)
+
+    def test_walk_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'a', 'b'))
+            for name in ('x', 'a/y', 'a/b/z'):
+                open(os.path.join(tmpdir, name), 'w').close()
+            self.assertEqual(
+                sorted(os.path.join(tmpdir, name)
+                       for name in ('x', 'a/y', 'a/b/z')),
+                sorted(media_common.walk_files(tmpdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_open_ledger(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tmpdir, 'state', 'jobs.db')
+            ledger = media_common.open_ledger('job', db_path)
+            ledger.add('item')
+            ledger.close()
+            ledger = media_common.open_ledger('job', db_path)
+            self.assertIn('item', ledger)
+            ledger.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    @patch('time.sleep')
+    @patch('time.monotonic')
+    def test_ops_limit(self, monotonic, sleep):
+        monotonic.return_value = 100.0
+        limiter = media_common.RateLimiter(ops_per_sec=2)
+
+        def advance(seconds):
+            monotonic.return_value += seconds
+        sleep.side_effect = advance
+
+        for _ in range(4):
+            limiter.acquire()
+        # Two operations fit in the initial burst, the next two wait
+        # half a second each.
+        self.assertEqual([call(0.5), call(0.5)], sleep.call_args_list)
+
+    @patch('time.sleep')
+    @patch('time.monotonic')
+    def test_bytes_limit_allows_large_items(self, monotonic, sleep):
+        monotonic.return_value = 100.0
+        limiter = media_common.RateLimiter(bytes_per_sec=1000)
+
+        def advance(seconds):
+            monotonic.return_value += seconds
+        sleep.side_effect = advance
+
+        limiter.acquire(3000)
+        sleep.assert_not_called()
+        # The 3000-byte item is paid back before the next one goes.
+        limiter.acquire(10)
+        self.assertAlmostEqual(2.01, sum(c.args[0] for c in
+                                         sleep.call_args_list))
+
+
+class TestPhysicalSortKey(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'a.jpg')
+        with open(self.path, 'wb') as fh:
+            fh.write(b'x' * 8192)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_key(self):
+        stat = os.stat(self.path)
+        key = media_common.physical_sort_key(self.path)
+        self.assertEqual((stat.st_dev, stat.st_ino), (key[0], key[2]))
+
+    @patch('fcntl.ioctl', side_effect=OSError(95, 'not supported'))
+    def test_falls_back_to_inode(self, _ioctl):
+        stat = os.stat(self.path)
+        self.assertEqual((stat.st_dev, 0, stat.st_ino),
+                         media_common.physical_sort_key(self.path))
+
+    def test_missing_file(self):
+        self.assertRaises(OSError, media_common.physical_sort_key,
+                          os.path.join(self.tmpdir, 'missing.jpg'))
+
+
 class TestPhoto(unittest.TestCase):
 
     def setUp(self):
@@ -165,6 +748,40 @@ class TestPhoto(unittest.TestCase):
         self.photo._load_filesystem_timestamp()
         self.assertEqual(self.timestamp, self.photo.timestamp)
 
+    @patch('os.path.getmtime')
+    def test_sidecar_timestamp_used_without_exif(self, getmtime):
+        getmtime.return_value = 0
+        self.photo.sidecar_timestamp = self.timestamp
+        self.photo._load_sidecar_timestamp()
+        self.photo._load_filesystem_timestamp()
+        self.assertEqual(self.timestamp, self.photo.timestamp)
+        self.assertTrue(self.photo.timestamp_from_sidecar())
+
+    def test_exif_timestamp_wins_over_sidecar(self):
+        self.photo.timestamp = self.timestamp
+        self.photo.sidecar_timestamp = 0
+        self.photo._load_sidecar_timestamp()
+        self.assertEqual(self.timestamp, self.photo.timestamp)
+        self.assertFalse(self.photo.timestamp_from_sidecar())
+
+    @patch('media_types.read_video_metadata')
+    def test_sidecar_timestamp_wins_over_video_header(self, read_video):
+        read_video.side_effect = lambda _path: dict(
+            dict.fromkeys(('camera_make', 'camera_model', 'latitude',
+                           'longitude', 'orientation', 'width', 'height')),
+            timestamp=self.timestamp + 3600)
+        self.photo.media_type = ('video', 'mp4')
+        self.photo.media_type_known = True
+        self.photo.sidecar_timestamp = self.timestamp
+        self.photo._load_exif_metadata()
+        self.photo._load_sidecar_timestamp()
+        self.assertEqual(self.timestamp, self.photo.timestamp)
+        # Without a sidecar, the movie header wins over the mtime.
+        self.photo.timestamp = None
+        self.photo.sidecar_timestamp = None
+        self.photo._load_exif_metadata()
+        self.assertEqual(self.timestamp + 3600, self.photo.timestamp)
+
     @patch('os.path.getmtime')
     def test_load_filesystem_timestamp_none(self, getmtime):
         self.photo.timestamp = None
@@ -0,0 +1,165 @@
+"""Telling media files from everything else by their first bytes.
+
+classify() reads one small block from the start of a file and matches it
+against the signatures of the image, raw, video and audio formats that
+cameras and phones produce.  It is cheap enough to run on every staged
+file before anything is hashed or opened with Pillow, so sidecars,
+Thumbs.db, desktop.ini and the like never reach the ingest.  The result
+also picks the metadata reader: Pillow for images, the QuickTime movie
+header for ISO-BMFF video.
+"""
+import os.path
+import struct
+
+IMAGE = 'image'
+RAW = 'raw'
+VIDEO = 'video'
+AUDIO = 'audio'
+
+# Enough for every signature below, including MPEG-TS sync bytes.
+HEADER_SIZE = 512
+
+# Raw formats that are plain TIFF files inside, told apart only by name.
+_TIFF_RAW_EXTENSIONS = frozenset((
+    '.3fr', '.arw', '.dcr', '.dng', '.erf', '.iiq', '.k25', '.kdc', '.mef',
+    '.mos', '.nef', '.nrw', '.pef', '.sr2', '.srf', '.srw'))
+
+# ISO base media (ftyp) major brands that aren't plain video.
+_FTYP_BRANDS = {
+    b'heic': (IMAGE, 'heic'), b'heix': (IMAGE, 'heic'),
+    b'heim': (IMAGE, 'heic'), b'heis': (IMAGE, 'heic'),
+    b'hevc': (IMAGE, 'heic'), b'mif1': (IMAGE, 'heif'),
+    b'msf1': (IMAGE, 'heif'), b'avif': (IMAGE, 'avif'),
+    b'crx ': (RAW, 'cr3'), b'qt  ': (VIDEO, 'mov'),
+    b'M4A ': (AUDIO, 'm4a'), b'M4B ': (AUDIO, 'm4a'),
+}
+
+# Top-level QuickTime atoms that start a .mov written without ftyp.
+_QUICKTIME_ATOMS = frozenset((b'moov', b'mdat', b'wide', b'free', b'skip',
+                              b'pnot'))
+
+# Seconds from the QuickTime epoch (1904-01-01) to the Unix epoch.
+_QUICKTIME_EPOCH = 2082844800
+
+# (offset, signature, (kind, format)), tried in order.
+_SIGNATURES = (
+    (0, b'\xff\xd8\xff', (IMAGE, 'jpeg')),
+    (0, b'\x89PNG\r\n\x1a\n', (IMAGE, 'png')),
+    (0, b'GIF87a', (IMAGE, 'gif')),
+    (0, b'GIF89a', (IMAGE, 'gif')),
+    (0, b'FUJIFILMCCD-RAW', (RAW, 'raf')),
+    (0, b'IIRO', (RAW, 'orf')),
+    (0, b'IIRS', (RAW, 'orf')),
+    (0, b'MMOR', (RAW, 'orf')),
+    (0, b'IIU\x00', (RAW, 'rw2')),
+    (0, b'\x00MRM', (RAW, 'mrw')),
+    (0, b'FOVb', (RAW, 'x3f')),
+    (0, b'II\x1a\x00\x00\x00HEAPCCDR', (RAW, 'crw')),
+    (0, b'\x1aE\xdf\xa3', (VIDEO, 'mkv')),
+    (0, b'\x00\x00\x01\xba', (VIDEO, 'mpg')),
+    (0, b'0&\xb2u\x8ef\xcf\x11', (VIDEO, 'wmv')),
+    (0, b'FLV\x01', (VIDEO, 'flv')),
+    (0, b'ID3', (AUDIO, 'mp3')),
+    (0, b'OggS', (AUDIO, 'ogg')),
+    (0, b'fLaC', (AUDIO, 'flac')),
+)
+
+
+def sniff(header, filename=''):
+    """Returns the (kind, format) of a file that starts with header, or
+    None if it isn't a known media format.
+
+    kind is IMAGE, RAW, VIDEO or AUDIO.  filename is only used to tell
+    TIFF-based raw formats from plain TIFF.
+    """
+    for (offset, signature, result) in _SIGNATURES:
+        if header.startswith(signature, offset):
+            return result
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        extension = os.path.splitext(filename)[1].lower()
+        if header[8:10] == b'CR':
+            return (RAW, 'cr2')
+        if extension in _TIFF_RAW_EXTENSIONS:
+            return (RAW, extension[1:])
+        return (IMAGE, 'tiff')
+    if header[4:8] == b'ftyp':
+        return _FTYP_BRANDS.get(header[8:12], (VIDEO, 'mp4'))
+    if header[4:8] in _QUICKTIME_ATOMS:
+        return (VIDEO, 'mov')
+    if header[:4] == b'RIFF':
+        return {b'WEBP': (IMAGE, 'webp'), b'AVI ': (VIDEO, 'avi'),
+                b'WAVE': (AUDIO, 'wav')}.get(header[8:12])
+    # MPEG transport streams: sync byte every 188 bytes, or every 192
+    # with the 4-byte timecode of AVCHD .mts files.
+    if header[0:1] == header[188:189] == header[376:377] == b'G':
+        return (VIDEO, 'ts')
+    if header[4:5] == header[196:197] == header[388:389] == b'G':
+        return (VIDEO, 'mts')
+    if header[:2] == b'BM' and filename.lower().endswith('.bmp'):
+        return (IMAGE, 'bmp')
+    return None
+
+
+def classify(path):
+    """Returns the (kind, format) of the file at path, or None for
+    anything that isn't media.  Raises OSError if it can't be read."""
+    with open(path, 'rb') as fh:
+        header = fh.read(HEADER_SIZE)
+    return sniff(header, os.path.basename(path))
+
+
+def _boxes(fh, end):
+    """Yields (type, payload offset, payload size) of the ISO-BMFF boxes
+    from the current position of fh up to offset end."""
+    position = fh.tell()
+    while position + 8 <= end:
+        fh.seek(position)
+        header = fh.read(16)
+        if len(header) < 8:
+            return
+        (size, box_type) = struct.unpack('>I4s', header[:8])
+        payload = position + 8
+        if size == 1 and len(header) == 16:
+            size = struct.unpack('>Q', header[8:])[0]
+            payload += 8
+        elif size == 0:
+            size = end - position
+        if size < payload - position:
+            return
+        yield (box_type, payload, position + size - payload)
+        position += size
+
+
+def read_video_metadata(path):
+    """Reads the capture time of an MP4 or QuickTime video.
+
+    Returns a dict shaped like media_common.read_image_metadata()'s,
+    with timestamp set from the creation time in the movie header (mvhd)
+    if the file records one.  The format says UTC, but many cameras write
+    their local time there.  Only box headers are read: the media data
+    is skipped over, wherever the moov box is.
+    """
+    metadata = dict.fromkeys(('timestamp', 'camera_make', 'camera_model',
+                              'latitude', 'longitude', 'orientation',
+                              'width', 'height'))
+    with open(path, 'rb') as fh:
+        end = os.fstat(fh.fileno()).st_size
+        for (box_type, offset, size) in _boxes(fh, end):
+            if box_type != b'moov':
+                continue
+            fh.seek(offset)
+            for (child_type, child_offset, _size) in _boxes(fh,
+                                                            offset + size):
+                if child_type != b'mvhd':
+                    continue
+                fh.seek(child_offset)
+                header = fh.read(12)
+                if header[:1] == b'\x01':
+                    created = struct.unpack('>Q', header[4:12])[0]
+                else:
+                    created = struct.unpack('>I', header[4:8])[0]
+                # Many cameras leave it 0 (1904) when their clock isn't set.
+                if created > _QUICKTIME_EPOCH:
+                    metadata['timestamp'] = created - _QUICKTIME_EPOCH
+                return metadata
+    return metadata
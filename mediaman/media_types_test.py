@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import shutil
+import struct
+import tempfile
+import unittest
+
+import media_types
+
+
+def _box(box_type, payload):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _mvhd(version, created):
+    if version:
+        return _box(b'mvhd', b'\x01\x00\x00\x00'
+                    + struct.pack('>QQ', created, created) + b'\x00' * 20)
+    return _box(b'mvhd', b'\x00\x00\x00\x00'
+                + struct.pack('>II', created, created) + b'\x00' * 20)
+
+
+class MediaTypesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        self.testdir = os.path.join(scriptdir, 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+    def test_sniff_media(self):
+        cases = [
+            (b'\xff\xd8\xff\xe1\x00\x10Exif', '', ('image', 'jpeg')),
+            (b'\x89PNG\r\n\x1a\n\x00\x00', '', ('image', 'png')),
+            (b'II*\x00\x10\x00\x00\x00CR\x02\x00', 'a.CR2', ('raw', 'cr2')),
+            (b'II*\x00\x08\x00\x00\x00', 'a.NEF', ('raw', 'nef')),
+            (b'MM\x00*\x00\x00\x00\x08', 'scan.tif', ('image', 'tiff')),
+            (b'FUJIFILMCCD-RAW 0201', '', ('raw', 'raf')),
+            (b'II\x1a\x00\x00\x00HEAPCCDR\x02\x00', 'CRW_0001.CRW',
+             ('raw', 'crw')),
+            (b'\x00\x00\x00\x18ftypheic\x00\x00', '', ('image', 'heic')),
+            (b'\x00\x00\x00\x18ftypcrx \x00\x00', '', ('raw', 'cr3')),
+            (b'\x00\x00\x00\x18ftypmp42\x00\x00', '', ('video', 'mp4')),
+            (b'\x00\x00\x00\x14ftypqt  \x00\x00', '', ('video', 'mov')),
+            (b'\x00\x00\x00\x08wide\x00\x00', '', ('video', 'mov')),
+            (b'RIFF\x00\x00\x00\x00AVI LIST', '', ('video', 'avi')),
+            (b'RIFF\x00\x00\x00\x00WEBPVP8 ', '', ('image', 'webp')),
+            (b'\x1aE\xdf\xa3\x01\x00', '', ('video', 'mkv')),
+            ((b'\x00\x00\x00\x00G' + b'\x00' * 187) * 3, 'a.MTS',
+             ('video', 'mts')),
+        ]
+        for (header, name, expected) in cases:
+            self.assertEqual(expected, media_types.sniff(header, name),
+                             header[:16])
+
+    def test_sniff_non_media(self):
+        for (header, name) in [
+                (b'{"title": "IMG_0001.jpg"', 'IMG_0001.jpg.json'),
+                (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'Thumbs.db'),
+                (b'\xff\xfe[\x00.\x00S\x00', 'desktop.ini'),
+                (b'RIFF\x00\x00\x00\x00WAVX', 'x.wav'),
+                (b'BM not really', 'notes.txt'),
+                (b'', 'empty.jpg')]:
+            self.assertIsNone(media_types.sniff(header, name), name)
+
+    def test_classify_files(self):
+        self.assertEqual(('image', 'jpeg'), media_types.classify(
+            os.path.join(self.testdir, 'DSC09012.JPG')))
+        self.assertIsNone(media_types.classify(
+            self._write('IMG_1.jpg.json', b'{}')))
+        self.assertRaises(OSError, media_types.classify,
+                          os.path.join(self.tmpdir, 'missing'))
+
+    def test_read_video_metadata(self):
+        created = 1341000000 + 2082844800
+        ftyp = _box(b'ftyp', b'qt  \x00\x00\x00\x00qt  ')
+        # moov after a large mdat, as most cameras write it.
+        mdat = _box(b'mdat', b'\x00' * 100000)
+        path = self._write('v0.mov', ftyp + mdat + _box(
+            b'moov', _box(b'udta', b'') + _mvhd(0, created)))
+        self.assertEqual(1341000000, media_types.read_video_metadata(
+            path)['timestamp'])
+        path = self._write('v1.mp4', ftyp + _box(b'moov', _mvhd(1, created))
+                           + mdat)
+        self.assertEqual(1341000000, media_types.read_video_metadata(
+            path)['timestamp'])
+        # A camera without a set clock writes 0 (1904).
+        path = self._write('unset.mov', ftyp + _box(b'moov', _mvhd(0, 0)))
+        self.assertIsNone(media_types.read_video_metadata(path)['timestamp'])
+        path = self._write('truncated.mov', ftyp + mdat[:50])
+        self.assertIsNone(media_types.read_video_metadata(path)['timestamp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Collision-free file names for copies into shared directories.
+
+A file copied into a directory that already holds its name is stored as
+``stem_1.ext``, ``stem_2.ext`` and so on.  Finding the next free suffix
+by trying each name in turn costs one ``open`` per taken name, which adds
+up to quadratic work when hundreds of ``IMG_0001.JPG`` land in one flat
+staging directory.  ``NameAllocator`` lists a directory once, the first
+time a name in it is taken, and from then on hands out the next suffix
+directly.
+
+This module only depends on the standard library so it can be bundled
+into the Windows ``photocoll.exe`` alongside ``takeout_fixer``.
+"""
+import os
+import re
+import threading
+
+# Flags for creating a copy: fail rather than overwrite.
+_CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+
+_SUFFIXED = re.compile(r'(.*)_(\d+)$', re.DOTALL)
+
+
+class NameAllocator:
+    """Creates files under free names, ``name`` or ``stem_N.ext``.
+
+    The highest suffix in use for each stem and extension is learned from
+    one listing of the directory and kept up to date as names are handed
+    out, so a clash costs O(1) calls instead of one per taken name.  Every
+    file is still created with ``O_EXCL``: a name that another process took
+    after the listing is simply skipped, never overwritten.  Thread-safe.
+
+    Unlike trying ``_1``, ``_2``, ... in turn, gaps left by deleted files
+    are not reused; the new name always gets the next suffix above the
+    highest one seen.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (directory, stem, extension) -> highest suffix in use, 0 if only
+        # the plain name is.
+        self._highest: dict[tuple[str, str, str], int] = {}
+        self._listed: set[str] = set()
+
+    def create(self, dest_dir: str, filename: str,
+               mode: int = 0o644) -> tuple[int, str]:
+        """Create a new file in *dest_dir* named *filename*, or the next
+        free ``stem_N.ext`` if that is taken.
+
+        Returns ``(fd, path)`` of the new, empty file, open for writing.
+        """
+        path = os.path.join(dest_dir, filename)
+        try:
+            return (os.open(path, _CREATE_FLAGS, mode), path)
+        except FileExistsError:
+            pass
+        (stem, ext) = os.path.splitext(filename)
+        while True:
+            counter = self._reserve(dest_dir, stem, ext)
+            path = os.path.join(dest_dir, f'{stem}_{counter}{ext}')
+            try:
+                return (os.open(path, _CREATE_FLAGS, mode), path)
+            except FileExistsError:
+                # Taken since the listing; the next suffix is free.
+                continue
+
+    def forget(self) -> None:
+        """Forget every listing, so that each directory is listed again
+        on its next clash, e.g. after files named here were removed."""
+        with self._lock:
+            self._highest.clear()
+            self._listed.clear()
+
+    def _reserve(self, dest_dir: str, stem: str, ext: str) -> int:
+        """Return the next unused suffix for *stem* and *ext*."""
+        with self._lock:
+            if dest_dir not in self._listed:
+                self._list(dest_dir)
+            key = (dest_dir, stem, ext)
+            counter = self._highest.get(key, 0) + 1
+            self._highest[key] = counter
+            return counter
+
+    def _list(self, dest_dir: str) -> None:
+        """Record the suffixes of every name in *dest_dir*."""
+        self._listed.add(dest_dir)
+        try:
+            names = os.listdir(dest_dir)
+        except OSError:
+            return
+        highest = self._highest
+        for name in names:
+            (stem, ext) = os.path.splitext(name)
+            key = (dest_dir, stem, ext)
+            highest[key] = max(highest.get(key, 0), 0)
+            match = _SUFFIXED.match(stem)
+            if match:
+                key = (dest_dir, match.group(1), ext)
+                highest[key] = max(highest.get(key, 0),
+                                   int(match.group(2)))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import naming
+
+
+class NameAllocatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.names = naming.NameAllocator()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _touch(self, *names):
+        for name in names:
+            open(os.path.join(self.dir, name), 'w').close()
+
+    def _create(self, filename):
+        (fd, path) = self.names.create(self.dir, filename)
+        os.close(fd)
+        return os.path.basename(path)
+
+    def test_free_name_is_used_as_is(self):
+        self.assertEqual('a.jpg', self._create('a.jpg'))
+        self.assertEqual('a_1.jpg', self._create('a.jpg'))
+        self.assertEqual('a_2.jpg', self._create('a.jpg'))
+        self.assertEqual('b.jpg', self._create('b.jpg'))
+
+    def test_continues_after_highest_existing_suffix(self):
+        self._touch('a.jpg', 'a_1.jpg', 'a_7.jpg', 'a_3.png', 'a_b_9.jpg')
+        self.assertEqual('a_8.jpg', self._create('a.jpg'))
+        self.assertEqual('a_9.jpg', self._create('a.jpg'))
+        self._touch('a_b.jpg')
+        self.assertEqual('a_b_10.jpg', self._create('a_b.jpg'))
+        # Names that only look suffixed, like IMG_0001.JPG, still work.
+        self._touch('IMG_0001.JPG')
+        self.assertEqual('IMG_0001_1.JPG', self._create('IMG_0001.JPG'))
+
+    def test_skips_names_taken_after_the_listing(self):
+        self._touch('a.jpg')
+        self.assertEqual('a_1.jpg', self._create('a.jpg'))
+        # Another process takes the next two names behind our back.
+        self._touch('a_2.jpg', 'a_3.jpg')
+        self.assertEqual('a_4.jpg', self._create('a.jpg'))
+
+    def test_forget_lists_again(self):
+        self._touch('a.jpg')
+        self.assertEqual('a_1.jpg', self._create('a.jpg'))
+        self.assertEqual('a_2.jpg', self._create('a.jpg'))
+        for name in ('a_1.jpg', 'a_2.jpg'):
+            os.remove(os.path.join(self.dir, name))
+        self.names.forget()
+        self.assertEqual('a_1.jpg', self._create('a.jpg'))
+
+    def test_lists_directory_once(self):
+        self._touch('a.jpg')
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            for _ in range(20):
+                self._create('a.jpg')
+        self.assertEqual(1, listdir.call_count)
+        self.assertEqual(21, len(os.listdir(self.dir)))
+
+    def test_threads_get_distinct_names(self):
+        self._touch('a.jpg')
+        created = []
+
+        def create():
+            for _ in range(50):
+                created.append(self._create('a.jpg'))
+
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(200, len(set(created)))
+        self.assertEqual(201, len(os.listdir(self.dir)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Bounded parallel map helpers shared by the client and server tools.
+
+This module only depends on the standard library so it can be bundled
+into the Windows ``photocoll.exe`` alongside ``takeout_fixer``.
+"""
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (FIRST_COMPLETED, Executor, ThreadPoolExecutor,
+                                wait)
+from typing import TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def imap_unordered(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    *,
+    workers: int = 4,
+    max_pending: int | None = None,
+    executor: Executor | None = None,
+) -> Iterator[R]:
+    """Apply *fn* to each of *items* on a pool, yielding results as they finish.
+
+    *items* is consumed lazily: at most *max_pending* calls (default
+    ``2 * workers``) are in flight at once, so a generator over hundreds
+    of thousands of files never gets materialized.  Chaining two calls
+    gives a two-stage pipeline whose stages overlap, each with its own
+    bounded pool.
+
+    Exceptions raised by *fn* propagate out of the iterator; callers that
+    want to keep going after a per-item failure should catch inside *fn*.
+
+    If *executor* is given it is used instead of a private thread pool
+    and is left running on return.
+    """
+    if max_pending is None:
+        max_pending = 2 * workers
+    max_pending = max(1, max_pending)
+    pool = executor or ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for item in items:
+            pending.add(pool.submit(fn, item))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if executor is None:
+            pool.shutdown(wait=True)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Tests for parallel.py."""
+import threading
+import time
+import unittest
+
+import parallel
+
+
+class ImapUnorderedTests(unittest.TestCase):
+
+    def test_returns_every_result(self):
+        results = parallel.imap_unordered(lambda x: x * x, range(50),
+                                          workers=4)
+        self.assertEqual(sorted(results), [x * x for x in range(50)])
+
+    def test_consumes_input_lazily(self):
+        """No more than max_pending items are pulled ahead of the consumer."""
+        pulled = []
+
+        def source():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+
+        it = parallel.imap_unordered(lambda x: x, source(),
+                                     workers=2, max_pending=3)
+        next(it)
+        self.assertLessEqual(len(pulled), 4)
+        it.close()
+
+    def test_runs_concurrently(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(x):
+            with lock:
+                active.append(x)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(x)
+            return x
+
+        list(parallel.imap_unordered(work, range(12), workers=3))
+        self.assertGreater(max(peak), 1)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_propagates_exceptions(self):
+        def work(x):
+            if x == 3:
+                raise ValueError('boom')
+            return x
+
+        with self.assertRaises(ValueError):
+            list(parallel.imap_unordered(work, range(10), workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,14 +14,21 @@ Usage:
 
 import argparse
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import os
 import shutil
+import sqlite3
 import sys
+import threading
 import time
+from collections import Counter
 from pathlib import Path
 
+import naming
+import parallel
 import takeout_fixer
 
 logger = logging.getLogger(__name__)
@@ -79,6 +86,102 @@ class CollectionState:
             )
 
 
+# ---------------------------------------------------------------------------
+# ShippedLedger — remembers content already copied to staging
+# ---------------------------------------------------------------------------
+
+
+class ShippedLedger:
+    """Records which file contents have already been copied to staging.
+
+    Entries are keyed by size + MD5 (the same digest photoman stores on
+    the server) and kept in a small SQLite file, so they persist across
+    runs and across overlapping Takeout exports.  Lookups go by size
+    first: a file whose size was never shipped cannot be a duplicate and
+    is copied without hashing it up front.
+
+    Safe to share between threads.  Changes are written on save()/close().
+    Copies in flight are tracked too (see start_copy()), so that threads
+    never copy the same content twice at once.
+    """
+
+    # Number of locks that same-size files are striped across.
+    _LOCK_STRIPES = 64
+
+    def __init__(self, db_path: Path):
+        """Open or create the ledger database at *db_path*."""
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._con = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._size_locks = [threading.Lock()
+                            for _ in range(self._LOCK_STRIPES)]
+        # (size, digest or None if not hashed yet) -> event set once the
+        # copy of that content has finished.
+        self._copying: dict[tuple[int, str | None], threading.Event] = {}
+        self._con.execute(
+            'CREATE TABLE IF NOT EXISTS shipped ('
+            'size integer, md5 varchar(32), source text, shipped_at real, '
+            'PRIMARY KEY (size, md5))')
+
+    def size_lock(self, size: int) -> threading.Lock:
+        """Return the lock serializing decisions about files of *size* bytes."""
+        return self._size_locks[size % self._LOCK_STRIPES]
+
+    def has_size(self, size: int) -> bool:
+        """Return True if any shipped file, or any file being copied, had
+        exactly *size* bytes."""
+        with self._lock:
+            if any(key[0] == size for key in self._copying):
+                return True
+            row = self._con.execute(
+                'SELECT 1 FROM shipped WHERE size = ? LIMIT 1',
+                (size,)).fetchone()
+        return row is not None
+
+    def contains(self, size: int, md5: str) -> bool:
+        """Return True if content with this size and digest was shipped."""
+        with self._lock:
+            row = self._con.execute(
+                'SELECT 1 FROM shipped WHERE size = ? AND md5 = ?',
+                (size, md5)).fetchone()
+        return row is not None
+
+    def copying(self, size: int, md5: str) -> threading.Event | None:
+        """Return the event of a copy in flight that may have this content,
+        one with this digest or one not hashed yet, or None."""
+        with self._lock:
+            return (self._copying.get((size, None))
+                    or self._copying.get((size, md5)))
+
+    def start_copy(self, size: int, md5: str | None) -> None:
+        """Record that content with this size and digest, or None if it
+        is hashed during the copy, is being copied."""
+        with self._lock:
+            self._copying[(size, md5)] = threading.Event()
+
+    def end_copy(self, size: int, md5: str | None) -> None:
+        """Record that the copy started by start_copy() is over."""
+        with self._lock:
+            self._copying.pop((size, md5)).set()
+
+    def add(self, size: int, md5: str, source: str) -> None:
+        """Record that content with this size and digest was shipped."""
+        with self._lock:
+            self._con.execute(
+                'INSERT OR IGNORE INTO shipped (size, md5, source, shipped_at)'
+                ' VALUES (?, ?, ?, ?)', (size, md5, source, time.time()))
+
+    def save(self) -> None:
+        """Persist the entries added so far."""
+        with self._lock:
+            self._con.commit()
+
+    def close(self) -> None:
+        """Persist and close the ledger."""
+        self.save()
+        self._con.close()
+
+
 # ---------------------------------------------------------------------------
 # find_new_photos — scan a directory tree for files newer than a timestamp
 # ---------------------------------------------------------------------------
@@ -135,8 +238,9 @@ def copy_files(files: list[Path], dest_dir: Path) -> list[Path]:
     """Copy each file in *files* to *dest_dir*, renaming on name collisions.
 
     If ``dest_dir / file.name`` already exists, the file is copied as
-    ``name_N.suffix`` where N is the smallest integer that avoids a
-    collision (1, 2, 3, …).
+    ``name_N.suffix`` where N is one more than the highest N already in
+    use for that name (1, 2, 3, …).  The directory is listed once, on the
+    first collision, so each further one costs a single create.
 
     Uses ``O_EXCL`` (exclusive create) on the final destination to avoid
     TOCTOU races when multiple processes target the same path.
@@ -144,36 +248,102 @@ def copy_files(files: list[Path], dest_dir: Path) -> list[Path]:
     Returns a list of destination Paths for the successfully copied files.
     """
     dest_dir.mkdir(parents=True, exist_ok=True)
-    copied: list[Path] = []
-    for src in files:
-        stem = src.stem
-        suffix = src.suffix
-        dest = dest_dir / src.name
-        counter = 0
+    names = naming.NameAllocator()
+    return [_copy_file(src, dest_dir, names=names) for src in files]
+
+
+def _copy_file(src: Path, dest_dir: Path, hasher=None,
+               names: naming.NameAllocator | None = None) -> Path:
+    """Copy a single file into existing *dest_dir*; see copy_files().
+
+    Safe to call from several threads at once: the ``O_EXCL`` create
+    decides which caller gets each name.  If *hasher* (a ``hashlib``
+    object) is given, it is fed the file's bytes as they are copied.
+    Pass the same *names* allocator for every file of a run so collisions
+    are resolved without retrying each taken name.
+    """
+    if names is None:
+        names = naming.NameAllocator()
+    (fd, dest_name) = names.create(str(dest_dir), src.name)
+    dest = Path(dest_name)
+    try:
+        with open(str(src), 'rb') as fsrc:
+            while True:
+                chunk = fsrc.read(8192)
+                if not chunk:
+                    break
+                if hasher is not None:
+                    hasher.update(chunk)
+                os.write(fd, chunk)
+    finally:
+        os.close(fd)
+    shutil.copystat(str(src), str(dest))
+    if dest.name != src.name:
+        logger.info(
+            'Renamed %s → %s to avoid collision', src.name, dest.name
+        )
+    return dest
+
+
+def _ship_file(src: Path, dest_dir: Path, ledger: ShippedLedger,
+               names: naming.NameAllocator | None = None) -> Path | None:
+    """Copy *src* to *dest_dir* unless identical content was already shipped.
+
+    Only files whose size matches something in *ledger*, or a file being
+    copied, are hashed before copying; everything else is hashed on the
+    fly during the copy.  Files of the same size are decided one at a
+    time, so two copies of a photo in the same export never both get
+    copied.  The copies themselves run in parallel, except that a file
+    waits for a copy in flight that may have the same content.
+
+    Returns the destination path, or None if the file was a duplicate.
+    """
+    size = src.stat().st_size
+    digest = None
+    copying = None
+    while True:
+        # Hash or wait outside the lock, then decide again.
+        if copying is not None:
+            copying.wait()
+        elif digest is None and ledger.has_size(size):
+            digest = _md5_file(src)
+        with ledger.size_lock(size):
+            if digest is None:
+                if ledger.has_size(size):
+                    continue
+            else:
+                copying = ledger.copying(size, digest)
+                if copying is not None:
+                    continue
+                if ledger.contains(size, digest):
+                    logger.info('Skipping %s: identical content was already '
+                                'copied to staging', src)
+                    return None
+            ledger.start_copy(size, digest)
+            break
+    try:
+        if digest is None:
+            hasher = hashlib.md5()
+            dest = _copy_file(src, dest_dir, hasher=hasher, names=names)
+            ledger.add(size, hasher.hexdigest(), str(src))
+        else:
+            dest = _copy_file(src, dest_dir, names=names)
+            ledger.add(size, digest, str(src))
+    finally:
+        ledger.end_copy(size, digest)
+    return dest
+
+
+def _md5_file(path: Path) -> str:
+    """Return the MD5 hex digest of the file at *path*."""
+    md5_hash = hashlib.md5()
+    with open(str(path), 'rb') as fh:
         while True:
-            try:
-                fd = os.open(str(dest),
-                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            chunk = fh.read(1 << 20)
+            if not chunk:
                 break
-            except FileExistsError:
-                counter += 1
-                dest = dest_dir / f'{stem}_{counter}{suffix}'
-        try:
-            with open(str(src), 'rb') as fsrc:
-                while True:
-                    chunk = fsrc.read(8192)
-                    if not chunk:
-                        break
-                    os.write(fd, chunk)
-        finally:
-            os.close(fd)
-        shutil.copystat(str(src), str(dest))
-        if counter > 0:
-            logger.info(
-                'Renamed %s → %s to avoid collision', src.name, dest.name
-            )
-        copied.append(dest)
-    return copied
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
 
 
 # ---------------------------------------------------------------------------
@@ -181,6 +351,14 @@ def copy_files(files: list[Path], dest_dir: Path) -> list[Path]:
 # ---------------------------------------------------------------------------
 
 
+def _default_ledger_path() -> Path:
+    """Return the default path of the fix-takeout shipped-content ledger.
+
+    It lives next to the collection state file (see _default_state_path).
+    """
+    return _default_state_path().parent / 'shipped.db'
+
+
 def _default_state_path() -> Path:
     """Return the platform-appropriate path for the collection state file.
 
@@ -348,6 +526,30 @@ def main(argv: list[str] | None = None) -> None:
         action='store_true',
         help='Delete JSON sidecar files after successfully fixing mtimes',
     )
+    fix_parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Threads for sidecar parsing and EXIF checks (default: 4)',
+    )
+    fix_parser.add_argument(
+        '--copy_workers',
+        type=int,
+        default=4,
+        help='Threads copying files to staging (default: 4)',
+    )
+    fix_parser.add_argument(
+        '--ledger_path',
+        type=Path,
+        default=None,
+        help='Path to the shipped-content ledger '
+             '(default: shipped.db next to the state file)',
+    )
+    fix_parser.add_argument(
+        '--no_dedup',
+        action='store_true',
+        help='Copy every file, even content already shipped before',
+    )
     fix_parser.add_argument(
         '--log_file',
         type=Path,
@@ -456,7 +658,16 @@ def _cmd_collect(args) -> None:
 
 
 def _cmd_fix_takeout(args) -> None:
-    """Run the Google Takeout journey (fix mtimes → staging)."""
+    """Run the Google Takeout journey (fix mtimes → staging).
+
+    Discovery, sidecar parsing/mtime fixing and the copy to staging run as
+    one streaming pipeline, so files start reaching staging while the
+    rest of the export is still being scanned.
+
+    Unless --no_dedup is given, content already shipped by this or an
+    earlier import (album copies, overlapping exports) is not copied
+    again; see ShippedLedger.
+    """
     src_dir = str(args.src_dir)
     staging_dir = args.staging_dir
 
@@ -464,28 +675,47 @@ def _cmd_fix_takeout(args) -> None:
         logger.error('%s is not a directory', src_dir)
         sys.exit(1)
 
-    # Step 1: Fix mtimes from JSON sidecars
-    logger.info('Fixing mtimes from Google Takeout JSON sidecars...')
-    fixed, already_ok, skipped = takeout_fixer.fix_mtimes(
-        src_dir, delete_json=args.delete_json,
-    )
+    logger.info('Fixing mtimes from Google Takeout JSON sidecars and '
+                'copying media to %s...', staging_dir)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    ledger = None
+    # One allocator for all copy threads, so a crowded staging directory
+    # is listed once rather than probed name by name.
+    names = naming.NameAllocator()
+    if args.no_dedup:
+        copy = functools.partial(_copy_file, dest_dir=staging_dir,
+                                 names=names)
+    else:
+        ledger = ShippedLedger(args.ledger_path or _default_ledger_path())
+        copy = functools.partial(_ship_file, dest_dir=staging_dir,
+                                 ledger=ledger, names=names)
+    stats: Counter[str] = Counter()
+    copied = duplicates = 0
+    try:
+        media_files = takeout_fixer.iter_fixed_media(
+            src_dir, delete_json=args.delete_json, workers=args.workers,
+            stats=stats,
+        )
+        for dest in parallel.imap_unordered(
+                copy, (Path(p) for p in media_files),
+                workers=args.copy_workers):
+            if dest is None:
+                duplicates += 1
+            else:
+                copied += 1
+    finally:
+        if ledger is not None:
+            ledger.close()
+
     logger.info(
         'Mtimes: %d fixed, %d already had EXIF dates, %d skipped',
-        fixed, already_ok, skipped,
+        stats['fixed'], stats['already_ok'], stats['skipped'],
     )
-
-    # Step 2: Find all media files (non-JSON)
-    media_files = takeout_fixer.iter_media_files(src_dir)
-    if not media_files:
+    if not copied and not duplicates:
         logger.info('No media files found in %s', src_dir)
         return
-
-    logger.info('Copying %d media file(s) to staging...', len(media_files))
-
-    # Step 3: Copy to staging
-    media_paths = [Path(p) for p in media_files]
-    copied = copy_files(media_paths, staging_dir)
-    logger.info('Copied %d file(s) to staging.', len(copied))
+    logger.info('Copied %d file(s) to staging, skipped %d duplicate(s).',
+                copied, duplicates)
 
 
 def _cmd_set_last_sync_time(args) -> None:
@@ -4,6 +4,7 @@ import json
 import os
 import shutil
 import tempfile
+import threading
 import time
 import unittest
 from pathlib import Path
@@ -243,6 +244,110 @@ class CopyFileTests(unittest.TestCase):
         ]))
 
 
+class ShippedLedgerTests(unittest.TestCase):
+    """Tests for ShippedLedger and _ship_file()."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        self.dest_dir = self.root / 'dest'
+        self.dest_dir.mkdir()
+        self.ledger_path = self.root / 'state' / 'shipped.db'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ledger_persists(self):
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        ledger.add(10, 'abc', 'src/a.jpg')
+        ledger.close()
+
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        self.assertTrue(ledger.has_size(10))
+        self.assertTrue(ledger.contains(10, 'abc'))
+        self.assertFalse(ledger.contains(10, 'def'))
+        self.assertFalse(ledger.has_size(11))
+        ledger.close()
+
+    def test_ship_file_unique_size_is_not_prehashed(self):
+        src = self.root / 'a.jpg'
+        src.write_bytes(b'unique content')
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        with patch.object(photocoll, '_md5_file') as md5_file:
+            dest = photocoll._ship_file(src, self.dest_dir, ledger)
+        md5_file.assert_not_called()
+        self.assertEqual(dest, self.dest_dir / 'a.jpg')
+        self.assertTrue(ledger.contains(
+            len(b'unique content'), photocoll._md5_file(src)))
+        ledger.close()
+
+    def test_ship_file_same_size_different_content(self):
+        a = self.root / 'a.jpg'
+        b = self.root / 'b.jpg'
+        a.write_bytes(b'aaaa')
+        b.write_bytes(b'bbbb')
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        self.assertIsNotNone(photocoll._ship_file(a, self.dest_dir, ledger))
+        self.assertIsNotNone(photocoll._ship_file(b, self.dest_dir, ledger))
+        self.assertIsNone(photocoll._ship_file(a, self.dest_dir, ledger))
+        ledger.close()
+
+    def _ship_concurrently(self, ledger, sources, copy_file):
+        """Ship *sources* from one thread each, copying with *copy_file*."""
+        results = {}
+
+        def ship(src):
+            results[src] = photocoll._ship_file(src, self.dest_dir, ledger)
+
+        with patch.object(photocoll, '_copy_file', new=copy_file):
+            threads = [threading.Thread(target=ship, args=(src,))
+                       for src in sources]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_ship_file_copies_in_parallel(self):
+        """Different content is copied in parallel: of a size shipped
+        before, and of a size sharing its lock stripe."""
+        sources = [self.root / name for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+        stripes = photocoll.ShippedLedger._LOCK_STRIPES
+        for (src, content) in zip(sources,
+                                  (b'aaaa', b'bbbb', b'c' * (4 + stripes))):
+            src.write_bytes(content)
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        ledger.add(4, 'older', 'old/x.jpg')
+        # Every copy waits for the others to start theirs.
+        started = threading.Barrier(len(sources), timeout=5)
+        copy_file = photocoll._copy_file
+
+        def copy_together(*args, **kwargs):
+            started.wait()
+            return copy_file(*args, **kwargs)
+
+        results = self._ship_concurrently(ledger, sources, copy_together)
+        self.assertNotIn(None, results.values())
+        self.assertEqual(3, len(os.listdir(self.dest_dir)))
+        ledger.close()
+
+    def test_ship_file_waits_for_same_content_in_flight(self):
+        sources = [self.root / name for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+        for src in sources:
+            src.write_bytes(b'same')
+        ledger = photocoll.ShippedLedger(self.ledger_path)
+        copy_file = photocoll._copy_file
+
+        def slow_copy(*args, **kwargs):
+            time.sleep(0.05)
+            return copy_file(*args, **kwargs)
+
+        results = self._ship_concurrently(ledger, sources, slow_copy)
+        self.assertEqual(2, list(results.values()).count(None))
+        self.assertEqual(1, len(os.listdir(self.dest_dir)))
+        ledger.close()
+
+
 # ---------------------------------------------------------------------------
 # Phase 2: Integration tests
 # ---------------------------------------------------------------------------
@@ -518,35 +623,56 @@ class MainTests(unittest.TestCase):
         _, kwargs = mock_collect.call_args
         self.assertEqual(kwargs['log_file'], Path(log))
 
-    @patch('photocoll.copy_files')
-    @patch('takeout_fixer.iter_media_files')
-    @patch('takeout_fixer.fix_mtimes')
-    def test_fix_takeout_subcommand(self, mock_fix, mock_iter, mock_copy):
-        """fix-takeout subcommand runs mtime fix + copy."""
+    def test_fix_takeout_subcommand(self):
+        """fix-takeout fixes sidecar mtimes and streams media to staging."""
+        staging = Path(self.tmpdir.name) / 'staging'
+        src = Path(self.tmpdir.name) / 'takeout'
+        album = src / 'Photos from 2020'
+        album.mkdir(parents=True)
+        ts = int(time.mktime(time.strptime('2020-06-15', '%Y-%m-%d')))
+        (album / 'video.mp4').write_bytes(b'fake mp4')
+        (album / 'video.mp4.json').write_text(json.dumps({
+            'photoTakenTime': {'timestamp': str(ts)},
+        }))
+        (album / 'photo.jpg').write_bytes(b'no sidecar')
+        (album / 'notes.txt').write_bytes(b'not media')
+
+        photocoll.main([
+            'fix-takeout',
+            '--src_dir', str(src),
+            '--staging_dir', str(staging),
+            '--ledger_path', str(Path(self.tmpdir.name) / 'shipped.db'),
+            '--delete_json',
+        ])
+
+        self.assertEqual({p.name for p in staging.iterdir()},
+                         {'video.mp4', 'photo.jpg'})
+        self.assertEqual(int((staging / 'video.mp4').stat().st_mtime), ts)
+        self.assertFalse((album / 'video.mp4.json').exists())
+
+    @patch('takeout_fixer.iter_fixed_media')
+    def test_fix_takeout_passes_options(self, mock_iter):
+        """fix-takeout forwards --delete_json and --workers to the fixer."""
         staging = str(Path(self.tmpdir.name) / 'staging')
         src = str(Path(self.tmpdir.name) / 'takeout')
         os.makedirs(src, exist_ok=True)
-
-        mock_fix.return_value = (5, 10, 2)
-        mock_iter.return_value = [
-            os.path.join(src, 'photo.jpg'),
-            os.path.join(src, 'video.mp4'),
-        ]
+        mock_iter.return_value = iter([])
 
         photocoll.main([
             'fix-takeout',
             '--src_dir', src,
             '--staging_dir', staging,
+            '--ledger_path', str(Path(self.tmpdir.name) / 'shipped.db'),
             '--delete_json',
+            '--workers', '2',
         ])
 
-        mock_fix.assert_called_once_with(src, delete_json=True)
-        mock_iter.assert_called_once_with(src)
-        mock_copy.assert_called_once()
-        copied_paths = mock_copy.call_args[0][0]
-        self.assertEqual(len(copied_paths), 2)
+        mock_iter.assert_called_once()
+        self.assertEqual(mock_iter.call_args.args, (src,))
+        self.assertTrue(mock_iter.call_args.kwargs['delete_json'])
+        self.assertEqual(mock_iter.call_args.kwargs['workers'], 2)
 
-    @patch('takeout_fixer.fix_mtimes')
+    @patch('takeout_fixer.iter_fixed_media')
     def test_fix_takeout_bad_src_dir(self, mock_fix):
         """fix-takeout with nonexistent src_dir exits with error."""
         staging = str(Path(self.tmpdir.name) / 'staging')
@@ -558,6 +684,38 @@ class MainTests(unittest.TestCase):
             ])
         mock_fix.assert_not_called()
 
+    def test_fix_takeout_dedups_album_copies(self):
+        """The same photo in a year folder and an album is copied once."""
+        staging = Path(self.tmpdir.name) / 'staging'
+        src = Path(self.tmpdir.name) / 'takeout'
+        for folder in ('Photos from 2020', 'Beach trip', 'Favorites'):
+            (src / folder).mkdir(parents=True)
+            (src / folder / 'IMG_0001.jpg').write_bytes(b'same photo')
+        (src / 'Beach trip' / 'IMG_0002.jpg').write_bytes(b'other photo')
+        ledger = str(Path(self.tmpdir.name) / 'shipped.db')
+
+        args = ['fix-takeout', '--src_dir', str(src),
+                '--staging_dir', str(staging), '--ledger_path', ledger]
+        photocoll.main(args)
+        self.assertEqual(sorted(p.read_bytes() for p in staging.iterdir()),
+                         [b'other photo', b'same photo'])
+
+        # An overlapping export later ships nothing new.
+        photocoll.main(args)
+        self.assertEqual(len(list(staging.iterdir())), 2)
+
+    def test_fix_takeout_no_dedup(self):
+        """--no_dedup copies every file."""
+        staging = Path(self.tmpdir.name) / 'staging'
+        src = Path(self.tmpdir.name) / 'takeout'
+        for folder in ('a', 'b'):
+            (src / folder).mkdir(parents=True)
+            (src / folder / 'IMG.jpg').write_bytes(b'same photo')
+
+        photocoll.main(['fix-takeout', '--src_dir', str(src),
+                        '--staging_dir', str(staging), '--no_dedup'])
+        self.assertEqual(len(list(staging.iterdir())), 2)
+
     def test_set_last_sync_time(self):
         """set-last-sync-time writes a timestamp to the state file."""
         state_path = Path(self.tmpdir.name) / 'state.json'
@@ -5,45 +5,390 @@ Organizes source photos by date and updates a sqlite database with
 metadata about the photos. Detects duplicates and ignores them.
 """
 import argparse
-import calendar
+import csv
+import functools
+import hashlib
+import json
 import logging
 import os
 import os.path
 import shutil
+import stat
 import sys
+import time
+from collections import Counter, deque
 
+import catalog
+import claims
+import content_hash
 import media_common
+import media_types
+import naming
+import relayout
+import similar
+import takeout_fixer
+import thumbnails
+
+# Where staged files that keep failing to archive are moved, under the
+# library, and after how many failures.
+QUARANTINE_DIR_NAME = 'quarantine'
+DEFAULT_QUARANTINE_AFTER = 5
+
+# Orders in which staged files can be archived, see _schedule().
+SCHEDULES = ('walk', 'smallest', 'oldest', 'interleave')
+
+# Bytes of small files archived between two large ones by the interleave
+# schedule.
+DEFAULT_SCHEDULE_BUDGET = 256 * 1000 * 1000
 
 
 def _find_and_archive_photos(search_dir, lib_base_dir,
-                             delete_source_on_success, group_name):
+                             delete_source_on_success, group_name,
+                             quarantine_after=DEFAULT_QUARANTINE_AFTER,
+                             non_media='skip', schedule='walk',
+                             schedule_budget=DEFAULT_SCHEDULE_BUDGET,
+                             files_from=None,
+                             sync_batch=media_common.DEFAULT_SYNC_BATCH,
+                             sync_mode='fsync'):
     """Sets up or opens a media library and adds new photos
     to the library and its database.
 
-    The source image files will be deleted if --del_src is specified.
+    The photos are every file under search_dir or, with files_from, an
+    iterable of paths (see _read_file_list()), just the files listed.
+
+    The source image files will be deleted if --del_src is specified,
+    in batches of sync_batch once their copies are on disk (see
+    _archive_photos()), and then files that failed quarantine_after
+    times are quarantined.
+    Files that aren't photos or videos are handled as non_media says,
+    see _iter_staged_photos(), in the order schedule says, see
+    _schedule().
+    Files are claimed one at a time (see claims.py), so other photoman
+    processes can work on the same search_dir at the same time.
+
+    Returns the latencies of the files handled, see _archive_photos().
     """
-    rep = media_common.Repository()
-    rep.open(lib_base_dir)
-    group_id = media_common.get_group_id(group_name)
-    files_to_delete = []
-    archive_count = 0
-    for (dirpath, _dirnames, filenames) in os.walk(search_dir):
+    claim_queue = claims.ClaimQueue(search_dir)
+    try:
+        claim_queue.open()
+    except OSError as e:
+        logging.warning("Can't claim files in %s (%s); archiving them "
+                        "without claims, so no other worker may share it",
+                        search_dir, e)
+        claim_queue = None
+    try:
+        return _archive_photos(
+            _iter_staged_photos(search_dir, claim_queue, non_media,
+                                schedule, schedule_budget, files_from),
+            lib_base_dir, delete_source_on_success, group_name,
+            quarantine_after if delete_source_on_success else None,
+            sync_batch, sync_mode)
+    finally:
+        if claim_queue:
+            claim_queue.close()
+
+
+def _ingest_takeout(takeout_dir, lib_base_dir, group_name):
+    """Archives an extracted Google Takeout export directly.
+
+    Capture times (for files without EXIF dates), descriptions and
+    locations are read from the JSON sidecars and passed to Photo as
+    metadata, so the export doesn't need its mtimes rewritten or a trip
+    through staging.  The export is only read, never modified.
+    """
+    _archive_photos(_iter_takeout_photos(takeout_dir), lib_base_dir,
+                    False, group_name)
+
+
+def _iter_staged_photos(search_dir, claim_queue=None, non_media='skip',
+                        schedule='walk',
+                        schedule_budget=DEFAULT_SCHEDULE_BUDGET,
+                        files_from=None):
+    """Yields a Photo for every media file under search_dir, or only
+    for those among the files_from paths, claimed through claim_queue if
+    given.  Files another worker claims first are skipped.
+
+    Files are classified by their first bytes (see media_types).  Other
+    files are left alone if non_media is 'skip', deleted if it is
+    'delete' and archived like media if it is 'archive'.
+
+    Files come in os.walk (or files_from) order with the 'walk' schedule.
+    Any other schedule lists and stats all the files first and yields
+    them in the order _schedule() gives; each is still classified and
+    claimed only when its turn comes.
+    """
+    if files_from is None:
+        paths = _walk_staged(search_dir)
+    else:
+        paths = _listed_files(search_dir, files_from)
+    if schedule != 'walk':
+        entries = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size,
+                            claims.arrival_time(path, stat)))
+        paths = [path for (path, _size, _arrival)
+                 in _schedule(entries, schedule, schedule_budget)]
+        logging.info('Archiving %d staged files in %s order', len(paths),
+                     schedule)
+    skipped = 0
+    for path in paths:
+        photo = media_common.Photo(path)
+        try:
+            non_media_file = photo.classify() is None
+        except OSError:
+            # Archiving it fails and is recorded as a failure.
+            non_media_file = False
+        if non_media_file and non_media != 'archive':
+            skipped += 1
+            if non_media == 'delete':
+                logging.info('Deleting %s, which is not a media file', path)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                logging.debug('Skipping %s, which is not a media file',
+                              path)
+            continue
+        if claim_queue:
+            photo.source_path = claim_queue.claim(path)
+            if photo.source_path is None:
+                continue
+        yield photo
+    if skipped:
+        logging.info('%s %d files that are not photos or videos',
+                     'Deleted' if non_media == 'delete' else 'Skipped',
+                     skipped)
+
+
+def _walk_staged(search_dir):
+    """Yields the path of every file under search_dir, in os.walk
+    order, leaving out the claim directories."""
+    for (dirpath, dirnames, filenames) in os.walk(search_dir):
+        if dirpath == search_dir and claims.CLAIMS_DIR_NAME in dirnames:
+            dirnames.remove(claims.CLAIMS_DIR_NAME)
         for filename in filenames:
             path = os.path.join(dirpath, filename)
             if not os.path.isfile(path):
                 logging.warning('Found a non-file when looking for photos: '
                                 '%s, it will not be modified', path)
                 continue
+            yield path
+
+
+def _read_file_list(fh):
+    """Yields the paths listed in fh, a binary file, as they arrive.
+
+    Paths are separated by NULs if the first read holds one (paths can't
+    contain NULs, but they can contain newlines), otherwise by newlines;
+    empty entries are ignored.  Input is read as it becomes
+    available, so paths piped in by a long-running tool are archived
+    without waiting for it to finish.
+    """
+    separator = None
+    pending = b''
+    while True:
+        chunk = fh.read1(65536)
+        if not chunk:
+            break
+        pending += chunk
+        if separator is None:
+            if b'\0' in pending:
+                separator = b'\0'
+            elif b'\n' in pending:
+                separator = b'\n'
+            else:
+                continue
+        (*entries, pending) = pending.split(separator)
+        yield from _decode_entries(entries, separator)
+    yield from _decode_entries([pending], separator)
+
+
+def _decode_entries(entries, separator):
+    """Yields the non-empty paths among entries of a file list."""
+    for entry in entries:
+        if separator != b'\0':
+            # Lists written on Windows end their lines in CRLF.
+            entry = entry.rstrip(b'\r\n')
+        if entry:
+            yield os.fsdecode(entry)
+
+
+def _listed_files(search_dir, paths):
+    """Yields the paths that name files under search_dir, outside its
+    claim directories.  Relative paths are taken to be under search_dir.
+    Anything else is logged and skipped."""
+    root = os.path.realpath(search_dir)
+    for path in paths:
+        path = os.path.join(search_dir, path)
+        # Directories may be spelled through symlinks, e.g. a share's
+        # mount point; the file itself is taken as it is, like os.walk.
+        relative = os.path.relpath(
+            os.path.join(os.path.realpath(os.path.dirname(path)),
+                         os.path.basename(path)), root)
+        if relative.split(os.sep)[0] in (os.pardir, claims.CLAIMS_DIR_NAME):
+            logging.warning('Not archiving %s, which is not in %s', path,
+                            search_dir)
+            continue
+        path = os.path.join(search_dir, relative)
+        if not os.path.isfile(path):
+            if os.path.lexists(path):
+                logging.warning('Found a non-file when looking for photos: '
+                                '%s, it will not be modified', path)
+            else:
+                logging.info('%s is gone, it was probably archived '
+                             'already', path)
+            continue
+        yield path
 
+
+def _schedule(entries, schedule, budget=DEFAULT_SCHEDULE_BUDGET):
+    """Orders (path, size, arrival time) entries of staged files for
+    archiving.
+
+    'smallest' goes by size, which gives the shortest mean time to
+    archive per file.  'oldest' goes by arrival in staging (the ctime,
+    as copies keep the mtime of the original, or the ctime saved on a
+    file's first claim: see claims.arrival_time()).  Without user
+    extended attributes, a file put back after a crash goes by the time
+    it was put back.  'interleave' is smallest
+    first, except that after every budget bytes of small files the
+    largest file left goes next, so a big video waits for a bounded
+    amount of work rather than the whole queue.  'walk' keeps the order.
+    """
+    if schedule == 'walk':
+        return list(entries)
+    if schedule == 'oldest':
+        return sorted(entries, key=lambda entry: (entry[2], entry[0]))
+    by_size = sorted(entries, key=lambda entry: (entry[1], entry[0]))
+    if schedule == 'smallest':
+        return by_size
+    queue = deque(by_size)
+    order = []
+    while queue:
+        spent = 0
+        while queue and spent < budget:
+            entry = queue.popleft()
+            spent += entry[1]
+            order.append(entry)
+        if queue:
+            order.append(queue.pop())
+    return order
+
+
+def _latency_summary(latencies):
+    """Returns the count, mean, 50th, 90th and 99th percentile and
+    maximum of latencies, a sorted list of seconds, as a dict."""
+    if not latencies:
+        return None
+    summary = {'files': len(latencies),
+               'mean': sum(latencies) / len(latencies),
+               'max': latencies[-1]}
+    for percent in (50, 90, 99):
+        # Nearest rank.
+        rank = max(1, -(-percent * len(latencies) // 100))
+        summary['p%d' % percent] = latencies[rank - 1]
+    return summary
+
+
+def _iter_takeout_photos(takeout_dir):
+    """Yields a Photo for every media file in a Takeout export, with the
+    metadata from its sidecar applied."""
+    for (dirpath, _dirnames, filenames) in os.walk(takeout_dir):
+        groups, unmatched_media, _unmatched_sidecars = (
+            takeout_fixer.SidecarIndex(filenames).groups())
+        for json_name, media_names in groups.items():
+            sidecar = takeout_fixer.read_sidecar(
+                os.path.join(dirpath, json_name))
+            for media_name in media_names:
+                photo = media_common.Photo(os.path.join(dirpath, media_name))
+                if sidecar is not None:
+                    photo.sidecar_timestamp = sidecar['timestamp']
+                    photo.description = sidecar['description']
+                    photo.latitude = sidecar['latitude']
+                    photo.longitude = sidecar['longitude']
+                yield photo
+        for media_name in unmatched_media:
+            logging.info('No sidecar found for %s',
+                         os.path.join(dirpath, media_name))
+            yield media_common.Photo(os.path.join(dirpath, media_name))
+
+
+def _archive_photos(photos, lib_base_dir, delete_source_on_success,
+                    group_name, quarantine_after=None,
+                    sync_batch=media_common.DEFAULT_SYNC_BATCH,
+                    sync_mode='fsync'):
+    """Archives each Photo from the photos iterable, skipping duplicates.
+
+    The source image files will be deleted if delete_source_on_success
+    is set, but only once the archived copies are on disk: every
+    sync_batch files, the copies are synced as sync_mode says and the
+    database committed before their sources are deleted (see
+    media_common.SyncBatch).  A file that fails is recorded in the
+    IngestFailures ledger and not tried again until its backoff has
+    passed; with quarantine_after, it is moved to
+    <lib_base_dir>/quarantine after that many failures.
+
+    Returns the sorted latencies of the files handled: the seconds from
+    the start of the run until each was archived, found to be a
+    duplicate or failed.  Their distribution is logged at the end.
+    """
+    start = time.monotonic()
+    latencies = []
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    group_id = media_common.get_group_id(group_name)
+    similarity_index = similar.SimilarityIndex(rep)
+    # Failures are committed with the batch, not ahead of its rows.
+    failures = rep.ingest_failures(commit=False)
+    names = naming.NameAllocator()
+    layout = rep.archive_layout(lib_base_dir)
+
+    def forget_rolled_back():
+        """Drops what this run cached about rows a failed sync rolled
+        back."""
+        (max_id,) = rep.con.execute('SELECT max(id) FROM photos').fetchone()
+        similarity_index.drop_after(max_id or 0)
+        layout.forget()
+        names.forget()
+
+    batch = media_common.SyncBatch(rep.con, lib_base_dir, sync_batch,
+                                   sync_mode, on_rollback=forget_rolled_back)
+    archive_count = 0
+    backing_off = 0
+    try:
+        for photo in photos:
+            path = photo.source_path
+            try:
+                key = media_common.failure_key(path)
+            except OSError:
+                key = None
+            if key is not None and failures.backing_off(key):
+                backing_off += 1
+                continue
             try:
-                photo = media_common.Photo(path)
                 photo.load_metadata()
                 if photo.md5 is None:
                     logging.warning('Could not compute hash for %s, skipping',
                                     path)
+                    if key is not None:
+                        _record_failure(failures, key, path, 'unreadable',
+                                        lib_base_dir, quarantine_after)
                     continue
 
                 db_result = rep.lookup_hash(photo.md5, size=photo.size)
+                if db_result is None and photo.content_md5 is not None:
+                    content_match = rep.lookup_content(photo.content_md5)
+                    if (content_match is not None
+                            and os.path.isfile(content_match[1])):
+                        logging.info('%s has the same image data as %s, only '
+                                     'its metadata differs', path,
+                                     content_match[1])
+                        db_result = content_match
                 if (db_result is not None
                         and os.path.abspath(db_result[1])
                         == os.path.abspath(path)):
@@ -55,7 +400,7 @@ def _find_and_archive_photos(search_dir, lib_base_dir,
                     logging.info('Deleting the source file %s, which is a '
                                  'duplicate of existing file %s',
                                  photo.source_path, db_result[1])
-                    os.remove(photo.source_path)
+                    batch.add(source=photo.source_path)
                 elif (db_result is not None
                       and os.path.isfile(db_result[1])):
                     logging.info('Ignoring the source file %s, which is a '
@@ -65,30 +410,99 @@ def _find_and_archive_photos(search_dir, lib_base_dir,
                     logging.info('Photo %s was deleted from the archive, '
                                  'replacing it with the new one.',
                                  db_result[1])
-                    if (_archive_photo(photo, lib_base_dir, rep, group_id)
-                            and delete_source_on_success):
-                        files_to_delete.append(photo.source_path)
+                    if _archive_photo(photo, lib_base_dir, rep, group_id,
+                                      names=names, layout=layout, batch=batch):
+                        batch.add(source=photo.source_path
+                                  if delete_source_on_success else None)
                 else:
                     archive_count += 1
-                    if (_archive_photo(photo, lib_base_dir, rep, group_id)
-                            and delete_source_on_success):
-                        files_to_delete.append(photo.source_path)
-            except Exception:
+                    if _archive_photo(photo, lib_base_dir, rep, group_id,
+                                      similarity_index, names, layout, batch):
+                        batch.add(source=photo.source_path
+                                  if delete_source_on_success else None)
+                if key in failures:
+                    failures.clear(key)
+            except Exception as e:
                 logging.exception('Error processing file %s, skipping', path)
-
-    rep.close()
-    for filepath in files_to_delete:
-        try:
-            os.remove(filepath)
-        except OSError as e:
-            logging.warning('Could not delete %s: %s', filepath, e)
+                if key is not None:
+                    _record_failure(failures, key, path,
+                                    '%s: %s' % (type(e).__name__, e),
+                                    lib_base_dir, quarantine_after)
+            finally:
+                latencies.append(time.monotonic() - start)
+    finally:
+        # Commits the rows of copies made so far, even if interrupted.
+        batch.flush()
+        rep.close()
+    if backing_off:
+        logging.info('Skipped %d files that failed recently; they will be '
+                     'retried later', backing_off)
     logging.info('Successfully completed archiving %d files', archive_count)
+    latencies.sort()
+    summary = _latency_summary(latencies)
+    if summary:
+        logging.info('Time to archive over %(files)d files: mean %(mean).1fs, '
+                     'p50 %(p50).1fs, p90 %(p90).1fs, p99 %(p99).1fs, '
+                     'max %(max).1fs', summary)
+    return latencies
 
 
-def _archive_photo(photo, lib_base_dir, repository, group_id):
-    """Copies the photo to the archive and adds it to the repository."""
-    _copy_photo(photo, lib_base_dir, group_id)
-    photo.db_id = repository.add_or_update(photo)
+def _record_failure(failures, key, path, error, lib_base_dir,
+                    quarantine_after):
+    """Records that archiving path failed with error, and quarantines the
+    file if it has failed quarantine_after times."""
+    attempts = failures.record(key, path, error)
+    if quarantine_after is None or attempts < quarantine_after:
+        logging.warning('%s has failed %d times; not retrying it for a '
+                        'while', path, attempts)
+        return
+    dest_dir = os.path.join(lib_base_dir, QUARANTINE_DIR_NAME)
+    os.makedirs(dest_dir, exist_ok=True)
+    (prefix, suffix) = os.path.splitext(os.path.basename(path))
+    dest = os.path.join(dest_dir, prefix + suffix)
+    counter = 0
+    while os.path.lexists(dest):
+        counter += 1
+        dest = os.path.join(dest_dir, '%s_%d%s' % (prefix, counter, suffix))
+    try:
+        shutil.move(path, dest)
+    except OSError as e:
+        logging.error('Could not quarantine %s: %s', path, e)
+        return
+    failures.quarantined(key, dest)
+    logging.error('%s failed %d times and was moved to %s; see the '
+                  'ingest_failures table in media.db for the errors', path,
+                  attempts, dest)
+
+
+def _archive_photo(photo, lib_base_dir, repository, group_id,
+                   similarity_index=None, names=None, layout=None,
+                   batch=None):
+    """Copies the photo to the archive and adds it to the repository.
+
+    With a similarity_index, a new photo that looks like one already
+    archived is flagged with that photo's id in similar_to.  names is
+    the NameAllocator to pick the archive file name with, layout the
+    library's ArchiveLayout.  With a SyncBatch, the copy is tracked by
+    the batch and the new row left for it to commit.
+    """
+    phash = None
+    if (similarity_index is not None and photo.media_type is not None
+            and photo.media_type[0] == media_types.IMAGE):
+        phash = similar.dhash(photo.source_path)
+        photo.phash = similar.to_db(phash)
+        photo.similar_to = similarity_index.nearest(phash)
+        if photo.similar_to is not None:
+            logging.info('%s looks like archived photo %d, it may be a '
+                         'resized or recompressed copy',
+                         photo.source_path, photo.similar_to)
+    _copy_photo(photo, lib_base_dir, group_id, names, layout)
+    photo.load_archive_fingerprint()
+    if batch is not None:
+        batch.track(photo.archive_path)
+    photo.db_id = repository.add_or_update(photo, commit=batch is None)
+    if similarity_index is not None and photo.db_id > 0:
+        similarity_index.add(photo.db_id, phash)
     if photo.db_id > 0 and os.path.isfile(photo.archive_path):
         dest_md5 = media_common.compute_md5(photo.archive_path)
         if dest_md5 == photo.md5:
@@ -109,47 +523,82 @@ def _archive_photo(photo, lib_base_dir, repository, group_id):
         return False
 
 
-def _copy_photo(photo, lib_base_dir, group_id):
+def _copy_photo(photo, lib_base_dir, group_id, names=None, layout=None):
     """Copies a photo file to its destination, computing the destination
-    from the file's metadata"""
+    from the file's metadata and, if given, the library's ArchiveLayout"""
     parts = photo.get_path_parts()
-    relative_path = os.path.join('%04d' % parts[0],
-                                 _get_month_name(parts[1]),
-                                 parts[2])
-    archive_path = os.path.join(lib_base_dir, 'photos', relative_path)
-    photo.archive_path = archive_path
+    if layout is None:
+        dest_dir = media_common.archive_dir(lib_base_dir, photo.timestamp)
+    else:
+        dest_dir = layout.directory(photo.timestamp, new=True)
+    photo.archive_path = os.path.join(dest_dir, parts[2])
     dest_dir = os.path.dirname(photo.archive_path)
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
     if photo.source_path != photo.archive_path:
-        photo.archive_path = _copy_file(photo.source_path, dest_dir)
+        photo.archive_path = _copy_file(photo.source_path, dest_dir, names)
+        if photo.timestamp_from_sidecar():
+            # Match what a staging import of an mtime-fixed file produces.
+            os.utime(photo.archive_path, (photo.timestamp, photo.timestamp))
         try:
             os.chown(photo.archive_path, -1, group_id)
         except OSError:
             pass
 
 
-def _copy_file(filepath, dest_dir):
+def _archive_staging(args):
+    """Archives --src_dir, or the files listed in --files_from."""
+    files_from = None
+    list_file = None
+    if args.files_from == '-':
+        files_from = _read_file_list(sys.stdin.buffer)
+    elif args.files_from:
+        list_file = open(args.files_from, 'rb')
+        files_from = _read_file_list(list_file)
+    try:
+        _find_and_archive_photos(args.src_dir, args.media_dir,
+                                 args.del_src, args.group_name,
+                                 args.quarantine_after, args.non_media,
+                                 args.schedule,
+                                 int(args.schedule_budget_mb * 1e6),
+                                 files_from, args.sync_batch, args.sync_mode)
+    finally:
+        if list_file:
+            list_file.close()
+
+
+def _set_day_dirs_after(lib_base_dir, count):
+    """Saves the library's day directory threshold for this and later
+    ingests."""
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        rep.set_day_dirs_after(count)
+    finally:
+        rep.close()
+    if count:
+        logging.info('Photos will go in day directories in months of more '
+                     'than %d photos; run relayout.py to move the ones '
+                     'already archived', count)
+    else:
+        logging.info('Day directories turned off')
+
+
+def _copy_file(filepath, dest_dir, names=None):
     """Copies a file, keeping its metadata and renaming it if there's a
     conflict.
 
     Uses ``O_EXCL`` (exclusive create) on the final destination to avoid
-    TOCTOU races when multiple processes target the same path.
+    TOCTOU races when multiple processes target the same path.  names, a
+    naming.NameAllocator, remembers the suffixes in use in dest_dir so
+    that the next conflict there is resolved without trying each one;
+    pass the same one for every file of an ingest.
     """
     os.makedirs(dest_dir, exist_ok=True)
-    _dirname, filename = os.path.split(filepath)
-    prefix, suffix = os.path.splitext(filename)
-    destpath = os.path.join(dest_dir, filename)
-    counter = 0
-    while True:
-        try:
-            fd = os.open(destpath,
-                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
-            break
-        except FileExistsError:
-            counter += 1
-            destpath = os.path.join(dest_dir,
-                                    prefix + '_' + str(counter) + suffix)
+    filename = os.path.basename(filepath)
+    if names is None:
+        names = naming.NameAllocator()
+    (fd, destpath) = names.create(dest_dir, filename)
     try:
         with open(filepath, 'rb') as src:
             while True:
@@ -160,19 +609,20 @@ def _copy_file(filepath, dest_dir):
     finally:
         os.close(fd)
     shutil.copystat(filepath, destpath)
-    if counter > 0:
+    if os.path.basename(destpath) != filename:
         logging.info('file %s had to be renamed to %s to avoid a conflict.',
                      filepath, destpath)
     return destpath
 
 
-def _get_month_name(month):
-    """Returns a month identifier for a given decimal month"""
-    return "%02d_%s" % (month, calendar.month_name[month])
-
+def _scan_missing_photos(lib_base_dir, lock=None):
+    """Removes photos from the repository that don't exist in the archive
 
-def _scan_missing_photos(lib_base_dir):
-    """Removes photos from the repository that don't exist in the archive"""
+    Runs under the library's ingest lock, which lock may already hold,
+    and not while relayout.py holds it or has left a journal to roll
+    forward: until their rows are updated, the photos it moves are
+    missing from their old paths.
+    """
     # Guard: verify the archive directory is actually accessible
     photos_dir = os.path.join(lib_base_dir, 'photos')
     if not os.path.isdir(photos_dir):
@@ -190,55 +640,757 @@ def _scan_missing_photos(lib_base_dir):
                        'photos — is the disk mounted?', photos_dir)
         return
 
+    own_lock = None
+    if lock is None or not lock.held():
+        own_lock = media_common.RunLock(
+            os.path.join(lib_base_dir, media_common.INGEST_LOCK_NAME))
+        if not own_lock.acquire():
+            logging.error('%s holds the lock on %s; not scanning for '
+                          'missing photos', own_lock.holder(), lib_base_dir)
+            return
     rep = media_common.Repository()
     try:
+        journal_path = os.path.join(lib_base_dir, relayout.JOURNAL_NAME)
+        if os.path.exists(journal_path):
+            logging.error('%s exists; not scanning for missing photos until '
+                          'relayout.py has rolled it forward', journal_path)
+            return
         rep.open(lib_base_dir)
         missing_files = []
-        for (db_id, filepath) in rep.iter_all_photos():
-            if not os.path.isfile(filepath):
+
+        def record(row, status, _value):
+            if status == 'missing':
                 logging.warning('The photo %s was deleted from the '
                                 'archive unexpectedly. It will be removed '
-                                'from the database.', filepath)
-                missing_files.append(db_id)
-        if missing_files:
+                                'from the database.', row[1])
+                missing_files.append(row[0])
+
+        job = media_common.BatchJob('scan_missing_photos', _check_present,
+                                    workers=8)
+        counts = job.run(list(rep.iter_all_photos()), on_result=record)
+        if counts['error']:
+            logging.error('Could not check %d photos; not removing any '
+                          'from the database', counts['error'])
+        elif missing_files:
             logging.warning('Removing %d missing photos from database',
                             len(missing_files))
             rep.remove_photos(missing_files)
     finally:
         rep.close()
+        if own_lock is not None:
+            own_lock.release()
+
+
+def _check_present(row):
+    """Returns 'present' or 'missing' for an (id, archive_path) row."""
+    return 'present' if os.path.isfile(row[1]) else 'missing'
+
+
+# --backfill field names and the photos columns each one fills in.
+_BACKFILL_FIELDS = {
+    'camera': ('camera_make', 'camera_model'),
+    'timestamp': ('timestamp',),
+    'gps': ('latitude', 'longitude'),
+    'orientation': ('orientation',),
+    'dimensions': ('width', 'height'),
+    'phash': ('phash',),
+    'content': ('content_md5',),
+}
+
+
+def _backfill(lib_base_dir, fields, workers=4, max_rate=None):
+    """Fills in missing metadata columns of already archived photos.
+
+    Rows with NULL in any of the fields' columns are read back from their
+    archive files in a process pool: headers only, except that phash
+    decodes a reduced image and content reads the whole file.  Values are written
+    with batched UPDATEs that never overwrite a non-NULL column, and
+    every row examined is recorded in a ledger so later runs skip rows
+    whose files simply don't have the data.  max_rate caps the files
+    read per second, to leave disk time for a concurrent ingest.
+    Returns a Counter of row statuses.
+    """
+    columns = [column for field in fields
+               for column in _BACKFILL_FIELDS[field]]
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        ledger = rep.ledger('backfill:' + ','.join(sorted(fields)))
+        rows = rep.con.execute(
+            'SELECT id, archive_path FROM photos WHERE '
+            + ' OR '.join('%s IS NULL' % column for column in columns)
+            + ' ORDER BY id').fetchall()
+        update = ('UPDATE photos SET '
+                  + ', '.join('%s = COALESCE(%s, :%s)' % (c, c, c)
+                              for c in columns)
+                  + ' WHERE id = :id')
+        pending = []
+
+        def record(row, _status, values):
+            if values:
+                pending.append(dict(values, id=row[0]))
+
+        def flush():
+            rep.con.executemany(update, pending)
+            pending.clear()
+
+        job = media_common.BatchJob(
+            'backfill', functools.partial(_read_backfill_values, columns),
+            ledger=ledger, key=lambda row: str(row[0]), workers=workers,
+            processes=True,
+            rate_limiter=(media_common.RateLimiter(ops_per_sec=max_rate)
+                          if max_rate else None))
+        return job.run(rows, on_result=record, on_checkpoint=flush)
+    finally:
+        rep.close()
+
+
+def _read_backfill_values(columns, row):
+    """Reads the columns for an (id, archive_path) row from its file.
+
+    Returns ('filled', {column: value}) or ('not_found', None).
+    """
+    try:
+        metadata = media_common.read_image_metadata(row[1])
+    except OSError:
+        if not os.path.isfile(row[1]):
+            raise
+        # Not an image Pillow understands, e.g. a video.
+        metadata = {}
+    if 'phash' in columns:
+        metadata['phash'] = similar.to_db(similar.dhash(row[1]))
+    if 'content_md5' in columns:
+        metadata['content_md5'] = content_hash.file_content_md5(row[1])
+    if 'timestamp' in columns and metadata.get('timestamp') is None:
+        # Same fallback as archiving a file without an EXIF date.
+        metadata['timestamp'] = os.path.getmtime(row[1])
+    values = {column: metadata.get(column) for column in columns}
+    if all(value is None for value in values.values()):
+        return ('not_found', None)
+    return ('filled', values)
+
+
+_SCRUB_JOB = 'scrub'
+
+_SCRUB_CHUNK = 1 << 20
+
+
+def _scrub(lib_base_dir, max_mbps=None, max_iops=None, max_minutes=None):
+    """Re-hashes archived files and compares them with their stored MD5.
+
+    A pass over the whole library can span several runs: rows verified
+    since the pass began are skipped, and the rest are read in physical
+    disk order until max_minutes is used up.  Each result goes to the
+    verified_at and verify_status columns, committed in batches, so an
+    interrupted run loses little work.  Reads are throttled to max_mbps
+    and max_iops and dropped from the page cache as they go.  All files
+    known to be damaged, missing or unreadable are reported at the end of
+    every run.  Returns a Counter of this run's statuses.
+    """
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        state = rep.ledger(_SCRUB_JOB)
+        pass_start = int(state.get_state('pass_start', 0))
+        rows = _rows_to_scrub(rep, pass_start)
+        if not rows:
+            pass_start = int(time.time())
+            state.set_state('pass_start', pass_start)
+            state.commit()
+            logging.info('Starting a new scrub pass of %s', lib_base_dir)
+            rows = _rows_to_scrub(rep, pass_start)
+        rows.sort(key=_scrub_sort_key)
+
+        deadline = (time.monotonic() + max_minutes * 60
+                    if max_minutes is not None else None)
+
+        def until_deadline():
+            for (i, row) in enumerate(rows):
+                if deadline is not None and time.monotonic() >= deadline:
+                    logging.info('Scrub time is up; %d files are left for '
+                                 'the next run', len(rows) - i)
+                    return
+                yield row
+
+        pending = []
+
+        def record(row, status, fingerprint):
+            if status != 'ok':
+                logging.error('Scrub found %s %s', status.upper(), row[1])
+            pending.append(_verification(row[0], status, fingerprint))
+
+        def flush():
+            _save_verifications(rep, pending)
+
+        limiter = None
+        if max_mbps or max_iops:
+            limiter = media_common.RateLimiter(
+                ops_per_sec=max_iops,
+                bytes_per_sec=max_mbps * 1e6 if max_mbps else None)
+        # One reader, so the disk sees a single sequential stream.
+        job = media_common.BatchJob(
+            _SCRUB_JOB, functools.partial(_scrub_file, limiter), workers=1,
+            size_of=lambda row: row[3] or 0)
+        counts = job.run(until_deadline(), on_result=record,
+                         on_checkpoint=flush)
+
+        problems = rep.con.execute(
+            "SELECT archive_path, verify_status FROM photos "
+            "WHERE verify_status != 'ok' ORDER BY archive_path").fetchall()
+        for (path, status) in problems:
+            logging.warning('Scrub: %s is %s', path, status)
+        if problems:
+            logging.warning('Scrub: %d archived files are damaged, missing '
+                            'or unreadable', len(problems))
+        return counts
+    finally:
+        rep.close()
+
+
+def _quick_check(lib_base_dir, workers=4):
+    """Finds archive files that changed since they were fingerprinted.
+
+    One os.scandir pass over the archive is compared with the size,
+    mtime_ns, inode and device stored for every row.  Only files whose
+    fingerprint differs, or that have none yet, are re-hashed: those
+    whose content still matches get their new fingerprint stored, the
+    rest are reported as modified.  Missing files and files the database
+    doesn't know about are reported too.  Returns a Counter with
+    'unchanged', 'missing', 'untracked' and the re-hash statuses.
+    """
+    scanned = _scan_fingerprints(os.path.join(lib_base_dir, 'photos'))
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        counts = Counter()
+        to_hash = []
+        seen = set()
+        for (db_id, path, md5, size, mtime_ns, inode,
+             device) in rep.con.execute(
+                'SELECT id, archive_path, md5, size, mtime_ns, inode, '
+                'device FROM photos').fetchall():
+            current = scanned.get(os.path.normpath(path))
+            if current is None:
+                # Not under the scanned directory, or not there at all.
+                try:
+                    current = media_common.fingerprint(os.stat(path))
+                except FileNotFoundError:
+                    logging.warning('Quick check: %s is missing', path)
+                    counts['missing'] += 1
+                    continue
+            seen.add(os.path.normpath(path))
+            if current == (size, mtime_ns, inode, device):
+                counts['unchanged'] += 1
+            else:
+                to_hash.append((db_id, path, md5, size))
+        untracked = sorted(set(scanned) - seen)
+        for path in untracked:
+            logging.debug('Quick check: %s is not in the database', path)
+        counts['untracked'] = len(untracked)
+        logging.info('Quick check: %d of %d files need re-hashing',
+                     len(to_hash), len(seen))
+
+        pending = []
+
+        def record(row, status, fingerprint):
+            if status == 'mismatch':
+                logging.error('Quick check: %s was modified in place',
+                              row[1])
+            elif status != 'ok':
+                logging.error('Quick check: %s is %s', row[1], status)
+            pending.append(_verification(row[0], status, fingerprint))
+
+        job = media_common.BatchJob(
+            'quick_check', functools.partial(_scrub_file, None),
+            workers=workers, size_of=lambda row: row[3] or 0)
+        counts.update(job.run(
+            to_hash, on_result=record,
+            on_checkpoint=lambda: _save_verifications(rep, pending)))
+        return counts
+    finally:
+        rep.close()
+
+
+def _scan_fingerprints(top):
+    """Returns {path: fingerprint} for every file under top, from a single
+    os.scandir pass."""
+    fingerprints = {}
+    stack = [os.path.normpath(top)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            logging.warning('Could not list %s: %s', e.filename, e)
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        fingerprints[entry.path] = media_common.fingerprint(
+                            entry.stat(follow_symlinks=False))
+                except OSError as e:
+                    logging.warning('Could not stat %s: %s', entry.path, e)
+    return fingerprints
+
+
+def _verification(db_id, status, fingerprint):
+    """Returns the _save_verifications() parameters for one result."""
+    (_size, mtime_ns, inode, device) = fingerprint or (None,) * 4
+    return {'id': db_id, 'status': status, 'verified_at': int(time.time()),
+            'mtime_ns': mtime_ns, 'inode': inode, 'device': device}
+
+
+def _save_verifications(rep, pending):
+    """Stores and commits re-hash results, emptying pending.
+
+    A file that verified ok also gets its current stat fingerprint.
+    """
+    rep.con.executemany(
+        'UPDATE photos SET verified_at = :verified_at, '
+        'verify_status = :status, '
+        'mtime_ns = COALESCE(:mtime_ns, mtime_ns), '
+        'inode = COALESCE(:inode, inode), '
+        'device = COALESCE(:device, device) WHERE id = :id', pending)
+    rep.con.commit()
+    pending.clear()
+
+
+def _rows_to_scrub(rep, pass_start):
+    """Returns (id, archive_path, md5, size) rows not verified since
+    pass_start.
+
+    Rows verified in the very second the pass started are included, so a
+    new pass never misses rows verified just before it.
+    """
+    return rep.con.execute(
+        'SELECT id, archive_path, md5, size FROM photos '
+        'WHERE verified_at IS NULL OR verified_at <= ?',
+        [pass_start]).fetchall()
+
+
+def _scrub_sort_key(row):
+    """Sorts rows by disk position; unopenable files come first."""
+    try:
+        return (1,) + media_common.physical_sort_key(row[1])
+    except OSError:
+        return (0,)
+
+
+def _scrub_file(limiter, row):
+    """Hashes the file of an (id, archive_path, md5, size) row.
+
+    Returns ('ok', fingerprint) if the content matches, otherwise
+    'mismatch', 'missing' or 'unreadable'.
+    """
+    (_db_id, path, md5, size) = row
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return 'missing'
+    except OSError as e:
+        logging.error('Could not open %s: %s', path, e)
+        return 'unreadable'
+    md5_hash = hashlib.md5()
+    offset = 0
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            chunk = os.read(fd, _SCRUB_CHUNK)
+            if not chunk:
+                break
+            md5_hash.update(chunk)
+            if hasattr(os, 'posix_fadvise'):
+                # Keep a pass over the library from evicting the page
+                # cache's working set.
+                os.posix_fadvise(fd, offset, len(chunk),
+                                 os.POSIX_FADV_DONTNEED)
+            offset += len(chunk)
+            if limiter is not None:
+                limiter.acquire(len(chunk))
+        stat = os.fstat(fd)
+    except OSError as e:
+        logging.error('Could not read %s: %s', path, e)
+        return 'unreadable'
+    finally:
+        os.close(fd)
+    if offset != size or md5_hash.hexdigest() != md5:
+        return 'mismatch'
+    return ('ok', media_common.fingerprint(stat))
+
+
+def _find_similar(lib_base_dir, max_distance):
+    """Prints each cluster of archived photos that look alike, one path
+    per line and a blank line between clusters, and returns the
+    clusters.  Photos without a perceptual hash are skipped; fill those
+    in with --backfill phash.
+    """
+    rep = media_common.Repository()
+    rep.open(lib_base_dir, read_only=True)
+    try:
+        (unhashed,) = rep.con.execute(
+            'SELECT COUNT(*) FROM photos WHERE phash IS NULL').fetchone()
+        start = time.monotonic()
+        clusters = similar.find_similar(rep, max_distance)
+    finally:
+        rep.close()
+    for members in clusters:
+        for (_db_id, archive_path) in members:
+            print(archive_path)
+        print()
+    logging.info('Found %d clusters of similar photos (%d photos) in '
+                 '%.1fs; %d photos have no perceptual hash',
+                 len(clusters), sum(len(members) for members in clusters),
+                 time.monotonic() - start, unhashed)
+    return clusters
+
+
+def _export_catalog(lib_base_dir, catalog_dir=None):
+    """Exports the photos table as a columnar catalog for analytics.py,
+    by default to <lib_base_dir>/catalog.  Returns the number of photos
+    exported.
+    """
+    catalog_dir = catalog_dir or catalog.default_catalog_dir(lib_base_dir)
+    rep = media_common.Repository()
+    rep.open(lib_base_dir, read_only=True)
+    try:
+        start = time.monotonic()
+        count = catalog.export(rep, catalog_dir)
+    finally:
+        rep.close()
+    logging.info('Exported %d photos to %s in %.1fs', count, catalog_dir,
+                 time.monotonic() - start)
+    return count
+
+
+def _query(lib_base_dir, filters, columns=media_common.QUERY_COLUMNS,
+           output_format='json', limit=None, out=None):
+    """Writes the archived photos matching filters to out (default
+    stdout) as they are read: one JSON object per line, or CSV with a
+    header row.  Returns the number of photos written.
+    """
+    out = out or sys.stdout
+    rep = media_common.Repository()
+    rep.open(lib_base_dir, read_only=True)
+    try:
+        rows = rep.query(columns=columns, limit=limit, **filters)
+        written = 0
+        if output_format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        else:
+            for row in rows:
+                out.write(json.dumps(row) + '\n')
+                written += 1
+        return written
+    finally:
+        rep.close()
+
+
+def _query_filters(args):
+    """Returns the Repository.query() filters given on the command
+    line."""
+    path_prefix = args.path_prefix
+    if path_prefix and not os.path.isabs(path_prefix):
+        path_prefix = os.path.join(args.media_dir, 'photos', path_prefix)
+    return {
+        'since': media_common.parse_date(args.since) if args.since else None,
+        'before': (media_common.parse_date(args.before) if args.before
+                   else None),
+        'make': args.make,
+        'model': args.model,
+        'path_prefix': path_prefix,
+        'min_size': args.min_size,
+        'max_size': args.max_size,
+    }
+
+
+def _take_ingest_lock(args):
+    """Takes the lock that keeps two photomans from archiving into one
+    library unawares, and returns it; keep it referenced, it is held
+    until this process exits.  If another photoman holds it, returns
+    None to exit, or with --on_lock_busy join returns the unheld lock to
+    work alongside the other: staged files are claimed one by one, and a
+    Takeout export is left to the first process.
+    """
+    os.makedirs(args.media_dir, exist_ok=True)
+    lock = media_common.RunLock(
+        os.path.join(args.media_dir, media_common.INGEST_LOCK_NAME))
+    if lock.acquire():
+        return lock
+    if args.on_lock_busy == 'exit':
+        logging.info('Another photoman (%s) is archiving into %s; exiting',
+                     lock.holder(), args.media_dir)
+        return None
+    logging.info('Another photoman (%s) is archiving into %s; joining it '
+                 'as a worker', lock.holder(), args.media_dir)
+    if args.takeout_dir:
+        logging.warning('Not archiving %s; only --src_dir can be shared '
+                        'between workers', args.takeout_dir)
+        args.takeout_dir = None
+    return lock
+
+
+def _is_stream(files_from):
+    """Returns whether the --files_from list is a pipe or terminal, which
+    may not end for a long time, rather than a regular file."""
+    try:
+        if files_from == '-':
+            mode = os.fstat(sys.stdin.fileno()).st_mode
+        else:
+            mode = os.stat(files_from).st_mode
+    except (OSError, ValueError):
+        return False
+    return not stat.S_ISREG(mode)
+
+
+def _parse_columns(text):
+    """Parses the comma-separated --columns argument."""
+    columns = [column.strip() for column in text.split(',')]
+    unknown = [column for column in columns
+               if column not in media_common.PHOTO_COLUMNS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            'unknown column(s) %s; choose from %s'
+            % (','.join(unknown), ','.join(media_common.PHOTO_COLUMNS)))
+    return columns
+
+
+def _parse_backfill_fields(text):
+    """Parses the comma-separated --backfill argument."""
+    fields = [field.strip() for field in text.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in _BACKFILL_FIELDS]
+    if unknown or not fields:
+        raise argparse.ArgumentTypeError(
+            'unknown backfill field(s) %s; choose from %s'
+            % (','.join(unknown), ','.join(_BACKFILL_FIELDS)))
+    return fields
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Organize photos into a media library.')
-    parser.add_argument('--src_dir', required=True,
+    parser.add_argument('--src_dir',
                         help='Directory to scan for photos')
+    parser.add_argument('--files_from', metavar='FILE',
+                        help='Archive only the files listed in FILE (- for '
+                             'standard input), one per line or separated '
+                             'by NULs, instead of walking --src_dir; paths '
+                             'are relative to --src_dir or absolute ones in '
+                             'it')
+    parser.add_argument('--takeout_dir',
+                        help='Extracted Google Takeout export to archive '
+                             'directly, using its JSON sidecars; the export '
+                             'is never modified')
     parser.add_argument('--media_dir', required=True,
                         help='Directory of media library')
     parser.add_argument('--del_src', action='store_true',
                         help='Delete source images after archiving')
+    parser.add_argument('--sync_batch', type=int,
+                        default=media_common.DEFAULT_SYNC_BATCH,
+                        help='Flush archived copies to disk and commit the '
+                             'database every this many files, before their '
+                             'staged originals are deleted; 0 skips the '
+                             'flushes (default: %(default)s)')
+    parser.add_argument('--sync_mode', choices=media_common.SYNC_MODES,
+                        default='fsync',
+                        help='Flush each batch with an fsync per file and '
+                             'directory, or one syncfs() of the library\'s '
+                             'filesystem (default: fsync)')
+    parser.add_argument('--non_media', choices=('skip', 'delete', 'archive'),
+                        default='skip',
+                        help='What to do with staged files that are not '
+                             'photos or videos (sidecars, Thumbs.db, ...): '
+                             'leave them, delete them or archive them anyway '
+                             '(default: skip)')
+    parser.add_argument('--quarantine_after', type=int,
+                        default=DEFAULT_QUARANTINE_AFTER,
+                        help='With --del_src, move a staged file that failed '
+                             'to archive this many times (retried with '
+                             'backoff from 1 hour) to <media_dir>/quarantine '
+                             '(default: %(default)s)')
+    parser.add_argument('--schedule', choices=SCHEDULES, default='walk',
+                        help='Order to archive staged files in: as found, '
+                             'smallest first (shortest mean time to '
+                             'archive), oldest arrival first, or smallest '
+                             'first with the largest file left after every '
+                             '--schedule_budget_mb (default: walk); all but '
+                             'walk read a --files_from list to the end '
+                             'first, so they need a file, not a pipe')
+    parser.add_argument('--schedule_budget_mb', type=float,
+                        default=DEFAULT_SCHEDULE_BUDGET / 1e6,
+                        help='MB of small files archived between two large '
+                             'ones by --schedule interleave '
+                             '(default: %(default)g)')
+    parser.add_argument('--on_lock_busy', choices=('exit', 'join'),
+                        default='exit',
+                        help='If another photoman is already archiving into '
+                             '--media_dir: exit, or join it as one more '
+                             'worker on --src_dir (default: exit)')
+    parser.add_argument('--day_dirs_after', type=int, metavar='N',
+                        help='Archive photos into DD day directories in '
+                             'months holding more than N photos; saved in '
+                             'the library for later runs, 0 turns it off.  '
+                             'relayout.py moves photos already archived')
     parser.add_argument('--scan_missing', action='store_true',
                         help='Scan for deleted files in the archive')
     parser.add_argument('--group_name', default='',
                         help='Group for destination file ownership')
+    parser.add_argument('--backfill', type=_parse_backfill_fields,
+                        metavar='FIELD,...',
+                        help='Fill in missing metadata of archived photos '
+                             'from their files; fields: %s'
+                             % ','.join(_BACKFILL_FIELDS))
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Parallel workers for --backfill, '
+                             '--quick_check and --thumbnails (default: 4)')
+    parser.add_argument('--max_rate', type=float,
+                        help='Limit --backfill to this many files per '
+                             'second')
+    parser.add_argument('--scrub', action='store_true',
+                        help='Re-hash archived files and report any whose '
+                             'content no longer matches the database')
+    parser.add_argument('--scrub_mbps', type=float,
+                        help='Limit --scrub reads to this many MB/s')
+    parser.add_argument('--scrub_iops', type=float,
+                        help='Limit --scrub to this many reads per second')
+    parser.add_argument('--scrub_minutes', type=float,
+                        help='Stop --scrub after this long; the next run '
+                             'continues the pass')
+    parser.add_argument('--quick_check', action='store_true',
+                        help='Re-hash only archived files whose size, '
+                             'mtime or inode changed since archiving')
+    parser.add_argument('--find_similar', action='store_true',
+                        help='Print clusters of archived photos that look '
+                             'alike, e.g. resized or recompressed copies')
+    parser.add_argument('--similar_distance', type=int,
+                        default=similar.DEFAULT_MAX_DISTANCE,
+                        help='Most bits two perceptual hashes may differ '
+                             'by for --find_similar (default: %(default)s)')
+    parser.add_argument('--thumbnails', action='store_true',
+                        help='After archiving, make thumbnails for photos '
+                             'that have none yet')
+    parser.add_argument('--export_catalog', nargs='?', const='',
+                        metavar='DIR',
+                        help='Export the catalog for analytics.py to DIR '
+                             '(default: <media_dir>/catalog)')
+    query = parser.add_argument_group(
+        'query', 'List archived photos matching all the given filters')
+    query.add_argument('--query', action='store_true',
+                       help='Print the matching photos, oldest first')
+    query.add_argument('--count', action='store_true',
+                       help='Print only the number of matching photos')
+    query.add_argument('--since', help='Taken on or after this date '
+                                       '(YYYY-MM-DD)')
+    query.add_argument('--before', help='Taken before this date '
+                                        '(YYYY-MM-DD)')
+    query.add_argument('--make', help='Camera make (whole value, any case)')
+    query.add_argument('--model', help='Camera model (whole value, any '
+                                       'case)')
+    query.add_argument('--path_prefix',
+                       help='Archive path starts with this (relative paths '
+                            'are under <media_dir>/photos)')
+    query.add_argument('--min_size', type=int, help='At least this many '
+                                                    'bytes')
+    query.add_argument('--max_size', type=int, help='At most this many '
+                                                    'bytes')
+    query.add_argument('--columns', type=_parse_columns,
+                       default=media_common.QUERY_COLUMNS,
+                       help='Comma-separated columns to print (default: '
+                            '%s)' % ','.join(media_common.QUERY_COLUMNS))
+    query.add_argument('--format', choices=('json', 'csv'), default='json',
+                       help='JSON lines or CSV (default: json)')
+    query.add_argument('--limit', type=int, help='Print at most this many '
+                                                 'photos')
     args = parser.parse_args()
+    if not (args.src_dir or args.takeout_dir or args.backfill
+            or args.scrub or args.quick_check or args.find_similar
+            or args.thumbnails or args.export_catalog is not None
+            or args.query or args.count or args.day_dirs_after is not None):
+        parser.error('one of --src_dir, --takeout_dir, --day_dirs_after, '
+                     '--backfill, --scrub, --quick_check, --find_similar, '
+                     '--thumbnails, --export_catalog, --query or --count '
+                     'is required')
+    if args.day_dirs_after is not None and args.day_dirs_after < 0:
+        parser.error('--day_dirs_after must be 0 or more')
+    if args.sync_batch < 0:
+        parser.error('--sync_batch must be 0 or more')
+    if args.files_from and not args.src_dir:
+        parser.error('--files_from needs --src_dir, the staging directory '
+                     'the files are in')
+    if (args.files_from and args.schedule != 'walk'
+            and _is_stream(args.files_from)):
+        parser.error('--schedule %s reads the whole --files_from list '
+                     'before archiving anything; use --schedule walk with a '
+                     'pipe' % args.schedule)
+    if args.query or args.count:
+        try:
+            filters = _query_filters(args)
+        except ValueError as e:
+            parser.error(str(e))
 
-    # Safety: refuse to run if src_dir is inside the archive itself
+    # Safety: refuse to run if a source is inside the archive itself
     archive_photos = os.path.abspath(os.path.join(args.media_dir, 'photos'))
-    src_abs = os.path.abspath(args.src_dir)
-    if src_abs.startswith(archive_photos + os.sep) or src_abs == archive_photos:
-        logging.error('Source directory %s is inside the archive %s. '
-                       'Refusing to run — this would delete archived '
-                       'photos if --del_src is set.', args.src_dir,
-                       archive_photos)
-        sys.exit(1)
+    for source_dir in (args.src_dir, args.takeout_dir):
+        if not source_dir:
+            continue
+        src_abs = os.path.abspath(source_dir)
+        if (src_abs.startswith(archive_photos + os.sep)
+                or src_abs == archive_photos):
+            logging.error('Source directory %s is inside the archive %s. '
+                           'Refusing to run — this would delete archived '
+                           'photos if --del_src is set.', source_dir,
+                           archive_photos)
+            sys.exit(1)
 
     try:
         media_common.configure_logging('photoman.log')
-        _find_and_archive_photos(args.src_dir, args.media_dir,
-                                 args.del_src, args.group_name)
+        if args.day_dirs_after is not None:
+            _set_day_dirs_after(args.media_dir, args.day_dirs_after)
+        ingest_lock = None
+        if args.src_dir or args.takeout_dir:
+            ingest_lock = _take_ingest_lock(args)
+            if ingest_lock is None:
+                return
+        if args.takeout_dir:
+            _ingest_takeout(args.takeout_dir, args.media_dir,
+                            args.group_name)
+        if args.src_dir:
+            _archive_staging(args)
         if args.scan_missing:
-            _scan_missing_photos(args.media_dir)
+            _scan_missing_photos(args.media_dir, ingest_lock)
+        if args.backfill:
+            _backfill(args.media_dir, args.backfill, args.workers,
+                      args.max_rate)
+        if args.scrub:
+            _scrub(args.media_dir, args.scrub_mbps, args.scrub_iops,
+                   args.scrub_minutes)
+        if args.quick_check:
+            _quick_check(args.media_dir, args.workers)
+        if args.find_similar:
+            _find_similar(args.media_dir, args.similar_distance)
+        if args.thumbnails:
+            thumbnails.generate_all(args.media_dir, workers=args.workers)
+        if args.export_catalog is not None:
+            _export_catalog(args.media_dir, args.export_catalog)
+        if args.count:
+            rep = media_common.Repository()
+            rep.open(args.media_dir, read_only=True)
+            try:
+                print(rep.count(**filters))
+            finally:
+                rep.close()
+        if args.query:
+            _query(args.media_dir, filters, args.columns, args.format,
+                   args.limit)
+    except BrokenPipeError:
+        # The reader (e.g. head) went away; that's not an error.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
     except Exception:
         logging.exception('An unexpected error occurred during '
                           'photo archiving')
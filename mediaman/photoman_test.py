@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 
+import argparse
 import glob
+import io
+import json
 import logging
 import os
 import os.path
+import claims
+import jpeg_segments
 import photoman
 import media_common
 import shutil
+import sqlite3
 import tempfile
+import time
 import unittest
 from unittest.mock import *
 
+from PIL import Image
+
 
 class PhotoManFunctionalTests(unittest.TestCase):
 
@@ -195,6 +204,818 @@ class PhotoManFunctionalTests(unittest.TestCase):
         ])
         copystat.assert_called_with('/tmp/foo.txt', '/tmp/blah/foo_1.txt')
 
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_ingest_takeout(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            takeout = os.path.join(tmpdir, 'Takeout', 'Photos from 2015')
+            mediadir = os.path.join(tmpdir, 'media')
+            os.makedirs(takeout)
+            self._copy_test_images(takeout, '')
+            video = os.path.join(takeout, 'clip.mp4')
+            with open(video, 'wb') as fh:
+                fh.write(b'not really a video')
+            ts = int(time.mktime((2015, 5, 5, 12, 0, 0, 0, 0, -1)))
+            with open(video + '.supplemental-metadata.json', 'w') as fh:
+                json.dump({'photoTakenTime': {'timestamp': str(ts)},
+                           'description': 'Fireworks',
+                           'geoData': {'latitude': 40.5,
+                                       'longitude': -74.25}}, fh)
+            before = {path: os.stat(path).st_mtime for path in
+                      glob.glob(os.path.join(takeout, '**'), recursive=True)}
+
+            photoman._ingest_takeout(os.path.join(tmpdir, 'Takeout'),
+                                     mediadir, 'foo')
+
+            archived = os.path.join(mediadir, 'photos/2015/05_May/clip.mp4')
+            self.assertTrue(os.path.isfile(archived))
+            self.assertEqual(ts, int(os.path.getmtime(archived)))
+            self.assertTrue(os.path.isfile(os.path.join(
+                mediadir, 'photos/2012/07_July/gnexus 160.jpg')))
+            after = {path: os.stat(path).st_mtime for path in
+                     glob.glob(os.path.join(takeout, '**'), recursive=True)}
+            self.assertEqual(before, after, 'export must not be modified')
+
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            row = rep.con.execute(
+                'SELECT description, latitude, longitude, timestamp '
+                'FROM photos WHERE archive_path = ?', [archived]).fetchone()
+            self.assertEqual(('Fireworks', 40.5, -74.25, ts), row)
+            self.assertEqual(6, self._get_row_count(rep))
+            rep.close()
+
+            # A second ingest of the same export archives nothing new.
+            photoman._ingest_takeout(os.path.join(tmpdir, 'Takeout'),
+                                     mediadir, 'foo')
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(6, self._get_row_count(rep))
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_backfill(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            gnexus = os.path.join(mediadir, 'photos/2012/07_July/'
+                                  'gnexus 160.jpg')
+            geotagged = os.path.join(mediadir, 'photos/geotagged.jpg')
+            exif = Image.Exif()
+            exif[0x8825] = {1: 'N', 2: (51.0, 30.0, 0.0),
+                            3: 'W', 4: (0.0, 6.0, 0.0)}
+            Image.new('RGB', (8, 4)).save(geotagged, exif=exif)
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            rep.con.execute(
+                "INSERT INTO photos (md5, size, archive_path) "
+                "VALUES ('geo', 1, ?)", [geotagged])
+            # Rows from before these fields were parsed.
+            rep.con.execute(
+                'UPDATE photos SET camera_make = NULL, orientation = NULL, '
+                'width = NULL, height = NULL, latitude = NULL, '
+                'longitude = NULL')
+            rep.con.execute("UPDATE photos SET camera_model = 'Custom' "
+                            "WHERE archive_path = ?", [gnexus])
+            rep.close()
+
+            counts = photoman._backfill(
+                mediadir, ['camera', 'gps', 'dimensions', 'orientation',
+                           'timestamp'], workers=2)
+            self.assertEqual({'filled': 6}, counts)
+
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            query = ('SELECT camera_make, camera_model, orientation, width, '
+                     'height, latitude, longitude FROM photos '
+                     'WHERE archive_path = ?')
+            self.assertEqual(('Samsung', 'Custom', 0, 2592, 1944, None,
+                              None),
+                             rep.con.execute(query, [gnexus]).fetchone())
+            (make, model, orientation, width, height, latitude,
+             longitude) = rep.con.execute(query, [geotagged]).fetchone()
+            self.assertEqual((None, None, None, 8, 4),
+                             (make, model, orientation, width, height))
+            self.assertAlmostEqual(51.5, latitude)
+            self.assertAlmostEqual(-0.1, longitude)
+            self.assertIsNotNone(rep.con.execute(
+                'SELECT timestamp FROM photos WHERE archive_path = ?',
+                [geotagged]).fetchone()[0])
+            rep.close()
+
+            # Rows whose files lack some fields aren't read again.
+            self.assertEqual({'already_done': 6}, photoman._backfill(
+                mediadir, ['camera', 'gps', 'dimensions', 'orientation',
+                           'timestamp']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_scrub(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            photos = sorted(glob.glob(os.path.join(mediadir, 'photos',
+                                                   '*', '*', '*')))
+            with open(photos[0], 'r+b') as fh:
+                fh.seek(1000)
+                fh.write(b'\x00rot')
+            os.remove(photos[1])
+
+            counts = photoman._scrub(mediadir)
+            self.assertEqual({'ok': 3, 'mismatch': 1, 'missing': 1}, counts)
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            statuses = dict(rep.con.execute(
+                'SELECT archive_path, verify_status FROM photos '
+                'WHERE verified_at IS NOT NULL'))
+            self.assertEqual('mismatch', statuses[photos[0]])
+            self.assertEqual('missing', statuses[photos[1]])
+            self.assertEqual({'ok'}, set(statuses[p] for p in photos[2:]))
+
+            # A pass can be spread over several runs.
+            rep.con.execute('UPDATE photos SET verified_at = NULL '
+                            'WHERE archive_path = ?', [photos[2]])
+            rep.close()
+            self.assertEqual({}, photoman._scrub(mediadir, max_minutes=0))
+            self.assertEqual({'ok': 1}, photoman._scrub(mediadir))
+            # Then the next run starts a new pass.
+            self.assertEqual({'ok': 3, 'mismatch': 1, 'missing': 1},
+                             photoman._scrub(mediadir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_quick_check(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            photos = sorted(glob.glob(os.path.join(mediadir, 'photos',
+                                                   '*', '*', '*')))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            stored = rep.con.execute(
+                'SELECT size, mtime_ns, inode, device FROM photos '
+                'WHERE archive_path = ?', [photos[0]]).fetchone()
+            self.assertEqual(media_common.fingerprint(os.stat(photos[0])),
+                             stored)
+            rep.close()
+
+            with patch.object(photoman, '_scrub_file') as scrub_file:
+                self.assertEqual({'unchanged': 5, 'untracked': 0},
+                                 photoman._quick_check(mediadir))
+            scrub_file.assert_not_called()
+
+            # Rotated in place, touched only, deleted, and a stray file.
+            with open(photos[0], 'r+b') as fh:
+                fh.seek(1000)
+                fh.write(b'\x00rot')
+            os.utime(photos[1], ns=(0, 10 ** 18))
+            os.remove(photos[2])
+            open(os.path.join(mediadir, 'photos', 'stray.jpg'), 'w').close()
+            counts = photoman._quick_check(mediadir)
+            self.assertEqual({'unchanged': 2, 'ok': 1, 'mismatch': 1,
+                              'missing': 1, 'untracked': 1}, counts)
+
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(('ok', 10 ** 18), rep.con.execute(
+                'SELECT verify_status, mtime_ns FROM photos '
+                'WHERE archive_path = ?', [photos[1]]).fetchone())
+            self.assertEqual('mismatch', rep.con.execute(
+                'SELECT verify_status FROM photos WHERE archive_path = ?',
+                [photos[0]]).fetchone()[0])
+            rep.close()
+            # The touched file now has its new fingerprint.
+            self.assertEqual(3, photoman._quick_check(mediadir)['unchanged'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def _archive_for_quick_check(self):
+        """Archives the test photos; returns (mediadir, tmpdir, sorted
+        archive paths)."""
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+        photos = sorted(glob.glob(os.path.join(mediadir, 'photos',
+                                               '*', '*', '*')))
+        return (mediadir, tmpdir, photos)
+
+    def _fingerprint_row(self, mediadir, path):
+        rep = media_common.Repository()
+        rep.open(mediadir)
+        try:
+            return rep.con.execute(
+                'SELECT size, mtime_ns, inode, device FROM photos '
+                'WHERE archive_path = ?', [path]).fetchone()
+        finally:
+            rep.close()
+
+    def test_quick_check_hashes_only_changed_files(self):
+        (mediadir, tmpdir, photos) = self._archive_for_quick_check()
+        try:
+            os.utime(photos[3], ns=(0, 10 ** 18))
+            with patch.object(photoman, '_scrub_file',
+                              wraps=photoman._scrub_file) as scrub_file:
+                self.assertEqual({'unchanged': 4, 'ok': 1, 'untracked': 0},
+                                 photoman._quick_check(mediadir))
+            self.assertEqual([photos[3]], [call_args[0][1][1] for call_args
+                                           in scrub_file.call_args_list])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_quick_check_same_size_new_mtime(self):
+        """An edit in place that keeps the size is caught by the mtime."""
+        (mediadir, tmpdir, photos) = self._archive_for_quick_check()
+        try:
+            size = os.path.getsize(photos[0])
+            with open(photos[0], 'r+b') as fh:
+                fh.seek(size // 2)
+                fh.write(b'\xffedited')
+            os.utime(photos[0], ns=(0, 2 * 10 ** 18))
+            self.assertEqual(size, os.path.getsize(photos[0]))
+            self.assertEqual({'unchanged': 4, 'mismatch': 1, 'untracked': 0},
+                             photoman._quick_check(mediadir))
+            # A mismatch keeps the old fingerprint, so it is found again.
+            self.assertNotEqual(2 * 10 ** 18,
+                                self._fingerprint_row(mediadir, photos[0])[1])
+            self.assertEqual(1, photoman._quick_check(mediadir)['mismatch'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_quick_check_fingerprints_rows_without_one(self):
+        """Rows from before fingerprints are hashed once, then skipped."""
+        (mediadir, tmpdir, photos) = self._archive_for_quick_check()
+        try:
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            rep.con.execute('UPDATE photos SET mtime_ns = NULL, '
+                            'inode = NULL, device = NULL '
+                            'WHERE archive_path = ?', [photos[1]])
+            rep.close()
+            self.assertEqual({'unchanged': 4, 'ok': 1, 'untracked': 0},
+                             photoman._quick_check(mediadir))
+            self.assertEqual(media_common.fingerprint(os.stat(photos[1])),
+                             self._fingerprint_row(mediadir, photos[1]))
+            with patch.object(photoman, '_scrub_file') as scrub_file:
+                self.assertEqual({'unchanged': 5, 'untracked': 0},
+                                 photoman._quick_check(mediadir))
+            scrub_file.assert_not_called()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_scrub_file_throttles_and_drops_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'big.bin')
+            data = os.urandom(photoman._SCRUB_CHUNK + 10)
+            with open(path, 'wb') as fh:
+                fh.write(data)
+            row = (1, path, media_common.compute_md5(path), len(data))
+            limiter = Mock()
+            with patch('os.posix_fadvise') as fadvise:
+                (status, fingerprint) = photoman._scrub_file(limiter, row)
+            self.assertEqual('ok', status)
+            self.assertEqual(media_common.fingerprint(os.stat(path)),
+                             fingerprint)
+            self.assertEqual([call(photoman._SCRUB_CHUNK), call(10)],
+                             limiter.acquire.call_args_list)
+            self.assertEqual(
+                [call(ANY, 0, photoman._SCRUB_CHUNK,
+                      os.POSIX_FADV_DONTNEED),
+                 call(ANY, photoman._SCRUB_CHUNK, 10,
+                      os.POSIX_FADV_DONTNEED)],
+                [c for c in fadvise.call_args_list
+                 if c.args[3] == os.POSIX_FADV_DONTNEED])
+            self.assertEqual('mismatch', photoman._scrub_file(
+                None, (1, path, row[2], len(data) + 1)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_similar_photos(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            original = os.path.join(mediadir, 'photos/2006/06_June/'
+                                    'DSC09012.JPG')
+            with Image.open(original) as image:
+                exif = image.getexif()
+                image.thumbnail((400, 400))
+                image.save(os.path.join(srcdir, 'forwarded.jpg'),
+                           quality=40, exif=exif)
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            rows = dict((row[0], row[1:]) for row in rep.con.execute(
+                'SELECT archive_path, id, similar_to FROM photos'))
+            copy = os.path.join(mediadir, 'photos/2006/06_June/'
+                                'forwarded.jpg')
+            self.assertEqual(rows[original][0], rows[copy][1])
+            self.assertEqual([None] * 5,
+                             [similar_to for (path, (_id, similar_to))
+                              in rows.items() if path != copy])
+            rep.close()
+
+            with patch('builtins.print'):
+                clusters = photoman._find_similar(mediadir, 6)
+            self.assertEqual([[original, copy]],
+                             [[path for (_id, path) in members]
+                              for members in clusters])
+
+            # Rows archived before hashing are filled in by backfill.
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            rep.con.execute('UPDATE photos SET phash = NULL')
+            rep.close()
+            self.assertEqual({'filled': 6},
+                             photoman._backfill(mediadir, ['phash']))
+            with patch('builtins.print'):
+                self.assertEqual(1, len(photoman._find_similar(mediadir,
+                                                               6)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_retagged_copy_is_a_duplicate(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            gnexus = os.path.join(mediadir, 'photos/2012/07_July/'
+                                  'gnexus 160.jpg')
+            retagged = os.path.join(srcdir, 'gnexus 160_isoremoved.jpg')
+            jpeg_segments.copy_without_exif_tag(
+                gnexus, retagged, jpeg_segments.ISO_SPEED_RATINGS)
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            self.assertFalse(os.path.exists(retagged))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(5, self._get_row_count(rep))
+
+            # Rows from before the content digest are backfilled.
+            rep.con.execute('UPDATE photos SET content_md5 = NULL')
+            rep.close()
+            self.assertEqual({'filled': 5},
+                             photoman._backfill(mediadir, ['content']))
+            jpeg_segments.copy_without_exif_tag(
+                gnexus, retagged, jpeg_segments.ISO_SPEED_RATINGS)
+            photoman._find_and_archive_photos(srcdir, mediadir, False, 'foo')
+            self.assertTrue(os.path.exists(retagged))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(5, self._get_row_count(rep))
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_query(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            out = io.StringIO()
+            filters = {'since': media_common.parse_date('2006-01-01'),
+                       'make': 'sony'}
+            self.assertEqual(1, photoman._query(mediadir, filters, out=out))
+            row = json.loads(out.getvalue())
+            self.assertEqual(
+                os.path.join(mediadir, 'photos/2006/06_June/DSC09012.JPG'),
+                row['archive_path'])
+            self.assertEqual('SONY', row['camera_make'])
+
+            out = io.StringIO()
+            prefix = os.path.join(mediadir, 'photos', '2006')
+            self.assertEqual(2, photoman._query(
+                mediadir, {'path_prefix': prefix}, ('md5', 'size'), 'csv',
+                out=out))
+            lines = out.getvalue().splitlines()
+            self.assertEqual(['md5,size', 3], [lines[0], len(lines)])
+
+            out = io.StringIO()
+            self.assertEqual(2, photoman._query(mediadir, {}, ('id',),
+                                                limit=2, out=out))
+            self.assertEqual(2, len(out.getvalue().splitlines()))
+
+            # Nothing matches: no JSON lines, only the CSV header.
+            for (output_format, expected) in (('json', ''),
+                                              ('csv', 'id\r\n')):
+                out = io.StringIO()
+                self.assertEqual(0, photoman._query(
+                    mediadir, {'make': 'Leica'}, ('id',), output_format,
+                    out=out))
+                self.assertEqual(expected, out.getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_workers_share_staging(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            # Another worker, still running, holds one file.
+            other = claims.ClaimQueue(srcdir, name='otherhost-1')
+            other.open()
+            other.claim(os.path.join(srcdir, 'DSC09012.JPG'))
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(4, self._get_row_count(rep))
+            rep.close()
+            self.assertEqual(['otherhost-1'], os.listdir(
+                os.path.join(srcdir, claims.CLAIMS_DIR_NAME)))
+            # Once it gives the file back, the next run archives it.
+            other.close()
+            self.assertTrue(os.path.isfile(os.path.join(srcdir,
+                                                        'DSC09012.JPG')))
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            self.assertEqual([], list(media_common.walk_files(srcdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_failing_file_backs_off_and_is_quarantined(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = os.path.join(tmpdir, 'src')
+            mediadir = os.path.join(tmpdir, 'media')
+            os.mkdir(srcdir)
+            poison = os.path.join(srcdir, 'poison.mov')
+            with open(poison, 'wb') as fh:
+                fh.write(b'\x00\x00\x00\x18ftypqt  ' + b'x' * 100)
+
+            def run():
+                photoman._find_and_archive_photos(srcdir, mediadir, True,
+                                                  'foo', quarantine_after=3)
+
+            with patch.object(media_common.Photo, 'load_metadata',
+                              side_effect=IOError('bad atom')) as load:
+                run()
+                # The next hourly run doesn't touch it again.
+                run()
+                self.assertEqual(1, load.call_count)
+                self.assertTrue(os.path.isfile(poison))
+                for _ in range(2):
+                    rep = media_common.Repository()
+                    rep.open(mediadir)
+                    rep.con.execute('UPDATE ingest_failures SET retry_at = 0')
+                    rep.close()
+                    run()
+                self.assertEqual(3, load.call_count)
+            quarantined = os.path.join(mediadir, 'quarantine', 'poison.mov')
+            self.assertFalse(os.path.exists(poison))
+            self.assertTrue(os.path.isfile(quarantined))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(
+                [(3, 'OSError: bad atom', quarantined)],
+                rep.con.execute('SELECT attempts, error, quarantined_to '
+                                'FROM ingest_failures').fetchall())
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_non_media_files(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            junk = [os.path.join(srcdir, name) for name in
+                    ('DSC09012.JPG.json', 'Thumbs.db', 'desktop.ini')]
+            for path in junk:
+                with open(path, 'w') as fh:
+                    fh.write('not a photo')
+            with patch('media_common.read_image_metadata',
+                       wraps=media_common.read_image_metadata) as read:
+                photoman._find_and_archive_photos(srcdir, mediadir, True,
+                                                  'foo')
+            # Only the five photos were opened and archived.
+            self.assertEqual(5, read.call_count)
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(5, self._get_row_count(rep))
+            rep.close()
+            self.assertEqual(sorted(junk),
+                             sorted(media_common.walk_files(srcdir)))
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo',
+                                              non_media='delete')
+            self.assertEqual([], list(media_common.walk_files(srcdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_day_directories(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            photoman._set_day_dirs_after(mediadir, 1)
+            july_2012 = time.mktime((2012, 7, 1, 0, 0, 0, 0, 0, -1))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            rep.con.execute("INSERT INTO photos (md5, size, timestamp) "
+                            "VALUES ('f', 1, ?)", (july_2012,))
+            rep.close()
+            photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+            rep.open(mediadir)
+            (archive_path, timestamp) = rep.con.execute(
+                "SELECT archive_path, timestamp FROM photos WHERE "
+                "archive_path LIKE '%gnexus%'").fetchone()
+            rep.close()
+            # The month's second photo, the others are alone in theirs.
+            self.assertEqual(media_common.archive_dir(mediadir, timestamp,
+                                                      day_dir=True),
+                             os.path.dirname(archive_path))
+            self.assertTrue(os.path.isfile(archive_path))
+            self.assertTrue(os.path.isfile(os.path.join(
+                mediadir, 'photos', '2006', '06_June', 'DSC09012.JPG')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_schedule(self):
+        entries = [('video', 900, 1), ('a', 10, 3), ('b', 20, 2),
+                   ('raw', 500, 5), ('c', 30, 4)]
+        order = lambda schedule, *args: [
+            entry[0] for entry in photoman._schedule(entries, schedule,
+                                                     *args)]
+        self.assertEqual(['video', 'a', 'b', 'raw', 'c'], order('walk'))
+        self.assertEqual(['a', 'b', 'c', 'raw', 'video'], order('smallest'))
+        self.assertEqual(['video', 'b', 'a', 'c', 'raw'], order('oldest'))
+        # The largest file left goes after every 25 bytes of small ones.
+        self.assertEqual(['a', 'b', 'video', 'c', 'raw'],
+                         order('interleave', 25))
+
+    def test_scheduled_ingest(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            sizes = [os.path.getsize(photo.source_path) for photo in
+                     photoman._iter_staged_photos(srcdir,
+                                                  schedule='smallest')]
+            self.assertEqual(5, len(sizes))
+            self.assertEqual(sorted(sizes), sizes)
+            latencies = photoman._find_and_archive_photos(
+                srcdir, mediadir, True, '', schedule='interleave')
+            self.assertEqual(5, len(latencies))
+            self.assertEqual(sorted(latencies), latencies)
+            self.assertEqual([], list(media_common.walk_files(srcdir)))
+            summary = photoman._latency_summary([1, 2, 3, 4, 10])
+            self.assertEqual((5, 4, 3, 10, 10, 10),
+                             tuple(summary[name] for name in
+                                   ('files', 'mean', 'p50', 'p90', 'p99',
+                                    'max')))
+            self.assertIsNone(photoman._latency_summary([]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_oldest_keeps_recovered_file_first(self):
+        """A file put back after its worker crashed goes before the files
+        that arrived after it, though the renames reset its ctime."""
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            first = os.path.join(srcdir, 'IMG_1427.JPG')
+            try:
+                os.setxattr(first, 'user.test', b'1')
+            except (OSError, AttributeError):
+                self.skipTest('no user extended attributes here')
+            time.sleep(0.05)
+            for path in media_common.walk_files(srcdir):
+                if path != first:
+                    os.chmod(path, 0o644)
+            crashed = claims.ClaimQueue(srcdir, name='otherhost-12')
+            crashed.claim(first)
+            os.utime(crashed.worker_dir, (0, 0))
+            time.sleep(0.05)
+            queue = claims.ClaimQueue(srcdir, name='host-1', stale_after=600)
+            queue.open()
+            queue.close()
+            paths = [photo.source_path for photo in
+                     photoman._iter_staged_photos(srcdir, schedule='oldest')]
+            self.assertEqual(5, len(paths))
+            self.assertEqual(first, paths[0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_read_file_list(self):
+        read = lambda data: list(photoman._read_file_list(io.BytesIO(data)))
+        self.assertEqual(['a.jpg', 'sub/b c.jpg'],
+                         read(b'a.jpg\nsub/b c.jpg\n\n'))
+        self.assertEqual(['a.jpg', 'b.jpg'], read(b'a.jpg\r\nb.jpg'))
+        self.assertEqual(['new\nline.jpg', 'b.jpg'],
+                         read(b'new\nline.jpg\0b.jpg\0'))
+        self.assertEqual(['only.jpg'], read(b'only.jpg'))
+        self.assertEqual([], read(b''))
+
+    def test_files_from(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            outside = os.path.join(tmpdir, 'outside.jpg')
+            shutil.copy(os.path.join(srcdir, 'DSC09012.JPG'), outside)
+            listed = [b'DSC09012.JPG',
+                      os.fsencode(os.path.join(srcdir, 'foo',
+                                               'gnexus 160.jpg')),
+                      os.fsencode(outside), b'../outside.jpg',
+                      b'missing.jpg', b'.claims/x/IMG_1427.JPG']
+            with patch('photoman._walk_staged') as walk:
+                photoman._find_and_archive_photos(
+                    srcdir, mediadir, True, '',
+                    files_from=photoman._read_file_list(
+                        io.BytesIO(b'\0'.join(listed))))
+            walk.assert_not_called()
+            # Only the two listed files in srcdir were archived.
+            self.assertEqual(
+                ['105-0555_IMG.JPG', '594-9436_IMG.JPG', 'IMG_1427.JPG'],
+                sorted(os.path.basename(path) for path in
+                       media_common.walk_files(srcdir)))
+            self.assertTrue(os.path.isfile(outside))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(2, self._get_row_count(rep))
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sources_deleted_after_sync(self):
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            events = []
+            fsync_path = media_common._fsync_path
+            remove = os.remove
+
+            def record_fsync(path):
+                events.append(('sync', os.path.basename(path)))
+                fsync_path(path)
+
+            def record_remove(path):
+                events.append(('remove', os.path.basename(path)))
+                remove(path)
+
+            with patch('media_common._fsync_path', new=record_fsync), \
+                    patch('os.remove', new=record_remove):
+                photoman._find_and_archive_photos(srcdir, mediadir, True, '',
+                                                  sync_batch=2)
+            removed = [name for (event, name) in events if event == 'remove']
+            self.assertEqual(5, len(removed))
+            for name in removed:
+                self.assertLess(events.index(('sync', name)),
+                                events.index(('remove', name)))
+            self.assertEqual([], list(media_common.walk_files(srcdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_failed_sync_forgets_rolled_back_photos(self):
+        """A photo whose batch failed to sync is not matched later: its
+        row is gone and a new row takes its id."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            srcdir = os.path.join(tmpdir, 'src')
+            mediadir = os.path.join(tmpdir, 'media')
+            os.mkdir(srcdir)
+            original = os.path.join(srcdir, 'DSC09012.JPG')
+            shutil.copy(os.path.join(os.path.dirname(
+                os.path.realpath(__file__)), 'test', 'DSC09012.JPG'),
+                        original)
+            with Image.open(original) as image:
+                exif = image.getexif()
+                image.thumbnail((400, 400))
+                image.save(os.path.join(srcdir, 'forwarded.jpg'),
+                           quality=40, exif=exif)
+            fsync_path = media_common._fsync_path
+            failed = []
+
+            def fail_first_sync(path):
+                if not failed:
+                    failed.append(path)
+                    raise OSError(5, 'EIO')
+                fsync_path(path)
+
+            with patch('media_common._fsync_path', new=fail_first_sync):
+                photoman._find_and_archive_photos(srcdir, mediadir, True, '',
+                                                  sync_batch=1)
+            self.assertTrue(failed)
+            self.assertEqual(1, len(list(media_common.walk_files(srcdir))))
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual([None], [row[0] for row in rep.con.execute(
+                'SELECT similar_to FROM photos')])
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_failure_does_not_commit_unsynced_rows(self):
+        """Recording a failure mid-batch leaves the rows of the copies
+        made so far uncommitted until they are synced."""
+        (srcdir, mediadir, tmpdir) = self._setup_test_data()
+        try:
+            load_metadata = media_common.Photo.load_metadata
+            loaded = []
+
+            def flaky_load_metadata(photo):
+                loaded.append(photo.source_path)
+                if len(loaded) == 3:
+                    raise OSError(5, 'EIO')
+                load_metadata(photo)
+
+            record = media_common.IngestFailures.record
+            committed = []
+            synced = []
+
+            def record_and_count(failures, *args, **kwargs):
+                result = record(failures, *args, **kwargs)
+                con = sqlite3.connect(os.path.join(mediadir, 'media.db'))
+                committed.append(con.execute(
+                    'SELECT count(*) FROM photos').fetchone()[0])
+                con.close()
+                return result
+
+            with patch.object(media_common.Photo, 'load_metadata',
+                              new=flaky_load_metadata), \
+                    patch.object(media_common.IngestFailures, 'record',
+                                 new=record_and_count), \
+                    patch('media_common._fsync_path',
+                          side_effect=synced.append):
+                photoman._find_and_archive_photos(srcdir, mediadir, True, '',
+                                                  sync_batch=100)
+            self.assertEqual([0], committed)
+            self.assertTrue(synced)
+            rep = media_common.Repository()
+            rep.open(mediadir)
+            self.assertEqual(4, self._get_row_count(rep))
+            self.assertEqual(1, rep.con.execute(
+                'SELECT count(*) FROM ingest_failures').fetchone()[0])
+            rep.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_ingest_lock(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = argparse.Namespace(media_dir=tmpdir, on_lock_busy='exit',
+                                      takeout_dir='/takeout')
+            first = photoman._take_ingest_lock(args)
+            self.assertIsNotNone(first)
+            self.assertIsNone(photoman._take_ingest_lock(args))
+            args.on_lock_busy = 'join'
+            self.assertIsNotNone(photoman._take_ingest_lock(args))
+            self.assertIsNone(args.takeout_dir)
+            first.release()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_is_stream(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            list_path = os.path.join(tmpdir, 'list')
+            open(list_path, 'w').close()
+            self.assertFalse(photoman._is_stream(list_path))
+            fifo = os.path.join(tmpdir, 'fifo')
+            os.mkfifo(fifo)
+            self.assertTrue(photoman._is_stream(fifo))
+            (read_fd, write_fd) = os.pipe()
+            os.close(write_fd)
+            with os.fdopen(read_fd) as pipe, patch('sys.stdin', new=pipe):
+                self.assertTrue(photoman._is_stream('-'))
+            with open(list_path) as fh, patch('sys.stdin', new=fh):
+                self.assertFalse(photoman._is_stream('-'))
+            # Left for open() to report.
+            self.assertFalse(photoman._is_stream(
+                os.path.join(tmpdir, 'missing')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_columns(self):
+        self.assertEqual(['md5', 'size'], photoman._parse_columns('md5, size'))
+        for text in ('md5,colour', 'md5,', 'md5; DROP TABLE photos'):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              photoman._parse_columns, text)
+
+    @patch('sys.stderr', new_callable=io.StringIO)
+    def test_invalid_columns_is_a_usage_error(self, stderr):
+        argv = ['photoman.py', '--media_dir', '/nonexistent', '--query',
+                '--columns', 'md5,colour']
+        with patch('sys.argv', argv):
+            with self.assertRaises(SystemExit) as raised:
+                photoman.main()
+        self.assertEqual(2, raised.exception.code)
+        self.assertIn('unknown column(s) colour', stderr.getvalue())
+
+    def test_parse_backfill_fields(self):
+        self.assertEqual(['gps', 'camera'],
+                         photoman._parse_backfill_fields('gps, camera'))
+        self.assertRaises(argparse.ArgumentTypeError,
+                          photoman._parse_backfill_fields, 'gps,colour')
+
     def _get_row_count(self, repository):
         cur = repository.con.cursor()
         cur.execute('select id, archive_path FROM photos')
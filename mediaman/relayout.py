@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""Shifts the timestamps of archived photos and moves them to match.
+
+Photos are selected from media.db by camera make/model, archive path
+prefix and date range.  Their timestamps are shifted by a clock offset
+(e.g. +1y for the Flip camera, whose clock was a year behind) and photos
+whose YYYY/MM_Month directory changes are renamed into place, on the same
+filesystem and never by copying.  With no offset, photos are just moved
+to where their current timestamp says they belong.  That includes the
+library's day directories (photoman.py --day_dirs_after): a run after
+turning them on moves the photos of every month over the threshold into
+MM_Month/DD, and one after turning them off moves them back.
+
+Every planned move is first written to a journal in the library.  The
+file moves follow, with the database updated in transactions of
+batch_size photos so the nightly jobs can keep writing in between, and
+the journal is removed.  If a run is interrupted, the next one rolls the
+journal forward before doing anything else.
+
+A run holds the library's ingest lock throughout, so no photoman ingest
+starts and photoman --scan_missing doesn't take moved photos for
+deleted ones.  The scan also refuses to run while a journal is left.
+
+Usage:
+    relayout.py --media_dir /library --model Flip --offset +1y
+    relayout.py --media_dir /library --day_dirs_after 5000
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+import os.path
+import re
+import sys
+import time
+
+import media_common
+
+JOURNAL_NAME = 'relayout.journal'
+
+# Photos updated per database transaction.
+DEFAULT_BATCH_SIZE = 1000
+
+_OFFSET_RE = re.compile(r'([+-]?)((?:\d+[ydhms])+)$')
+
+_OFFSET_PART_RE = re.compile(r'(\d+)([ydhms])')
+
+_UNIT_SECONDS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+# Errors from os.link meaning the filesystem has no hard links.
+_NO_LINK_ERRNOS = frozenset({errno.EPERM, errno.EOPNOTSUPP, errno.ENOSYS})
+
+
+def parse_offset(text):
+    """Parses a clock offset such as '+1y', '-3h' or '1y2d30m'.
+
+    Returns (years, seconds).  Years are applied to the calendar date, so
+    '+1y' keeps the day and time of day.
+    """
+    match = _OFFSET_RE.match(text.strip())
+    if not match:
+        raise ValueError('bad offset %r, expected e.g. +1y, -3h or 1d12h'
+                         % text)
+    sign = -1 if match.group(1) == '-' else 1
+    years = seconds = 0
+    for (amount, unit) in _OFFSET_PART_RE.findall(match.group(2)):
+        if unit == 'y':
+            years += int(amount)
+        else:
+            seconds += int(amount) * _UNIT_SECONDS[unit]
+    return (sign * years, sign * seconds)
+
+
+def shift_timestamp(timestamp, years, seconds):
+    """Returns timestamp moved by a number of calendar years and seconds."""
+    if years:
+        time_list = list(time.localtime(timestamp))
+        time_list[0] += years
+        time_list[8] = -1
+        timestamp = time.mktime(tuple(time_list))
+    return int(timestamp + seconds)
+
+
+def select_photos(rep, make=None, model=None, path_prefix=None,
+                  since=None, before=None):
+    """Returns (id, archive_path, timestamp) rows matching the filters.
+
+    The filters are those of Repository.query(), so photoman.py --query
+    previews exactly the photos a re-layout touches: make and model match
+    the whole camera field in any case, path_prefix the start of
+    archive_path, and since/before (inclusive/exclusive) the timestamp.
+    """
+    (where, params) = media_common._query_filters(
+        since=since, before=before, make=make or None, model=model or None,
+        path_prefix=path_prefix)
+    return rep.con.execute(
+        'SELECT id, archive_path, timestamp FROM photos%s ORDER BY id'
+        % where, params).fetchall()
+
+
+def plan_moves(lib_base_dir, rows, years=0, seconds=0, layout=None):
+    """Returns the journal entries for shifting and re-laying out rows.
+
+    Photos are placed by layout, the library's ArchiveLayout, or in plain
+    YYYY/MM_Month directories without one.
+
+    Each entry is a dict with the photo's id, its current path (src), its
+    new path (dst), its new database timestamp and the new file mtime
+    (in ns, shifted by the same amount).  Photos that stay put with an
+    unchanged timestamp are left out.  New names never collide with an
+    existing file or with another planned move; each target directory is
+    listed once.
+    """
+    listings = {}
+    moves = []
+    for (db_id, src, timestamp) in rows:
+        timestamp = timestamp or 0
+        new_timestamp = shift_timestamp(timestamp, years, seconds)
+        if layout is None:
+            dest_dir = media_common.archive_dir(lib_base_dir, new_timestamp)
+        else:
+            dest_dir = layout.directory(new_timestamp)
+        if (new_timestamp == timestamp
+                and dest_dir == os.path.dirname(src)):
+            continue
+        try:
+            mtime_ns = os.stat(src).st_mtime_ns
+        except OSError:
+            logging.warning('Archived photo %s is missing, not moving it',
+                            src)
+            continue
+        if dest_dir == os.path.dirname(src):
+            dst = src
+        else:
+            dst = _free_name(dest_dir, os.path.basename(src), listings)
+        moves.append({
+            'id': db_id,
+            'src': src,
+            'dst': dst,
+            'timestamp': new_timestamp,
+            'mtime_ns': mtime_ns
+                        + (new_timestamp - timestamp) * 1000000000,
+        })
+    return moves
+
+
+def _free_name(dest_dir, filename, listings):
+    """Returns a path in dest_dir named like filename that is neither an
+    existing file nor already handed out."""
+    if dest_dir not in listings:
+        try:
+            listings[dest_dir] = set(os.listdir(dest_dir))
+        except FileNotFoundError:
+            listings[dest_dir] = set()
+    taken = listings[dest_dir]
+    prefix, suffix = os.path.splitext(filename)
+    candidate = filename
+    counter = 0
+    while candidate in taken:
+        counter += 1
+        candidate = '%s_%d%s' % (prefix, counter, suffix)
+    taken.add(candidate)
+    return os.path.join(dest_dir, candidate)
+
+
+def relayout(rep, lib_base_dir, moves, batch_size=DEFAULT_BATCH_SIZE):
+    """Journals and applies moves (from plan_moves) to the library,
+    committing the database updates batch_size photos at a time.  The
+    caller holds the library's ingest lock.
+
+    Returns (applied, failed).
+    """
+    journal_path = os.path.join(lib_base_dir, JOURNAL_NAME)
+    if os.path.exists(journal_path):
+        raise RuntimeError('%s exists; roll it forward first'
+                           % journal_path)
+    _write_journal(journal_path, moves)
+    return _apply_journal(rep, journal_path, batch_size)
+
+
+def roll_forward(rep, lib_base_dir, batch_size=DEFAULT_BATCH_SIZE):
+    """Finishes an interrupted re-layout, if there is one.  The caller
+    holds the library's ingest lock.
+
+    Returns (applied, failed), or None if there was no journal.
+    """
+    journal_path = os.path.join(lib_base_dir, JOURNAL_NAME)
+    if not os.path.exists(journal_path):
+        return None
+    logging.warning('Rolling forward the interrupted re-layout in %s',
+                    journal_path)
+    return _apply_journal(rep, journal_path, batch_size)
+
+
+def _write_journal(journal_path, moves):
+    """Durably writes the journal before anything is changed."""
+    tmp_path = journal_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        for move in moves:
+            fh.write(json.dumps(move) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def _apply_journal(rep, journal_path, batch_size=DEFAULT_BATCH_SIZE):
+    """Moves the files listed in the journal, updates the database in
+    transactions of batch_size photos and removes the journal, along with
+    any source directories the moves emptied.
+
+    Safe to repeat: moves already done are recognized, and the mtimes and
+    database values written are absolute.
+    """
+    with open(journal_path) as fh:
+        moves = [json.loads(line) for line in fh if line.strip()]
+    updates = []
+    applied = 0
+    for move in moves:
+        try:
+            if not _move_file(move['src'], move['dst']):
+                continue
+            stat = os.stat(move['dst'])
+            os.utime(move['dst'], ns=(stat.st_atime_ns, move['mtime_ns']))
+        except OSError as e:
+            logging.error('Could not move %s to %s: %s',
+                          move['src'], move['dst'], e)
+            continue
+        updates.append((move['dst'], move['timestamp'], move['mtime_ns'],
+                        move['id']))
+        if len(updates) >= batch_size:
+            applied += _update_rows(rep, updates)
+            updates = []
+    applied += _update_rows(rep, updates)
+    os.remove(journal_path)
+    for src_dir in sorted({os.path.dirname(move['src']) for move in moves
+                           if move['src'] != move['dst']}, reverse=True):
+        try:
+            os.rmdir(src_dir)
+        except OSError:
+            pass
+    failed = len(moves) - applied
+    logging.info('Re-layout complete: %d photos updated, %d failed',
+                 applied, failed)
+    return (applied, failed)
+
+
+def _update_rows(rep, updates):
+    """Writes the new paths and timestamps of moved photos in one
+    transaction.  Returns the number of photos updated."""
+    with rep.con:
+        # The file keeps its inode; only the fingerprint's mtime changes.
+        rep.con.executemany(
+            'UPDATE photos SET archive_path = ?, timestamp = ?, '
+            'mtime_ns = ? WHERE id = ?', updates)
+    return len(updates)
+
+
+def _move_file(src, dst):
+    """Renames src to dst without ever replacing an existing file.
+
+    Returns True once the file is at dst, including when an earlier,
+    interrupted run already moved it.
+    """
+    if src == dst:
+        return os.path.exists(dst)
+    src_exists = os.path.lexists(src)
+    dst_exists = os.path.lexists(dst)
+    if dst_exists and not src_exists:
+        return True
+    if dst_exists:
+        if os.path.samefile(src, dst):
+            # Interrupted between link and unlink.
+            os.unlink(src)
+            return True
+        logging.error('Not moving %s: %s already exists', src, dst)
+        return False
+    if not src_exists:
+        logging.error('Not moving %s: it no longer exists', src)
+        return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        logging.error('Not moving %s: %s already exists', src, dst)
+        return False
+    except OSError as e:
+        if e.errno not in _NO_LINK_ERRNOS:
+            raise
+        # No hard links here; a plain rename is still never a copy.
+        os.rename(src, dst)
+        return True
+    os.unlink(src)
+    return True
+
+
+def _configure_logging():
+    """Configures logging to stderr, file."""
+    media_common.configure_logging('relayout.log')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Shift photo timestamps and move archived photos to '
+                    'match.')
+    parser.add_argument('--media_dir', required=True,
+                        help='Media library to re-layout')
+    parser.add_argument('--make', help='Only photos whose camera make is '
+                                       'this (whole value, any case)')
+    parser.add_argument('--model', help='Only photos whose camera model is '
+                                        'this (whole value, any case)')
+    parser.add_argument('--path_prefix',
+                        help='Only photos whose archive path starts with '
+                             'this (relative paths are under '
+                             '<media_dir>/photos)')
+    parser.add_argument('--since', help='Only photos taken on or after '
+                                        'this date (YYYY-MM-DD)')
+    parser.add_argument('--before', help='Only photos taken before this '
+                                         'date (YYYY-MM-DD)')
+    parser.add_argument('--offset', default='0s',
+                        help='Clock offset to apply, e.g. +1y, -3h or '
+                             '1d12h (default: none, just re-layout)')
+    parser.add_argument('--day_dirs_after', type=int, metavar='N',
+                        help='First change the library\'s day directory '
+                             'threshold, as photoman.py --day_dirs_after '
+                             'does')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Photos updated per database transaction '
+                             '(default: %(default)s)')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only show what would be moved')
+    parser.add_argument('--yes', action='store_true',
+                        help='Skip the confirmation prompt')
+    args = parser.parse_args()
+
+    try:
+        years, seconds = parse_offset(args.offset)
+        since = media_common.parse_date(args.since) if args.since else None
+        before = (media_common.parse_date(args.before) if args.before
+                  else None)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.day_dirs_after is not None and args.day_dirs_after < 0:
+        parser.error('--day_dirs_after must be 0 or more')
+    if args.batch_size < 1:
+        parser.error('--batch_size must be at least 1')
+    path_prefix = args.path_prefix
+    if path_prefix and not os.path.isabs(path_prefix):
+        path_prefix = os.path.join(args.media_dir, 'photos', path_prefix)
+
+    _configure_logging()
+    rep = media_common.Repository()
+    rep.open(args.media_dir)
+    lock = media_common.RunLock(
+        os.path.join(args.media_dir, media_common.INGEST_LOCK_NAME))
+    if not lock.acquire():
+        rep.close()
+        logging.error('%s holds %s; try again once it has finished',
+                      lock.holder(), lock.lock_path)
+        sys.exit(1)
+    try:
+        roll_forward(rep, args.media_dir, args.batch_size)
+        layout = rep.archive_layout(args.media_dir)
+        if args.day_dirs_after is not None:
+            layout.day_dirs_after = args.day_dirs_after
+        rows = select_photos(rep, make=args.make, model=args.model,
+                             path_prefix=path_prefix, since=since,
+                             before=before)
+        moves = plan_moves(args.media_dir, rows, years, seconds, layout)
+        moved = sum(1 for move in moves if move['src'] != move['dst'])
+        print(f'{len(rows)} photo(s) selected; {len(moves)} timestamp(s) '
+              f'to change, {moved} file(s) to move')
+        if args.dry_run:
+            for move in moves:
+                print(move['src'], '->', move['dst'])
+            return
+        if moves and not args.yes:
+            response = input('Proceed? [y/N] ')
+            if response.lower() not in ('y', 'yes'):
+                print('Aborted.')
+                return
+        if args.day_dirs_after is not None:
+            rep.set_day_dirs_after(args.day_dirs_after)
+        if not moves:
+            return
+        _applied, failed = relayout(rep, args.media_dir, moves,
+                                    args.batch_size)
+    except Exception:
+        logging.exception('An unexpected error occurred during re-layout')
+        sys.exit(1)
+    finally:
+        rep.close()
+        lock.release()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import errno
+import glob
+import io
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import *
+
+import media_common
+import photoman
+import relayout
+
+
+class RelayoutTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        self.mediadir = os.path.join(self.tmpdir, 'media')
+        os.mkdir(self.srcdir)
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        for test_file in glob.glob(os.path.join(scriptdir, 'test', '*')):
+            shutil.copy(test_file, self.srcdir)
+        self._archive()
+        self.rep = media_common.Repository()
+        self.rep.open(self.mediadir)
+        self.gnexus = os.path.join(self.mediadir,
+                                   'photos/2012/07_July/gnexus 160.jpg')
+
+    def tearDown(self):
+        self.rep.close()
+        shutil.rmtree(self.tmpdir)
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def _archive(self):
+        photoman._find_and_archive_photos(self.srcdir, self.mediadir,
+                                          True, 'foo')
+
+    def _row(self, path):
+        return self.rep.con.execute(
+            'SELECT id, timestamp FROM photos WHERE archive_path = ?',
+            [path]).fetchone()
+
+    def test_parse_offset(self):
+        self.assertEqual((1, 0), relayout.parse_offset('+1y'))
+        self.assertEqual((0, -3 * 3600), relayout.parse_offset('-3h'))
+        self.assertEqual((1, 2 * 86400 + 30 * 60),
+                         relayout.parse_offset('1y2d30m'))
+        self.assertRaises(ValueError, relayout.parse_offset, '1 year')
+
+    def test_shift_timestamp_keeps_calendar_date(self):
+        timestamp = time.mktime((2010, 5, 1, 12, 0, 0, 0, 0, -1))
+        shifted = relayout.shift_timestamp(timestamp, 1, 0)
+        self.assertEqual((2011, 5, 1, 12, 0),
+                         time.localtime(shifted)[0:5])
+
+    def test_select_photos(self):
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        self.assertEqual([self.gnexus], [row[1] for row in rows])
+        prefix = os.path.join(self.mediadir, 'photos', '2012', '07_')
+        self.assertIn(self.gnexus, [row[1] for row in relayout.select_photos(
+            self.rep, path_prefix=prefix)])
+        (_db_id, timestamp) = self._row(self.gnexus)
+        self.assertEqual([], relayout.select_photos(
+            self.rep, model='Galaxy Nexus', since=timestamp + 1))
+        self.assertEqual([], relayout.select_photos(
+            self.rep, model='Galaxy Nexus', before=timestamp))
+
+    def test_select_photos_matches_whole_model(self):
+        """A model whose name is part of another's, or a LIKE wildcard,
+        never selects the other camera's photos."""
+        (db_id, timestamp) = self._row(self.gnexus)
+        self.rep.con.execute(
+            "INSERT INTO photos (md5, size, archive_path, timestamp, "
+            "camera_model) VALUES ('n', 1, '/lib/n.jpg', ?, 'Nexus')",
+            (timestamp,))
+        nexus = [row[1] for row in relayout.select_photos(self.rep,
+                                                          model='nexus')]
+        self.assertEqual(['/lib/n.jpg'], nexus)
+        self.assertEqual([], relayout.select_photos(self.rep, model='%'))
+        self.assertEqual([], relayout.select_photos(self.rep,
+                                                    model='Galaxy_Nexus'))
+        moves = relayout.plan_moves(
+            self.mediadir, relayout.select_photos(self.rep, model='Nexus'),
+            years=1)
+        self.assertNotIn(db_id, [move['id'] for move in moves])
+        relayout.relayout(self.rep, self.mediadir, moves)
+        self.assertTrue(os.path.isfile(self.gnexus))
+        self.assertEqual((db_id, timestamp), self._row(self.gnexus))
+        # --query previews the same rows.
+        self.assertEqual(nexus, [row['archive_path'] for row in
+                                 self.rep.query(model='Nexus')])
+
+    def test_relayout_moves_files_and_rows(self):
+        (db_id, timestamp) = self._row(self.gnexus)
+        mtime = os.stat(self.gnexus).st_mtime
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        self.assertEqual(1, len(moves))
+        self.assertEqual((1, 0), relayout.relayout(self.rep, self.mediadir,
+                                                   moves))
+
+        moved = os.path.join(self.mediadir,
+                             'photos/2013/07_July/gnexus 160.jpg')
+        self.assertFalse(os.path.exists(self.gnexus))
+        self.assertTrue(os.path.isfile(moved))
+        new_timestamp = relayout.shift_timestamp(timestamp, 1, 0)
+        self.assertEqual((db_id, new_timestamp), self._row(moved))
+        self.assertAlmostEqual(mtime + new_timestamp - timestamp,
+                               os.stat(moved).st_mtime, places=3)
+        self.assertEqual(os.stat(moved).st_mtime_ns, self.rep.con.execute(
+            'SELECT mtime_ns FROM photos WHERE id = ?', [db_id]).fetchone()[0])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.mediadir, relayout.JOURNAL_NAME)))
+        # Nothing left to do the second time around.
+        self.assertEqual([], relayout.plan_moves(
+            self.mediadir, relayout.select_photos(self.rep), 0, 0))
+
+    def test_relayout_never_replaces_files(self):
+        dest_dir = os.path.join(self.mediadir, 'photos/2013/07_July')
+        os.makedirs(dest_dir)
+        occupant = os.path.join(dest_dir, 'gnexus 160.jpg')
+        with open(occupant, 'w') as fh:
+            fh.write('someone else')
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        self.assertEqual(os.path.join(dest_dir, 'gnexus 160_1.jpg'),
+                         moves[0]['dst'])
+        relayout.relayout(self.rep, self.mediadir, moves)
+        with open(occupant) as fh:
+            self.assertEqual('someone else', fh.read())
+        self.assertIsNotNone(self._row(moves[0]['dst']))
+
+    def test_timestamp_only_change(self):
+        (db_id, timestamp) = self._row(self.gnexus)
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        moves = relayout.plan_moves(self.mediadir, rows, seconds=60)
+        self.assertEqual(self.gnexus, moves[0]['dst'])
+        relayout.relayout(self.rep, self.mediadir, moves)
+        self.assertEqual((db_id, timestamp + 60), self._row(self.gnexus))
+
+    def test_roll_forward_after_crash(self):
+        rows = relayout.select_photos(self.rep)
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        self.assertEqual(len(rows), len(moves))
+        journal = os.path.join(self.mediadir, relayout.JOURNAL_NAME)
+        relayout._write_journal(journal, moves)
+        # Crash after one full move and one half-done (linked) move.
+        for move in moves[:2]:
+            os.makedirs(os.path.dirname(move['dst']), exist_ok=True)
+            os.link(move['src'], move['dst'])
+        os.unlink(moves[0]['src'])
+
+        self.assertEqual((len(moves), 0),
+                         relayout.roll_forward(self.rep, self.mediadir))
+        for move in moves:
+            self.assertFalse(os.path.exists(move['src']))
+            self.assertTrue(os.path.isfile(move['dst']))
+            self.assertEqual((move['id'], move['timestamp']),
+                             self._row(move['dst']))
+        self.assertFalse(os.path.exists(journal))
+        self.assertIsNone(relayout.roll_forward(self.rep, self.mediadir))
+
+    def test_scan_missing_waits_for_journal_and_lock(self):
+        """photoman --scan_missing leaves the rows of photos that an
+        interrupted or running re-layout is moving alone."""
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        journal = os.path.join(self.mediadir, relayout.JOURNAL_NAME)
+        relayout._write_journal(journal, moves)
+        os.makedirs(os.path.dirname(moves[0]['dst']))
+        os.rename(moves[0]['src'], moves[0]['dst'])
+        self.rep.con.commit()
+
+        photoman._scan_missing_photos(self.mediadir)
+        self.assertIsNotNone(self._row(self.gnexus))
+
+        lock = media_common.RunLock(
+            os.path.join(self.mediadir, media_common.INGEST_LOCK_NAME))
+        self.assertTrue(lock.acquire())
+        try:
+            relayout.roll_forward(self.rep, self.mediadir)
+            self.rep.con.execute(
+                "INSERT INTO photos (md5, size, archive_path) "
+                "VALUES ('gone', 1, '/gone.jpg')")
+            self.rep.con.commit()
+            photoman._scan_missing_photos(self.mediadir)
+            self.assertIsNotNone(self._row('/gone.jpg'))
+            # The holder of the lock can scan.
+            photoman._scan_missing_photos(self.mediadir, lock)
+        finally:
+            lock.release()
+        self.assertIsNone(self._row('/gone.jpg'))
+        self.assertIsNotNone(self._row(moves[0]['dst']))
+
+    def test_main_takes_ingest_lock(self):
+        lock = media_common.RunLock(
+            os.path.join(self.mediadir, media_common.INGEST_LOCK_NAME))
+        self.assertTrue(lock.acquire())
+        argv = ['relayout.py', '--media_dir', self.mediadir,
+                '--model', 'Galaxy Nexus', '--offset', '+1y', '--yes']
+        try:
+            with patch('sys.argv', argv), \
+                    patch.object(relayout, '_configure_logging'):
+                self.assertRaises(SystemExit, relayout.main)
+        finally:
+            lock.release()
+        self.assertTrue(os.path.isfile(self.gnexus))
+        with patch('sys.argv', argv), \
+                patch.object(relayout, '_configure_logging'), \
+                patch('sys.stdout', new=io.StringIO()):
+            relayout.main()
+        self.assertFalse(os.path.exists(self.gnexus))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.mediadir, relayout.JOURNAL_NAME)))
+
+    def test_day_directories(self):
+        (db_id, timestamp) = self._row(self.gnexus)
+        # A second photo taken in July 2012, whose file is gone.
+        self.rep.con.execute(
+            "INSERT INTO photos (md5, size, archive_path, timestamp) "
+            "VALUES ('f', 1, '/gone.jpg', ?)", (timestamp,))
+        self.rep.set_day_dirs_after(1)
+        rows = relayout.select_photos(self.rep)
+        moves = relayout.plan_moves(self.mediadir, rows,
+                                    layout=self.rep.archive_layout(
+                                        self.mediadir))
+        sharded = os.path.join(
+            media_common.archive_dir(self.mediadir, timestamp, day_dir=True),
+            'gnexus 160.jpg')
+        self.assertEqual([(self.gnexus, sharded)],
+                         [(move['src'], move['dst']) for move in moves])
+        self.assertEqual((1, 0), relayout.relayout(self.rep, self.mediadir,
+                                                   moves, batch_size=1))
+        self.assertEqual((db_id, timestamp), self._row(sharded))
+        # Turned off again, the photo goes back and its day directory too.
+        self.rep.set_day_dirs_after(0)
+        moves = relayout.plan_moves(
+            self.mediadir, relayout.select_photos(self.rep),
+            layout=self.rep.archive_layout(self.mediadir))
+        relayout.relayout(self.rep, self.mediadir, moves)
+        self.assertTrue(os.path.isfile(self.gnexus))
+        self.assertFalse(os.path.exists(os.path.dirname(sharded)))
+
+    def test_batched_updates(self):
+        rows = relayout.select_photos(self.rep)
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        with patch.object(relayout, '_update_rows',
+                          wraps=relayout._update_rows) as update_rows:
+            self.assertEqual((len(moves), 0), relayout.relayout(
+                self.rep, self.mediadir, moves, batch_size=2))
+        self.assertEqual([2, 2, 1], [len(call_args[0][1]) for call_args
+                                     in update_rows.call_args_list])
+        for move in moves:
+            self.assertEqual((move['id'], move['timestamp']),
+                             self._row(move['dst']))
+
+    def test_refuses_cross_device_moves(self):
+        rows = relayout.select_photos(self.rep, model='Galaxy Nexus')
+        moves = relayout.plan_moves(self.mediadir, rows, years=1)
+        with patch('os.link',
+                   side_effect=OSError(errno.EXDEV, 'cross-device')):
+            self.assertEqual((0, 1), relayout.relayout(
+                self.rep, self.mediadir, moves))
+        self.assertTrue(os.path.isfile(self.gnexus))
+        self.assertIsNotNone(self._row(self.gnexus))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+"""Perceptual hashing and near-duplicate search for archived photos.
+
+Exact dedup (MD5 + size) misses resized, recompressed or re-sent copies
+of a photo.  Each photo instead gets a 64-bit difference hash (dHash) of
+a 9x8 grayscale thumbnail; copies that look alike have hashes a few bits
+apart, whatever their encoding.  Hashes are stored in the photos table
+as signed 64-bit integers, the only kind SQLite has.
+"""
+
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Hashes at most this many bits apart are considered the same picture.
+DEFAULT_MAX_DISTANCE = 6
+
+_HASH_WIDTH = 9
+_HASH_HEIGHT = 8
+
+# Rows of the pairwise distance matrix computed at once; bounds memory to
+# about _SEARCH_BLOCK * len(hashes) * 9 bytes.
+_SEARCH_BLOCK = 256
+
+# Number of set bits in each byte value, for numpy without bitwise_count.
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+
+def dhash(filepath):
+    """Returns the difference hash of an image file as an unsigned int.
+
+    The image is decoded at reduced size (draft mode), turned upright
+    according to its EXIF orientation and shrunk to 9x8 grayscale; each
+    bit records whether a pixel is brighter than its left neighbour.
+    Returns None if Pillow can't decode the file, e.g. for videos.
+    """
+    try:
+        with Image.open(filepath) as image:
+            image.draft('L', (_HASH_WIDTH, _HASH_HEIGHT))
+            image = ImageOps.exif_transpose(image.convert('L'))
+            small = image.resize((_HASH_WIDTH, _HASH_HEIGHT),
+                                 Image.Resampling.BOX)
+    except (OSError, ValueError, SyntaxError,
+            Image.DecompressionBombError) as e:
+        logging.debug('Cannot compute a perceptual hash of %s: %s',
+                      filepath, e)
+        return None
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def to_db(phash):
+    """Converts an unsigned hash to the signed value stored in SQLite."""
+    if phash is None:
+        return None
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+def from_db(value):
+    """Converts a stored signed hash back to an unsigned int."""
+    if value is None:
+        return None
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+def hash_array(values):
+    """Returns stored (signed) hashes as a numpy uint64 array."""
+    return np.array(values, dtype=np.int64).view(np.uint64)
+
+
+def popcount(array, out=None):
+    """Returns the number of set bits in each uint64 of array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(array, out=out)
+    as_bytes = array.reshape(array.shape + (1,)).view(np.uint8)
+    counts = _BYTE_POPCOUNT[as_bytes].sum(axis=-1, dtype=np.uint8)
+    if out is None:
+        return counts
+    out[...] = counts
+    return out
+
+
+def similar_pairs(hashes, max_distance=DEFAULT_MAX_DISTANCE):
+    """Finds all pairs of hashes at most max_distance bits apart.
+
+    hashes is a uint64 array.  Every pair is compared, a block of rows at
+    a time against all later rows, with vectorized XOR and popcount into
+    buffers allocated once.  Returns (i, j, distance) arrays of indexes
+    into hashes, with i < j.
+    """
+    found_i = [np.array([], dtype=np.intp)]
+    found_j = [np.array([], dtype=np.intp)]
+    found_d = [np.array([], dtype=np.uint8)]
+    shape = (min(_SEARCH_BLOCK, len(hashes)), len(hashes))
+    xor_buffer = np.empty(shape, dtype=np.uint64)
+    distance_buffer = np.empty(shape, dtype=np.uint8)
+    close_buffer = np.empty(shape, dtype=bool)
+    # Within a block's own columns only the upper triangle counts: each
+    # pair once, and no photo paired with itself.
+    upper = np.triu(np.ones((shape[0], shape[0]), dtype=bool), k=1)
+    for start in range(0, len(hashes), _SEARCH_BLOCK):
+        block = hashes[start:start + _SEARCH_BLOCK]
+        size = len(block)
+        view = (slice(0, size), slice(0, len(hashes) - start))
+        xor = np.bitwise_xor(block[:, None], hashes[None, start:],
+                             out=xor_buffer[view])
+        distances = popcount(xor, out=distance_buffer[view])
+        close = np.less_equal(distances, max_distance,
+                              out=close_buffer[view])
+        close[:, :size] &= upper[:size, :size]
+        # Only the few rows with a match are searched for their columns.
+        (rows,) = np.nonzero(close.any(axis=1))
+        (hit_rows, cols) = np.nonzero(close[rows])
+        rows = rows[hit_rows]
+        found_i.append(rows + start)
+        found_j.append(cols + start)
+        found_d.append(distances[rows, cols])
+    return (np.concatenate(found_i), np.concatenate(found_j),
+            np.concatenate(found_d))
+
+
+def cluster(count, pairs_i, pairs_j):
+    """Groups indexes 0..count-1 joined by pairs into clusters.
+
+    Returns the clusters with more than one member, as sorted lists of
+    indexes, in order of their smallest index.
+    """
+    parent = list(range(count))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for (i, j) in zip(pairs_i.tolist(), pairs_j.tolist()):
+        (root_i, root_j) = (find(i), find(j))
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    return [members for (_root, members) in sorted(groups.items())
+            if len(members) > 1]
+
+
+def find_similar(rep, max_distance=DEFAULT_MAX_DISTANCE):
+    """Clusters the library's photos whose hashes are within max_distance.
+
+    Returns a list of clusters, each a list of (id, archive_path) rows.
+    Photos without a hash (not yet backfilled, or not images) are
+    skipped.
+    """
+    rows = rep.con.execute(
+        'SELECT id, archive_path, phash FROM photos '
+        'WHERE phash IS NOT NULL ORDER BY id').fetchall()
+    hashes = hash_array([row[2] for row in rows])
+    (pairs_i, pairs_j, _distances) = similar_pairs(hashes, max_distance)
+    return [[rows[i][0:2] for i in members]
+            for members in cluster(len(rows), pairs_i, pairs_j)]
+
+
+class SimilarityIndex():
+    """The library's perceptual hashes, held in memory while ingesting so
+    each new photo can be checked against all of them cheaply.
+
+    The first _count entries of the arrays are in use; they double in
+    size when full, so adding n photos copies O(n) hashes, not O(n**2).
+    """
+
+    def __init__(self, rep):
+        rows = rep.con.execute('SELECT id, phash FROM photos '
+                               'WHERE phash IS NOT NULL').fetchall()
+        self._ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self._hashes = hash_array([row[1] for row in rows])
+        self._count = len(rows)
+
+    def __len__(self):
+        return self._count
+
+    def nearest(self, phash, max_distance=DEFAULT_MAX_DISTANCE):
+        """Returns the id of the closest photo whose hash is within
+        max_distance of phash (unsigned), or None."""
+        if phash is None or not self._count:
+            return None
+        distances = popcount(self._hashes[:self._count] ^ np.uint64(phash))
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        return int(self._ids[best])
+
+    def add(self, db_id, phash):
+        """Adds a newly archived photo, so later ingests match it too."""
+        if phash is None:
+            return
+        if self._count == len(self._ids):
+            capacity = max(16, 2 * self._count)
+            self._ids = np.resize(self._ids, capacity)
+            self._hashes = np.resize(self._hashes, capacity)
+        self._ids[self._count] = db_id
+        self._hashes[self._count] = np.uint64(phash)
+        self._count += 1
+
+    def drop_after(self, max_id):
+        """Drops the photos with ids above max_id, e.g. after their rows
+        were rolled back, so that no new row reusing an id matches."""
+        keep = np.flatnonzero(self._ids[:self._count] <= max_id)
+        self._ids[:len(keep)] = self._ids[keep]
+        self._hashes[:len(keep)] = self._hashes[keep]
+        self._count = len(keep)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import *
+
+import numpy as np
+from PIL import Image
+
+import similar
+
+
+class SimilarTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        self.testdir = os.path.join(scriptdir, 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _distance(self, a, b):
+        return bin(a ^ b).count('1')
+
+    def test_dhash_matches_resized_copy(self):
+        original = os.path.join(self.testdir, 'DSC09012.JPG')
+        copy = os.path.join(self.tmpdir, 'copy.jpg')
+        with Image.open(original) as image:
+            image.thumbnail((400, 400))
+            image.save(copy, quality=40)
+        self.assertLessEqual(
+            self._distance(similar.dhash(original), similar.dhash(copy)),
+            similar.DEFAULT_MAX_DISTANCE)
+        hashes = [similar.dhash(os.path.join(self.testdir, name))
+                  for name in sorted(os.listdir(self.testdir))]
+        for (a, b) in itertools.combinations(hashes, 2):
+            self.assertGreater(self._distance(a, b),
+                               similar.DEFAULT_MAX_DISTANCE)
+
+    def test_dhash_follows_exif_orientation(self):
+        pixels = np.zeros((60, 80), dtype=np.uint8)
+        pixels[:, :40] = np.linspace(0, 255, 40)
+        pixels[10:30, 50:70] = 200
+        image = Image.fromarray(pixels)
+        upright = os.path.join(self.tmpdir, 'upright.png')
+        tagged = os.path.join(self.tmpdir, 'tagged.jpg')
+        image.save(upright)
+        # Stored on its side with "rotate 90 CW" in EXIF, as cameras do.
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        image.transpose(Image.Transpose.ROTATE_90).save(
+            tagged, exif=exif, quality=95)
+        self.assertLessEqual(
+            self._distance(similar.dhash(upright), similar.dhash(tagged)),
+            similar.DEFAULT_MAX_DISTANCE)
+
+    def test_dhash_of_non_image(self):
+        path = os.path.join(self.tmpdir, 'clip.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(b'\x00\x00\x00\x18ftypmp42')
+        self.assertIsNone(similar.dhash(path))
+
+    def test_db_round_trip(self):
+        con = sqlite3.connect(':memory:')
+        con.execute('CREATE TABLE t (h integer)')
+        for phash in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+            con.execute('DELETE FROM t')
+            con.execute('INSERT INTO t VALUES (?)', [similar.to_db(phash)])
+            (stored,) = con.execute('SELECT h FROM t').fetchone()
+            self.assertEqual(phash, similar.from_db(stored))
+            self.assertEqual(phash, int(similar.hash_array([stored])[0]))
+        self.assertIsNone(similar.to_db(None))
+
+    def test_popcount_without_bitwise_count(self):
+        values = np.array([0, 1, 0xFF, (1 << 64) - 1, 0x8000000000000001],
+                          dtype=np.uint64)
+        with patch('similar.hasattr', create=True, return_value=False):
+            counts = similar.popcount(values)
+        self.assertEqual([0, 1, 8, 64, 2], counts.tolist())
+
+    @patch('similar._SEARCH_BLOCK', new=16)
+    def test_similar_pairs_matches_brute_force(self):
+        rng = np.random.default_rng(42)
+        hashes = rng.integers(0, 1 << 63, 100, dtype=np.int64).view(
+            np.uint64)
+        # Near copies across and within blocks, and an exact copy.
+        for (copy, original, flips) in ((40, 3, 5), (7, 5, 1), (99, 3, 0),
+                                        (60, 50, 8)):
+            hashes[copy] = hashes[original] ^ np.uint64((1 << flips) - 1)
+        (pairs_i, pairs_j, distances) = similar.similar_pairs(hashes, 6)
+        found = set(zip(pairs_i.tolist(), pairs_j.tolist(),
+                        distances.tolist()))
+        expected = set()
+        for (i, j) in itertools.combinations(range(len(hashes)), 2):
+            distance = self._distance(int(hashes[i]), int(hashes[j]))
+            if distance <= 6:
+                expected.add((i, j, distance))
+        self.assertEqual(expected, found)
+        self.assertIn((3, 99, 0), found)
+        self.assertNotIn(50, pairs_i.tolist())
+
+    def test_similar_pairs_empty(self):
+        (pairs_i, _pairs_j, _distances) = similar.similar_pairs(
+            similar.hash_array([]))
+        self.assertEqual(0, len(pairs_i))
+
+    def test_cluster(self):
+        self.assertEqual([[0, 2, 5], [3, 4]], similar.cluster(
+            7, np.array([2, 3, 0]), np.array([5, 4, 5])))
+
+    def test_similarity_index(self):
+        con = sqlite3.connect(':memory:')
+        con.execute('CREATE TABLE photos (id integer primary key, '
+                    'phash integer)')
+        con.executemany('INSERT INTO photos VALUES (?, ?)',
+                        [(1, similar.to_db(0xF0F0)),
+                         (2, similar.to_db(1 << 63)), (3, None)])
+        rep = Mock(con=con)
+        index = similar.SimilarityIndex(rep)
+        self.assertEqual(2, len(index))
+        self.assertEqual(1, index.nearest(0xF0F1))
+        self.assertEqual(2, index.nearest((1 << 63) | 0x7))
+        self.assertIsNone(index.nearest(0xFFFF0000))
+        self.assertIsNone(index.nearest(None))
+        index.add(4, 0xFFFF0000)
+        self.assertEqual(4, index.nearest(0xFFFF0001))
+        index.drop_after(3)
+        self.assertEqual(2, len(index))
+        self.assertIsNone(index.nearest(0xFFFF0001))
+        self.assertEqual(1, index.nearest(0xF0F1))
+
+    def test_similarity_index_grows(self):
+        con = sqlite3.connect(':memory:')
+        con.execute('CREATE TABLE photos (id integer primary key, '
+                    'phash integer)')
+        index = similar.SimilarityIndex(Mock(con=con))
+        self.assertIsNone(index.nearest(0))
+        hashes = [(i << 40) | 0xFFFF for i in range(1, 101)]
+        for (db_id, phash) in enumerate(hashes, 1):
+            index.add(db_id, phash)
+            index.add(None, None)
+        self.assertEqual(100, len(index))
+        self.assertEqual(100, index.nearest(hashes[-1]))
+        # Spare capacity never matches.
+        self.assertIsNone(index.nearest(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,12 +5,21 @@ contain the original capture timestamp.  The exported files get mtime=now,
 which breaks date-based organization for any file lacking embedded EXIF
 DateTimeOriginal (videos and EXIF-less photos).
 
-This module reads the .json sidecars and restores correct mtimes.
+This module reads the .json sidecars and restores correct mtimes.  The
+sidecar parsing and EXIF checks run on a bounded thread pool so that
+callers can stream fixed files onward (e.g. to staging) while the rest
+of the export is still being scanned.
 """
+import functools
 import json
 import logging
 import os
+import re
 import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+
+import parallel
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +37,108 @@ _PHOTO_EXTENSIONS = frozenset({
 
 _MEDIA_EXTENSIONS = _VIDEO_EXTENSIONS | _PHOTO_EXTENSIONS
 
+# Google cuts sidecar names to this many characters before the ".json".
+_SIDECAR_NAME_LIMIT = 46
+
+_SUPPLEMENTAL = 'supplemental-metadata'
+
+_EDITED_SUFFIXES = ('-edited',)
+
+_COUNTER_RE = re.compile(r'^(.+)\((\d+)\)$')
+
+
+class SidecarIndex:
+    """Matches Google Takeout sidecars to media files within one directory.
+
+    Built from a single directory listing.  Sidecar names are normalized
+    once under Google's naming rules and stored in dicts, so matching a
+    media file costs a handful of O(1) lookups regardless of how many
+    files the directory holds.  The rules handled are:
+
+    * plain ``IMG_1234.JPG.json``;
+    * ``IMG_1234.JPG.supplemental-metadata.json``, including versions
+      truncated to ``.supplemental-me.json``, ``.suppl.json`` and so on;
+    * duplicate numbering moved behind the extension, i.e. the sidecar of
+      ``IMG(1).jpg`` is ``IMG.jpg(1).json``;
+    * sidecar names cut to 46 characters (plus ``.json``), which for long
+      media names truncates the media name itself;
+    * ``-edited`` copies and live-photo videos sharing the original
+      photo's sidecar, and old sidecars named without the media extension.
+    """
+
+    def __init__(self, filenames: Iterable[str]):
+        self.media: list[str] = []
+        self.sidecars: list[str] = []
+        self._by_name: dict[tuple[str, int], str] = {}
+        self._by_stem: dict[tuple[str, int], str] = {}
+        for name in filenames:
+            if name.lower().endswith(_JSON_EXT):
+                self.sidecars.append(name)
+                self._add_sidecar(name)
+            elif _is_media_name(name):
+                self.media.append(name)
+
+    def _add_sidecar(self, json_name: str) -> None:
+        raw, counter = _split_counter(json_name[:-len(_JSON_EXT)])
+        body = raw
+        head, dot, last = raw.rpartition('.')
+        if dot and head and _SUPPLEMENTAL.startswith(last):
+            body = head
+        for key in {(body, counter), (raw, counter)}:
+            self._by_name.setdefault(key, json_name)
+        stem = os.path.splitext(body)[0]
+        self._by_stem.setdefault((stem, counter), json_name)
+
+    def match(self, media_name: str) -> str | None:
+        """Return the sidecar name describing *media_name*, or None."""
+        stem, ext = os.path.splitext(media_name)
+        base, counter = _split_counter(stem)
+        names = [(base + ext, counter)]
+        if counter:
+            # The parentheses may be part of the original name.
+            names.append((media_name, 0))
+        for suffix in _EDITED_SUFFIXES:
+            if base.endswith(suffix):
+                names.append((base[:-len(suffix)] + ext, counter))
+        for name, count in names:
+            json_name = (self._by_name.get((name, count))
+                         or self._by_name.get(
+                             (name[:_SIDECAR_NAME_LIMIT], count)))
+            if json_name is not None:
+                return json_name
+        for name, count in names:
+            json_name = self._by_stem.get((os.path.splitext(name)[0], count))
+            if json_name is not None:
+                return json_name
+        return None
+
+    def groups(self) -> tuple[dict[str, list[str]], list[str], list[str]]:
+        """Pair every file in the listing.
+
+        Returns ``(groups, unmatched_media, unmatched_sidecars)`` where
+        *groups* maps each matched sidecar name to the media names it
+        describes.
+        """
+        groups: dict[str, list[str]] = {}
+        unmatched_media = []
+        for media_name in self.media:
+            json_name = self.match(media_name)
+            if json_name is None:
+                unmatched_media.append(media_name)
+            else:
+                groups.setdefault(json_name, []).append(media_name)
+        unmatched_sidecars = [name for name in self.sidecars
+                              if name not in groups]
+        return groups, unmatched_media, unmatched_sidecars
+
+
+def _split_counter(name: str) -> tuple[str, int]:
+    """Split a trailing duplicate counter: ``'IMG(2)'`` → ``('IMG', 2)``."""
+    m = _COUNTER_RE.match(name)
+    if m is None:
+        return name, 0
+    return m.group(1), int(m.group(2))
+
 
 def has_exif_date(filepath: str) -> bool:
     """Return True if *filepath* has a parseable EXIF DateTimeOriginal."""
@@ -52,10 +163,12 @@ def has_exif_date(filepath: str) -> bool:
         return False
 
 
-def fix_mtimes(src_dir: str, *, delete_json: bool = False) -> tuple[int, int, int]:
+def fix_mtimes(src_dir: str, *, delete_json: bool = False,
+               workers: int = 4) -> tuple[int, int, int]:
     """Fix mtimes for files in *src_dir* using Google Takeout JSON sidecars.
 
-    Walks *src_dir* recursively, finds .json sidecar files, reads
+    Walks *src_dir* recursively, pairs .json sidecar files with their
+    media files (see :class:`SidecarIndex`), reads
     ``photoTakenTime.timestamp``, and sets the media file's mtime to
     that timestamp *if* the file is a video or lacks embedded EXIF.
 
@@ -64,66 +177,166 @@ def fix_mtimes(src_dir: str, *, delete_json: bool = False) -> tuple[int, int, in
 
     Returns ``(fixed, already_ok, skipped)``.
     """
-    fixed = 0
-    already_ok = 0
-    skipped = 0
+    stats: Counter[str] = Counter()
+    for _media_path in iter_fixed_media(src_dir, delete_json=delete_json,
+                                        workers=workers, stats=stats):
+        pass
+    if stats['unmatched_media'] or stats['unmatched_sidecars']:
+        logger.info('%d media file(s) had no sidecar; %d sidecar(s) had no '
+                    'media file', stats['unmatched_media'],
+                    stats['unmatched_sidecars'])
+    return stats['fixed'], stats['already_ok'], stats['skipped']
+
+
+def iter_fixed_media(
+    src_dir: str,
+    *,
+    delete_json: bool = False,
+    workers: int = 4,
+    stats: Counter[str] | None = None,
+) -> Iterator[str]:
+    """Stream the media files under *src_dir*, fixing mtimes on the way.
+
+    This is the single-pass form of :func:`fix_mtimes` followed by
+    :func:`iter_media_files`: directories are listed one at a time, each
+    sidecar is parsed and applied on a bounded pool of *workers* threads,
+    and every media file is yielded as soon as its mtime is final (files
+    without a sidecar are yielded straight away).  Memory stays bounded
+    by one directory listing plus the in-flight work, and the first file
+    is available without waiting for the whole tree to be scanned.
+
+    Files are yielded in completion order, not walk order.  If *stats* is
+    given it is updated in place with ``fixed``/``already_ok``/``skipped``
+    counts, the same numbers :func:`fix_mtimes` returns, plus
+    ``unmatched_media`` and ``unmatched_sidecars``.
+    """
+    if stats is None:
+        stats = Counter()
+
+    def tasks() -> Iterator[_FixTask]:
+        for dirpath, _dirnames, filenames in os.walk(src_dir):
+            yield from _plan_directory(dirpath, filenames, stats)
+
+    fix = functools.partial(_fix_task, delete_json=delete_json)
+    for results in parallel.imap_unordered(fix, tasks(), workers=workers):
+        for media_path, status in results:
+            if status is not None:
+                stats[status] += 1
+            if _is_media_name(os.path.basename(media_path)):
+                yield media_path
 
-    for dirpath, _dirnames, filenames in os.walk(src_dir):
-        json_files = [f for f in filenames if f.lower().endswith(_JSON_EXT)]
-        for json_name in json_files:
-            json_path = os.path.join(dirpath, json_name)
-
-            # The corresponding media file is the JSON filename minus the
-            # final .json extension.  E.g. IMG_1234.JPG.json → IMG_1234.JPG
-            media_name = json_name[:-len(_JSON_EXT)]
-            if not media_name:
-                continue
-            media_path = os.path.join(dirpath, media_name)
-
-            if not os.path.isfile(media_path):
-                # JSON without a corresponding media file — e.g. album
-                # metadata.  Skip.
-                skipped += 1
-                continue
-
-            # Read the capture timestamp from the JSON sidecar
-            try:
-                with open(json_path, 'r', encoding='utf-8') as fh:
-                    data = json.load(fh)
-                timestamp_str = data.get('photoTakenTime', {}).get('timestamp')
-                if timestamp_str is None:
-                    logger.debug('No photoTakenTime in %s, skipping', json_path)
-                    skipped += 1
-                    continue
-                capture_ts = int(timestamp_str)
-            except (json.JSONDecodeError, ValueError, KeyError, OSError) as e:
-                logger.warning('Could not parse %s: %s', json_path, e)
-                skipped += 1
-                continue
-
-            # Determine if this file needs mtime fixing
-            ext = os.path.splitext(media_name)[1].lower()
-            needs_fix = ext in _VIDEO_EXTENSIONS or not has_exif_date(media_path)
-
-            if not needs_fix:
-                already_ok += 1
-                if delete_json:
-                    _remove_json(json_path)
-                continue
-
-            # Apply the timestamp
-            try:
-                os.utime(media_path, (capture_ts, capture_ts))
-                logger.info('Fixed mtime: %s → %s',
-                            media_path, time.ctime(capture_ts))
-                fixed += 1
-                if delete_json:
-                    _remove_json(json_path)
-            except OSError as e:
-                logger.warning('Could not set mtime on %s: %s', media_path, e)
-                skipped += 1
-
-    return fixed, already_ok, skipped
+
+# A unit of work for the fixing stage: a sidecar (or None) and the files
+# it describes.
+_FixTask = tuple[str | None, list[str]]
+
+
+def _plan_directory(dirpath: str, filenames: list[str],
+                    stats: Counter[str]) -> Iterator[_FixTask]:
+    """Pair the sidecars and media files of one directory listing."""
+    groups, unmatched_media, unmatched_sidecars = (
+        SidecarIndex(filenames).groups())
+    for json_name in unmatched_sidecars:
+        # JSON without a corresponding media file — e.g. album
+        # metadata.  Skip.
+        logger.debug('No media file for sidecar %s',
+                     os.path.join(dirpath, json_name))
+        stats['skipped'] += 1
+        stats['unmatched_sidecars'] += 1
+    for json_name, media_names in groups.items():
+        yield (os.path.join(dirpath, json_name),
+               [os.path.join(dirpath, name) for name in media_names])
+    for media_name in unmatched_media:
+        logger.debug('No sidecar for %s', os.path.join(dirpath, media_name))
+        stats['unmatched_media'] += 1
+        yield (None, [os.path.join(dirpath, media_name)])
+
+
+def _fix_task(task: _FixTask, *,
+              delete_json: bool) -> list[tuple[str, str | None]]:
+    """Apply one sidecar's timestamp to its media files.
+
+    Returns ``(media_path, status)`` pairs where status is ``fixed``,
+    ``already_ok``, ``skipped``, or None for files without a sidecar.
+    """
+    json_path, media_paths = task
+    if json_path is None:
+        return [(path, None) for path in media_paths]
+
+    # Read the capture timestamp from the JSON sidecar
+    sidecar = read_sidecar(json_path)
+    if sidecar is None or sidecar['timestamp'] is None:
+        return [(path, 'skipped') for path in media_paths]
+    capture_ts = sidecar['timestamp']
+
+    results = []
+    for media_path in media_paths:
+        results.append((media_path, _apply_timestamp(media_path, capture_ts)))
+    if delete_json and all(status != 'skipped' for _path, status in results):
+        _remove_json(json_path)
+    return results
+
+
+def _apply_timestamp(media_path: str, capture_ts: int) -> str:
+    """Set *media_path*'s mtime to *capture_ts* unless EXIF already dates it."""
+    # Determine if this file needs mtime fixing
+    ext = os.path.splitext(media_path)[1].lower()
+    needs_fix = ext in _VIDEO_EXTENSIONS or not has_exif_date(media_path)
+    if not needs_fix:
+        return 'already_ok'
+
+    try:
+        os.utime(media_path, (capture_ts, capture_ts))
+        logger.info('Fixed mtime: %s → %s',
+                    media_path, time.ctime(capture_ts))
+        return 'fixed'
+    except OSError as e:
+        logger.warning('Could not set mtime on %s: %s', media_path, e)
+        return 'skipped'
+
+
+def read_sidecar(json_path: str) -> dict | None:
+    """Parse the fields mediaman uses from a Google Takeout JSON sidecar.
+
+    Returns a dict with ``timestamp`` (epoch seconds of ``photoTakenTime``),
+    ``description``, ``latitude`` and ``longitude``; any of them may be
+    None.  Google writes 0.0/0.0 for photos without a location, which is
+    reported as None.  Returns None if the file can't be read or parsed.
+    """
+    try:
+        with open(json_path, 'r', encoding='utf-8') as fh:
+            data = json.load(fh)
+        timestamp_str = data.get('photoTakenTime', {}).get('timestamp')
+        timestamp = None if timestamp_str is None else int(timestamp_str)
+    except (json.JSONDecodeError, ValueError, KeyError, OSError,
+            AttributeError) as e:
+        logger.warning('Could not parse %s: %s', json_path, e)
+        return None
+    if timestamp is None:
+        logger.debug('No photoTakenTime in %s', json_path)
+
+    latitude = longitude = None
+    for key in ('geoData', 'geoDataExif'):
+        geo = data.get(key)
+        if not isinstance(geo, dict):
+            continue
+        try:
+            lat = float(geo.get('latitude', 0.0))
+            lon = float(geo.get('longitude', 0.0))
+        except (TypeError, ValueError):
+            continue
+        if lat or lon:
+            latitude, longitude = lat, lon
+            break
+    description = data.get('description')
+    if not isinstance(description, str) or not description:
+        description = None
+    return {
+        'timestamp': timestamp,
+        'description': description,
+        'latitude': latitude,
+        'longitude': longitude,
+    }
 
 
 def iter_media_files(src_dir: str) -> list[str]:
@@ -138,15 +351,18 @@ def iter_media_files(src_dir: str) -> list[str]:
     results: list[str] = []
     for dirpath, _dirnames, filenames in os.walk(src_dir):
         for filename in filenames:
-            if filename.lower().endswith(_JSON_EXT):
-                continue
-            ext = os.path.splitext(filename)[1].lower()
-            if ext not in _MEDIA_EXTENSIONS:
-                continue
-            results.append(os.path.join(dirpath, filename))
+            if _is_media_name(filename):
+                results.append(os.path.join(dirpath, filename))
     return results
 
 
+def _is_media_name(filename: str) -> bool:
+    """Return True if *filename* has a photo or video extension."""
+    if filename.lower().endswith(_JSON_EXT):
+        return False
+    return os.path.splitext(filename)[1].lower() in _MEDIA_EXTENSIONS
+
+
 def _remove_json(json_path: str) -> None:
     """Delete a JSON sidecar file after successful processing."""
     try:
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Content-addressed thumbnail cache for the photo library.
+
+Thumbnails are keyed by the photo's MD5 (photos.md5), so renames and
+re-layouts never invalidate them, and stored as JPEGs under
+<cache>/<size>/<md5[0:2]>/<md5[2:4]>/<md5>.jpg.  Each photo is decoded
+once for all sizes, with Pillow's draft mode letting the JPEG decoder
+scale by 1/2, 1/4 or 1/8 in the DCT instead of decoding all 12 MP.
+
+The cache can be bounded in size: the least recently used thumbnails
+(by mtime, refreshed on use) are evicted first, and a missing thumbnail
+is simply generated again when it is next asked for.
+
+Usage:
+    thumbnails.py --media_dir /library --generate --max_mb 2000
+    thumbnails.py --media_dir /library --get <md5> --size 320
+"""
+import argparse
+import functools
+import logging
+import os
+import os.path
+import sys
+import time
+
+from PIL import Image, ImageOps
+
+import media_common
+
+# Longest edge of each thumbnail size, in pixels.
+SIZES = (160, 320, 1024)
+
+CACHE_DIR_NAME = 'thumbnails'
+
+_JOB = 'thumbnails'
+
+_QUALITY = 85
+
+# Thumbnails used within this long aren't touched again, to save writes.
+_TOUCH_INTERVAL = 3600
+
+# Eviction frees space down to this fraction of the limit, so it doesn't
+# run again after every few new thumbnails.
+_EVICT_TO = 0.9
+
+
+def default_cache_dir(lib_base_dir):
+    """Returns the thumbnail cache directory of a library."""
+    return os.path.join(lib_base_dir, CACHE_DIR_NAME)
+
+
+def thumbnail_path(cache_dir, md5, size):
+    """Returns where the thumbnail of one size of a photo is stored."""
+    return os.path.join(cache_dir, str(size), md5[0:2], md5[2:4],
+                        md5 + '.jpg')
+
+
+def generate(cache_dir, source_path, md5, sizes=SIZES):
+    """Writes the thumbnails of source_path in all sizes.
+
+    Returns 'generated', or 'not_image' if Pillow can't decode the file
+    (e.g. a video).  Thumbnails are written to a temporary name and
+    renamed into place, so readers never see a partial file.
+    """
+    try:
+        with Image.open(source_path) as image:
+            (width, height) = image.size
+            scale = max(sizes) / max(width, height)
+            if scale < 1:
+                # The decoder picks the smallest DCT scale that is still
+                # at least this big.
+                image.draft('RGB', (int(width * scale) + 1,
+                                    int(height * scale) + 1))
+            image = ImageOps.exif_transpose(image.convert('RGB'))
+    except (OSError, ValueError, SyntaxError,
+            Image.DecompressionBombError) as e:
+        logging.debug('Cannot make thumbnails of %s: %s', source_path, e)
+        return 'not_image'
+    # Largest first, each one shrunk from the last.
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        path = thumbnail_path(cache_dir, md5, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        image.save(tmp_path, 'JPEG', quality=_QUALITY)
+        os.replace(tmp_path, path)
+    return 'generated'
+
+
+def get(cache_dir, md5, size, source_path):
+    """Returns the path of a photo's thumbnail, generating it on a miss.
+
+    Returns None if no thumbnail can be made of source_path.  A hit
+    refreshes the thumbnail's mtime, which eviction uses as its last use.
+    """
+    path = thumbnail_path(cache_dir, md5, size)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        if generate(cache_dir, source_path, md5) != 'generated':
+            return None
+        return path
+    if mtime < time.time() - _TOUCH_INTERVAL:
+        os.utime(path)
+    return path
+
+
+def evict(cache_dir, max_bytes):
+    """Deletes least recently used thumbnails until the cache is within
+    max_bytes.
+
+    Returns (files removed, bytes freed).
+    """
+    entries = []
+    total = 0
+    for path in media_common.walk_files(cache_dir):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    if total <= max_bytes:
+        return (0, 0)
+    entries.sort()
+    target = max_bytes * _EVICT_TO
+    removed = freed = 0
+    for (_mtime, size, path) in entries:
+        if total - freed <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        removed += 1
+        freed += size
+    logging.info('Evicted %d thumbnails (%.1f MB) from %s', removed,
+                 freed / 1e6, cache_dir)
+    return (removed, freed)
+
+
+def generate_all(lib_base_dir, cache_dir=None, workers=4, max_rate=None,
+                 max_bytes=None):
+    """Makes thumbnails for every archived photo that has none yet.
+
+    Runs in a process pool.  Each photo's MD5 is recorded in a ledger in
+    media.db, so an interrupted run resumes and the hourly ingest only
+    pays for new photos; thumbnails evicted since are regenerated on
+    their next use instead.  With max_bytes, the cache is evicted down
+    to size at the end.  Returns a Counter of statuses.
+    """
+    cache_dir = cache_dir or default_cache_dir(lib_base_dir)
+    rep = media_common.Repository()
+    rep.open(lib_base_dir)
+    try:
+        rows = rep.con.execute(
+            'SELECT id, archive_path, md5 FROM photos ORDER BY id'
+        ).fetchall()
+        job = media_common.BatchJob(
+            'thumbnails', functools.partial(_generate_row, cache_dir),
+            ledger=rep.ledger(_JOB), key=lambda row: row[2],
+            workers=workers, processes=True,
+            rate_limiter=(media_common.RateLimiter(ops_per_sec=max_rate)
+                          if max_rate else None))
+        counts = job.run(rows)
+    finally:
+        rep.close()
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes)
+    return counts
+
+
+def _generate_row(cache_dir, row):
+    """Generates the thumbnails of an (id, archive_path, md5) row, unless
+    they are all already cached."""
+    (_db_id, archive_path, md5) = row
+    if all(os.path.exists(thumbnail_path(cache_dir, md5, size))
+           for size in SIZES):
+        return 'cached'
+    return generate(cache_dir, archive_path, md5)
+
+
+def _configure_logging():
+    """Configures logging to stderr, file."""
+    media_common.configure_logging('thumbnails.log')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate and look up photo thumbnails.')
+    parser.add_argument('--media_dir', required=True,
+                        help='Media library')
+    parser.add_argument('--cache_dir',
+                        help='Thumbnail cache (default: '
+                             '<media_dir>/%s)' % CACHE_DIR_NAME)
+    parser.add_argument('--generate', action='store_true',
+                        help='Make thumbnails for all photos that have '
+                             'none yet')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Worker processes for --generate '
+                             '(default: 4)')
+    parser.add_argument('--max_rate', type=float,
+                        help='Limit --generate to this many photos per '
+                             'second')
+    parser.add_argument('--max_mb', type=float,
+                        help='Evict least recently used thumbnails to keep '
+                             'the cache under this size')
+    parser.add_argument('--get', metavar='MD5',
+                        help='Print the path of this photo\'s thumbnail, '
+                             'making it if needed')
+    parser.add_argument('--size', type=int, default=SIZES[1],
+                        choices=SIZES,
+                        help='Thumbnail size for --get (default: '
+                             '%(default)s)')
+    args = parser.parse_args()
+    if not (args.generate or args.get or args.max_mb):
+        parser.error('one of --generate, --get or --max_mb is required')
+    cache_dir = args.cache_dir or default_cache_dir(args.media_dir)
+    max_bytes = args.max_mb * 1e6 if args.max_mb else None
+
+    _configure_logging()
+    try:
+        if args.generate:
+            generate_all(args.media_dir, cache_dir, args.workers,
+                         args.max_rate, max_bytes)
+        elif max_bytes:
+            evict(cache_dir, max_bytes)
+        if args.get:
+            rep = media_common.Repository()
+            rep.open(args.media_dir, read_only=True)
+            try:
+                row = rep.lookup_hash(args.get)
+            finally:
+                rep.close()
+            path = row and get(cache_dir, args.get, args.size, row[1])
+            if path is None:
+                logging.error('No thumbnail for %s', args.get)
+                sys.exit(1)
+            print(path)
+    except Exception:
+        logging.exception('An unexpected error occurred making thumbnails')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
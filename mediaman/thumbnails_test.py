@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import glob
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from unittest.mock import *
+
+from PIL import Image, JpegImagePlugin
+
+import media_common
+import photoman
+import thumbnails
+
+
+class ThumbnailTests(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger('')
+        # prevent log messages from cluttering unit test output
+        root.setLevel(logging.CRITICAL)
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        scriptdir = os.path.dirname(os.path.realpath(__file__))
+        self.testdir = os.path.join(scriptdir, 'test')
+        self.photo = os.path.join(self.testdir, 'DSC09012.JPG')
+        self.md5 = media_common.compute_md5(self.photo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_thumbnail_path_is_sharded(self):
+        self.assertEqual(
+            os.path.join(self.cache, '320', 'ab', 'cd', 'abcdef.jpg'),
+            thumbnails.thumbnail_path(self.cache, 'abcdef', 320))
+
+    def test_generate_all_sizes(self):
+        with Image.open(self.photo) as image:
+            (width, height) = image.size
+        self.assertEqual('generated', thumbnails.generate(
+            self.cache, self.photo, self.md5))
+        for size in thumbnails.SIZES:
+            with Image.open(thumbnails.thumbnail_path(
+                    self.cache, self.md5, size)) as thumb:
+                self.assertEqual(size, max(thumb.size))
+                self.assertAlmostEqual(width / height,
+                                       thumb.size[0] / thumb.size[1],
+                                       places=1)
+        self.assertEqual([], glob.glob(os.path.join(self.cache, '*', '*',
+                                                    '*', '*.tmp')))
+
+    def test_generate_uses_draft_and_orientation(self):
+        path = os.path.join(self.tmpdir, 'rotated.jpg')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.new('RGB', (4000, 3000)).save(path, exif=exif)
+        jpeg_file = JpegImagePlugin.JpegImageFile
+        with patch.object(jpeg_file, 'draft', autospec=True,
+                          side_effect=jpeg_file.draft) as draft:
+            thumbnails.generate(self.cache, path, 'ff00', sizes=(500,))
+        draft.assert_called_once_with(ANY, 'RGB', (501, 376))
+        with Image.open(thumbnails.thumbnail_path(self.cache, 'ff00',
+                                                  500)) as thumb:
+            self.assertEqual((375, 500), thumb.size)
+
+    def test_not_image(self):
+        path = os.path.join(self.tmpdir, 'clip.mp4')
+        with open(path, 'wb') as fh:
+            fh.write(b'\x00\x00\x00\x18ftypmp42')
+        self.assertEqual('not_image',
+                         thumbnails.generate(self.cache, path, 'aa00'))
+        self.assertIsNone(thumbnails.get(self.cache, 'aa00', 160, path))
+
+    def test_get_regenerates_on_miss_and_refreshes_use(self):
+        path = thumbnails.get(self.cache, self.md5, 160, self.photo)
+        self.assertTrue(os.path.isfile(path))
+        os.utime(path, (0, 0))
+        self.assertEqual(path, thumbnails.get(self.cache, self.md5, 160,
+                                              self.photo))
+        self.assertGreater(os.stat(path).st_mtime, 0)
+        os.remove(path)
+        self.assertEqual(path, thumbnails.get(self.cache, self.md5, 160,
+                                              self.photo))
+        self.assertTrue(os.path.isfile(path))
+
+    def test_evict_least_recently_used(self):
+        paths = []
+        for i in range(5):
+            path = thumbnails.thumbnail_path(self.cache, '%04x' % i, 160)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fh:
+                fh.write(b'x' * 1000)
+            # Used in the order 3, 1, 4, 0, 2.
+            os.utime(path, (0, [3, 1, 4, 0, 2].index(i) * 100))
+            paths.append(path)
+        self.assertEqual((0, 0), thumbnails.evict(self.cache, 5000))
+        self.assertEqual((3, 3000), thumbnails.evict(self.cache, 3000))
+        self.assertEqual([True, False, True, False, False],
+                         [os.path.exists(path) for path in paths])
+
+    @patch('grp.getgrnam', new=lambda x: [None, None, -1])
+    @patch('os.chown', new=lambda x, y, z: None)
+    def test_generate_all_resumes(self):
+        srcdir = os.path.join(self.tmpdir, 'src')
+        mediadir = os.path.join(self.tmpdir, 'media')
+        shutil.copytree(self.testdir, srcdir)
+        photoman._find_and_archive_photos(srcdir, mediadir, True, 'foo')
+        self.assertEqual({'generated': 5},
+                         thumbnails.generate_all(mediadir, workers=2))
+        cache = thumbnails.default_cache_dir(mediadir)
+        self.assertEqual(5 * len(thumbnails.SIZES),
+                         len(list(media_common.walk_files(cache))))
+        self.assertEqual({'already_done': 5},
+                         thumbnails.generate_all(mediadir, workers=2))
+        # A bounded cache is evicted down to size.
+        thumbnails.generate_all(mediadir, max_bytes=50000)
+        self.assertLessEqual(
+            sum(os.path.getsize(path)
+                for path in media_common.walk_files(cache)), 50000)
+
+
+if __name__ == '__main__':
+    unittest.main()